@@ -0,0 +1,399 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from llm_client import get_llm_client, response_content, parse_json_response, LLMCancelled
+from instrumentation import span, log_event
+from ocr_utils import PAGE_MARKER_RE
+from prompt_budget import count_tokens, split_at_tokens, compress_markdown
+from config import (ANALYSIS_CONCURRENCY, ANALYSIS_CHUNK_TOKENS, ANALYSIS_CRITERIA_BATCH_CHARS,
+                    ANALYSIS_CRITERIA_BATCH_SIZE)
+
+CATEGORY_INCLUSION = 'inclusion'
+CATEGORY_EXCLUSION = 'exclusion'
+
+# 单个条目的判定：met 表示患者满足该条目所描述的条件
+STATUS_MET = 'met'
+STATUS_NOT_MET = 'not_met'
+STATUS_UNKNOWN = 'unknown'
+
+# 分块并发分析时检查取消标志的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.2
+
+_INCLUSION_HEADING = re.compile(r'(inclusion|入选|纳入|入组)', re.IGNORECASE)
+_EXCLUSION_HEADING = re.compile(r'(exclusion|排除)', re.IGNORECASE)
+_ITEM_START = re.compile(r'^\s*(?:[-*•]\s+|\(?\d{1,3}[.)、）]\s*|[（(]\d{1,3}[)）]\s*)')
+_SECTION_BREAK = re.compile(rf'^(?:{PAGE_MARKER_RE.pattern}|#{{1,6}}\s)', re.MULTILINE)
+
+
+def split_criteria_items(criteria_text):
+    """把入排标准文本拆成条目列表 [{'id', 'category', 'text'}]
+
+    以 Inclusion/Exclusion（入选/排除）标题区分类别，以编号或项目符号开头的行作为新条目，
+    其余行并入上一条。
+    """
+    items = []
+    category = CATEGORY_INCLUSION
+    current = None
+    for line in criteria_text.splitlines():
+        stripped = line.strip().strip('#*').strip()
+        if not stripped:
+            continue
+        is_item = bool(_ITEM_START.match(line))
+        if not is_item and len(stripped) < 40:
+            if _EXCLUSION_HEADING.search(stripped):
+                category = CATEGORY_EXCLUSION
+                current = None
+                continue
+            if _INCLUSION_HEADING.search(stripped):
+                category = CATEGORY_INCLUSION
+                current = None
+                continue
+        if is_item:
+            stripped = _ITEM_START.sub('', line).strip()
+        if is_item or current is None or current['category'] != category:
+            current = {'category': category, 'text': stripped}
+            items.append(current)
+        else:
+            current['text'] += " " + stripped
+    counters = {CATEGORY_INCLUSION: 0, CATEGORY_EXCLUSION: 0}
+    for item in items:
+        counters[item['category']] += 1
+        prefix = 'I' if item['category'] == CATEGORY_INCLUSION else 'E'
+        item['id'] = f"{prefix}{counters[item['category']]}"
+    return items
+
+
+def _cut_score(piece):
+    """片段内容的哈希映射到 [0, 1)，用于由内容决定分块边界"""
+    return int(hashlib.sha256(piece.encode('utf-8')).hexdigest()[:8], 16) / 0x100000000
+
+
+def split_case_sections(case_text, max_tokens=ANALYSIS_CHUNK_TOKENS):
+    """按页码标记 / Markdown 标题把病例切成小节（超长小节再按行切），再合并成不超过 max_tokens 的分块
+
+    分块边界由片段内容决定（见 _cut_score），而不是按顺序装满：修改病例的某一处只影响所在的分块，
+    其余分块内容不变，VerdictMemo 中按分块记忆的判定仍可沿用。
+    """
+    starts = [m.start() for m in _SECTION_BREAK.finditer(case_text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    sections = [case_text[a:b] for a, b in zip(starts, starts[1:] + [len(case_text)])]
+
+    pieces = []
+    for section in sections:
+        section_tokens = count_tokens(section)
+        if section_tokens <= max_tokens:
+            pieces.append((section, section_tokens))
+            continue
+        # 超长小节按行切分，超长的行再按 token 上限切开
+        for line in section.splitlines(keepends=True):
+            line_tokens = count_tokens(line)
+            while line_tokens > max_tokens:
+                head, line = split_at_tokens(line, max_tokens)
+                pieces.append((head, count_tokens(head)))
+                line_tokens = count_tokens(line)
+            if line:
+                pieces.append((line, line_tokens))
+
+    # 分块 token 数按各片段之和累计，分词在片段边界处的差异很小，可以忽略。
+    # 片段的得分小于其 token 数 / target_tokens 时在其后断开（平均每 target_tokens 断开一次，不足 min_tokens 不断开）；
+    # 加入下一片段会超过 max_tokens 时，在当前分块中得分最低的片段之后断开，同样只取决于内容
+    target_tokens = max(max_tokens // 2, 1)
+    min_tokens = max_tokens // 4
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece, piece_tokens in pieces:
+        score = _cut_score(piece)
+        while current and current_tokens + piece_tokens > max_tokens:
+            cut = min(range(len(current)), key=lambda i: current[i][2])
+            chunks.append("".join(entry[0] for entry in current[:cut + 1]))
+            current = current[cut + 1:]
+            current_tokens = sum(entry[1] for entry in current)
+        current.append((piece, piece_tokens, score))
+        current_tokens += piece_tokens
+        if current_tokens >= min_tokens and score < piece_tokens / target_tokens:
+            chunks.append("".join(entry[0] for entry in current))
+            current, current_tokens = [], 0
+    if current:
+        chunks.append("".join(entry[0] for entry in current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def batch_criteria(items, max_chars=ANALYSIS_CRITERIA_BATCH_CHARS, max_items=ANALYSIS_CRITERIA_BATCH_SIZE):
+    """把条目分成若干批，每批不超过 max_items 条且文本总长不超过 max_chars，各批可并发评估"""
+    batches = []
+    size = 0
+    for item in items:
+        if batches and len(batches[-1]) < max_items and size + len(item['text']) <= max_chars:
+            batches[-1].append(item)
+            size += len(item['text'])
+        else:
+            batches.append([item])
+            size = len(item['text'])
+    return batches
+
+
+def criteria_prompt(all_items):
+    """评估用的系统提示：说明 + 完整条目列表
+
+    同一方案下对所有患者、所有分块都完全相同，放在消息最前面，
+    使服务端的前缀缓存（prompt caching）可以命中。
+    """
+    criteria_lines = "\n".join(
+        f"[{item['id']}]（{'入选' if item['category'] == CATEGORY_INCLUSION else '排除'}）{item['text']}"
+        for item in all_items
+    )
+    return f"""你是临床试验受试者筛查助手。用户会提供患者病例（可能只是其中一部分）以及需要评估的条目编号，
+请仅根据所提供的病例内容，逐条判断患者是否满足条目所描述的条件。
+
+试验方案的全部入排条目：
+{criteria_lines}
+
+判断结果只能是 met（满足该条件）、not_met（明确不满足）或 unknown（所给病例没有相关信息）。
+请只输出 JSON，格式为：
+{{"verdicts": [{{"id": "条目编号", "status": "met|not_met|unknown", "evidence": "病例原文摘录", "reason": "简要解释"}}]}}"""
+
+
+def _map_messages(all_items, items, chunk, chunk_index, chunk_count):
+    # 消息顺序由稳定到多变：条目列表（按方案固定）→ 病例分块（按患者固定）→ 本次要评估的条目编号
+    return [
+        {"role": "system", "content": criteria_prompt(all_items)},
+        {"role": "user", "content": f"患者病例（第 {chunk_index}/{chunk_count} 部分）：\n{chunk}"},
+        {"role": "user", "content": f"请评估以下条目：{', '.join(item['id'] for item in items)}"},
+    ]
+
+
+def evaluate_chunk(items, chunk, chunk_index=1, chunk_count=1, max_tokens=2000, all_items=None, refresh=False):
+    """map 阶段：用一个病例分块评估一批条目，返回 {条目ID: 判定}"""
+    response = get_llm_client().chat_completion(
+        messages=_map_messages(all_items or items, items, chunk, chunk_index, chunk_count),
+        model="deepseek-chat",
+        temperature=0.0,
+        max_tokens=max_tokens,
+        response_format={"type": "json_object"},
+        refresh=refresh,
+    )
+    parsed = parse_json_response(response_content(response))
+    known = {item['id'] for item in items}
+    verdicts = {}
+    for verdict in parsed.get('verdicts', []):
+        item_id = verdict.get('id')
+        if item_id not in known:
+            continue
+        status = verdict.get('status')
+        if status not in (STATUS_MET, STATUS_NOT_MET, STATUS_UNKNOWN):
+            status = STATUS_UNKNOWN
+        verdicts[item_id] = {
+            'status': status,
+            'evidence': (verdict.get('evidence') or "").strip(),
+            'reason': (verdict.get('reason') or "").strip(),
+        }
+    return verdicts
+
+
+def merge_verdicts(items, chunk_verdicts):
+    """reduce 阶段：合并各分块对同一条目的判定
+
+    任一分块判定 met 即为 met（病例中出现了相关事实）；否则只要有分块判定 not_met 即为 not_met；
+    都没有信息时为 unknown。证据取与最终判定一致的各分块摘录。
+    """
+    merged = {}
+    for item in items:
+        found = [v[item['id']] for v in chunk_verdicts if item['id'] in v]
+        statuses = {v['status'] for v in found}
+        if STATUS_MET in statuses:
+            status = STATUS_MET
+        elif STATUS_NOT_MET in statuses:
+            status = STATUS_NOT_MET
+        else:
+            status = STATUS_UNKNOWN
+        # 信息不足的条目不附证据；其余去重后保留原顺序
+        supporting = [v for v in found if v['status'] == status] if status != STATUS_UNKNOWN else []
+        merged[item['id']] = {
+            'status': status,
+            'evidence': list(dict.fromkeys(v['evidence'] for v in supporting if v['evidence'])),
+            'reasons': list(dict.fromkeys(v['reason'] for v in supporting if v['reason'])),
+        }
+    return merged
+
+
+def render_verdicts(items, merged, pending=0, note=""):
+    """按原有的三段式格式输出：符合的条目 / 不符合的条目 / 总体结论，note 附在结论之后"""
+    eligible, ineligible, unknown = [], [], []
+    for item in items:
+        verdict = merged.get(item['id'])
+        if verdict is None:
+            unknown.append((item, None))
+            continue
+        satisfied = verdict['status'] == STATUS_MET
+        if verdict['status'] == STATUS_UNKNOWN:
+            unknown.append((item, verdict))
+        elif satisfied == (item['category'] == CATEGORY_INCLUSION):
+            eligible.append((item, verdict))
+        else:
+            ineligible.append((item, verdict))
+
+    def _lines(entries):
+        if not entries:
+            return ["无"]
+        lines = []
+        for item, verdict in entries:
+            label = '入选' if item['category'] == CATEGORY_INCLUSION else '排除'
+            lines.append(f"- [{item['id']}]（{label}）{item['text']}")
+            if verdict and verdict['evidence']:
+                lines.append(f"  依据：{'；'.join(verdict['evidence'][:3])}")
+            if verdict and verdict['reasons']:
+                lines.append(f"  解释：{'；'.join(verdict['reasons'][:2])}")
+        return lines
+
+    if ineligible:
+        conclusion = f"不符合入排标准（{len(ineligible)} 条不符合）。"
+    elif unknown:
+        conclusion = f"目前未发现不符合的条目，但有 {len(unknown)} 条缺少信息，需补充资料后确认。"
+    else:
+        conclusion = "符合入排标准。"
+    if pending:
+        conclusion = f"分析进行中，尚有 {pending} 个分块未完成。"
+
+    parts = ["1. 符合的条目："] + _lines(eligible)
+    parts += ["", "2. 不符合的条目："] + _lines(ineligible)
+    if unknown:
+        parts += ["", "信息不足的条目："] + _lines(unknown)
+    parts += ["", f"3. 总体结论：{conclusion}{note}"]
+    return "\n".join(parts)
+
+
+def extract_conclusion(analysis):
+    """从分析结果中截取“总体结论”部分，便于在 CSV 与历史会话列表中查看"""
+    marker = analysis.find("总体结论")
+    if marker < 0:
+        return ""
+    conclusion = analysis[marker + len("总体结论"):].lstrip("：:*# \n")
+    return " ".join(conclusion.split())[:500]
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def item_key(item):
+    """条目的记忆键：类别 + 文本（忽略空白差异），与编号无关，增删其他条目后仍能对上"""
+    text = re.sub(r'\s+', ' ', item['text']).strip()
+    return _digest(f"{item['category']}:{text}")
+
+
+class VerdictMemo:
+    """按 (条目, 病例分块) 记忆逐条判定，用于修改入排标准或病例后的增量重新分析
+
+    只改动了个别条目时，其余条目在各分块上的判定直接沿用；只改动了病例的某一部分时，
+    只有内容变化的分块需要重新评估。超过 max_entries 时淘汰最久未用的记录。
+    """
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, item_digest, chunk_digest):
+        with self._lock:
+            verdict = self._entries.get((item_digest, chunk_digest))
+            if verdict is not None:
+                self._entries.move_to_end((item_digest, chunk_digest))
+            return verdict
+
+    def put(self, item_digest, chunk_digest, verdict):
+        with self._lock:
+            self._entries[(item_digest, chunk_digest)] = verdict
+            self._entries.move_to_end((item_digest, chunk_digest))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def map_reduce_analysis(criteria, patient_case, on_progress=None, cancel_event=None, items=None, refresh=False,
+                        memo=None):
+    """分块并发分析长病例：病例分块 × 条目批次并发评估，再按条目合并
+
+    on_progress(当前合并结果文本) 在每个评估单元完成后回调；cancel_event 置位时抛出 LLMCancelled。
+    items 可传入已拆分好的条目列表，否则从 criteria 文本中拆分；refresh=True 时忽略响应缓存。
+    病例先压缩页眉页脚与表格冗余标记，再按 token 上限分块。
+    传入 memo（VerdictMemo）时，已记忆的 (条目, 分块) 判定直接沿用，只评估新增或改动的部分；
+    refresh=True 时全部重新评估并更新记忆。
+    """
+    items = items or split_criteria_items(criteria)
+    if not items:
+        raise ValueError("未能从入排标准中识别出条目")
+    chunks = split_case_sections(compress_markdown(patient_case))
+    item_digests = {item['id']: item_key(item) for item in items}
+    chunk_digests = [_digest(chunk) for chunk in chunks]
+
+    # 已记忆的判定按分块放入结果，剩余条目按分块重新分批
+    chunk_verdicts = []
+    units = []
+    for index, chunk in enumerate(chunks, 1):
+        remembered = {}
+        if memo is not None and not refresh:
+            for item in items:
+                verdict = memo.get(item_digests[item['id']], chunk_digests[index - 1])
+                if verdict is not None:
+                    remembered[item['id']] = verdict
+        if remembered:
+            chunk_verdicts.append(remembered)
+        missing = [item for item in items if item['id'] not in remembered]
+        units.extend((batch, chunk, index) for batch in batch_criteria(missing))
+    reused = sum(len(verdicts) for verdicts in chunk_verdicts)
+    log_event("analysis.map_reduce_plan", f"分块分析：病例 {len(chunks)} 块 × 条目 {len(items)} 条，"
+              f"沿用已有判定 {reused} 项，需发送 {len(units)} 个请求",
+              chunks=len(chunks), items=len(items), reused=reused, requests=len(units))
+
+    with span("analysis.map_reduce", chunks=len(chunks), items=len(items), reused=reused, requests=len(units)):
+        # 不用 with 管理线程池：退出 with 会等待所有在途请求结束，取消时需要立即返回
+        executor = ThreadPoolExecutor(max_workers=ANALYSIS_CONCURRENCY)
+        futures = {
+            executor.submit(evaluate_chunk, batch, chunk, index, len(chunks), all_items=items,
+                            refresh=refresh): (batch, index)
+            for batch, chunk, index in units
+        }
+        pending = set(futures)
+        done_count = 0
+        try:
+            while pending:
+                # 定期检查取消标志，不必等到下一个请求完成
+                done, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                if cancel_event is not None and cancel_event.is_set():
+                    raise LLMCancelled()
+                for future in done:
+                    batch, index = futures[future]
+                    try:
+                        verdicts = future.result()
+                    except ValueError as e:
+                        # 单个分块返回的内容无法解析时，这批条目在该分块上记为信息不足，不影响其他分块；
+                        # 也不写入记忆，下次分析时重新评估
+                        log_event("analysis.chunk_unparsable", f"第 {index} 块的评估结果无法解析：{str(e)}",
+                                  level="warning", chunk=index, items=len(batch))
+                        verdicts = {item['id']: {'status': STATUS_UNKNOWN, 'evidence': "", 'reason': ""}
+                                    for item in batch}
+                    else:
+                        if memo is not None:
+                            for item_id, verdict in verdicts.items():
+                                memo.put(item_digests[item_id], chunk_digests[index - 1], verdict)
+                    chunk_verdicts.append(verdicts)
+                    done_count += 1
+                    if on_progress is not None:
+                        on_progress(render_verdicts(items, merge_verdicts(items, chunk_verdicts),
+                                                    len(units) - done_count))
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return render_verdicts(items, merge_verdicts(items, chunk_verdicts))
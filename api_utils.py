@@ -1,22 +1,46 @@
 import requests
-from openai import OpenAI
-from config import API_KEY, API_URL
-def extract_criteria_from_text(text):
+from instrumentation import log_event
+from llm_client import get_llm_client, response_content, LLMError, LLMCancelled
+from analysis_engine import map_reduce_analysis
+from prompt_budget import compress_markdown, count_message_tokens, prompt_budget
+from criteria_compiler import compile_criteria, evaluate_patient
+from config import LAB_RULES_ENABLED
+
+
+def _complete(messages, on_delta=None, cancel_event=None, **params):
+    """发送请求并返回完整文本
+
+    传入 on_delta 时改用流式接口，每收到一段新文本就以 on_delta(新增文本, 已累计文本) 回调，
+    cancel_event 被置位时抛出 LLMCancelled。相同请求优先返回响应缓存，refresh=True 时重新请求。
+    """
+    client = get_llm_client()
+    if on_delta is None:
+        return response_content(client.chat_completion(messages=messages, **params))
+    content = ""
+    for delta in client.stream_chat_completion(messages=messages, cancel_event=cancel_event, **params):
+        content += delta
+        on_delta(delta, content)
+    return content
+
+
+def extract_criteria_from_text(text, on_delta=None, cancel_event=None, refresh=False):
     """调用 AI API 提取入排标准"""
     try:
-        client = OpenAI(api_key=API_KEY, base_url=API_URL)
-        response = client.chat.completions.create(
+        message_content = _complete(
             model="deepseek-chat",
             messages=[
                 {"role": "system", "content": "you are a helpful assistant"},
                 {"role": "user", "content": f"请从以下文本中具体的和严谨的提取方案中Inclusion Criteria和Exclusion Criteria两部分原文，不要加入任何新内容：\n{text}"}
-            ]
+            ],
+            on_delta=on_delta,
+            cancel_event=cancel_event,
+            refresh=refresh
         )
-        
-        # 直接从response中获取内容
-        message_content = response.choices[0].message.content
         return True, message_content
 
+    except LLMCancelled:
+        return False, "已取消"
+
     except requests.exceptions.Timeout:
         return False, "连接超时，请检查网络连接"
     except requests.exceptions.ConnectionError:
@@ -24,47 +48,19 @@ def extract_criteria_from_text(text):
     except Exception as e:
         return False, f"发生错误：{str(e)}"
 
-def analyze_patient_criteria(criteria, patient_case):
+def analyze_patient_criteria(criteria, patient_case, on_delta=None, cancel_event=None, refresh=False):
     """使用 deepseek-reasoner 分析患者是否符合入排标准"""
     try:
-        headers = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
-        full_api_url = f"{API_URL}/v1/chat/completions"  # 确保URL是完整的
-        
-        # 限制文本长度，防止token超限
-        max_criteria_length = 10000  # 可根据实际情况调整
-        max_case_length = 20000
-        
-        criteria_length = len(criteria)
-        case_length = len(patient_case)
-        
-        criteria_truncated = False
-        case_truncated = False
-        
-        if criteria_length > max_criteria_length:
-            criteria = criteria[:max_criteria_length] + f"...[内容过长已截断，原长度: {criteria_length} 字符]"
-            criteria_truncated = True
-            print(f"入排标准内容过长，已截断至{max_criteria_length}字符，原长度: {criteria_length}字符")
-            
-        if case_length > max_case_length:
-            patient_case = patient_case[:max_case_length] + f"...[内容过长已截断，原长度: {case_length} 字符]"
-            case_truncated = True
-            print(f"患者病例内容过长，已截断至{max_case_length}字符，原长度: {case_length}字符")
-        
-        # 在界面上显示长度信息的提示
-        length_info = ""
-        if criteria_truncated:
-            length_info += f"入排标准内容长度: {criteria_length}字符，超过{max_criteria_length}字符限制，已截断。\n"
-        if case_truncated:
-            length_info += f"患者病例内容长度: {case_length}字符，超过{max_case_length}字符限制，已截断。\n"
-        
-        if length_info:
-            length_info += "内容过长可能影响分析结果的准确性。\n\n"
-        
-        payload = {
-            "model": "deepseek-chat",  # 尝试使用不同的模型
-            "messages": [{
-                "role": "user", 
-                "content": f"""请分析以下患者病例是否符合入排标准，并在病例中标注符合和不符合的条目：
+        client = get_llm_client()
+        
+        # 先压缩病例 OCR 输出中的页眉页脚与表格冗余标记，再按模型的上下文预算决定能否一次发送；
+        # 入排标准需逐条引用原文，不做有损压缩
+        patient_case = compress_markdown(patient_case)
+        model = "deepseek-chat"  # 尝试使用不同的模型
+        max_tokens = 5000
+        messages = [{
+            "role": "user",
+            "content": f"""请分析以下患者病例是否符合入排标准，并在病例中标注符合和不符合的条目：
                 
 入排标准：
 {criteria}
@@ -77,31 +73,50 @@ def analyze_patient_criteria(criteria, patient_case):
 2. 不符合的条目：(在原文中标注并解释)
 3. 总体结论：
 """
-            }],
-            "temperature": 0.7,
-            "max_tokens": 5000
-        }
-        
-        print(f"正在发送请求到: {full_api_url}")
-        
-        response = requests.post(full_api_url, headers=headers, json=payload, timeout=120)
-        
-        # 打印详细的响应信息
-        print(f"状态码: {response.status_code}")
-        print(f"响应内容: {response.text}")
-        
-        if response.status_code != 200:
-            return f"{length_info}分析失败：API响应状态码 {response.status_code} - {response.text}"
-        
-        response_json = response.json()
+        }]
+        prompt_tokens = count_message_tokens(messages)
+        budget = prompt_budget(model, max_tokens)
+        
+        # 超过单次请求的预算时不再截断，改为分块并发分析后按条目合并
+        if prompt_tokens > budget:
+            log_event("analysis.long_input", f"内容较长（提示词约 {prompt_tokens} token，预算 {budget} token），改用分块分析",
+                      prompt_tokens=prompt_tokens, budget=budget)
+            try:
+                return map_reduce_analysis(
+                    criteria, patient_case,
+                    on_progress=(lambda text: on_delta(text, text)) if on_delta is not None else None,
+                    cancel_event=cancel_event,
+                    refresh=refresh
+                )
+            except LLMError as e:
+                return f"分析失败：{str(e)}"
+            except LLMCancelled:
+                return "分析失败：已取消"
+            except ValueError as e:
+                return f"分析失败：{str(e)}"
+        
+        log_event("analysis.request", level="debug", url=client.url, prompt_tokens=prompt_tokens, budget=budget)
+        
+        try:
+            content = _complete(
+                messages=messages,
+                model=model,
+                temperature=0.7,
+                max_tokens=max_tokens,
+                on_delta=on_delta,
+                cancel_event=cancel_event,
+                refresh=refresh
+            )
+        except LLMError as e:
+            return f"分析失败：{str(e)}"
+        except LLMCancelled:
+            return "分析失败：已取消"
         
         # 解析响应内容
-        if "choices" in response_json and len(response_json["choices"]) > 0:
-            content = response_json["choices"][0].get("message", {}).get("content", "")
-            if content:
-                return f"{length_info}{content}"
+        if content:
+            return content
         
-        return f"{length_info}分析失败：无法解析API响应 - {response_json}"
+        return "分析失败：API 未返回内容"
             
     except requests.exceptions.Timeout:
         return "分析失败：请求超时，请检查网络连接或稍后重试"
@@ -110,24 +125,91 @@ def analyze_patient_criteria(criteria, patient_case):
     except Exception as e:
         return f"分析失败：未知错误 - {str(e)}"
 
-def organize_patient_case(case_text):
-    """使用AI模型整理患者病例"""
+def compile_protocol_criteria(criteria_text, previous=None):
+    """将入排标准编译为结构化条目列表（按方案哈希缓存）；传入上一版编译结果时只编译改动的条目"""
+    try:
+        return True, compile_criteria(criteria_text, previous=previous)
+    except Exception as e:
+        return False, f"发生错误：{str(e)}"
+
+def analyze_patient_by_criteria(compiled, patient_case, on_delta=None, cancel_event=None, refresh=False, memo=None):
+    """按编译好的条目逐条分析患者是否符合入排标准，输出格式与 analyze_patient_criteria 相同
+
+    传入 memo（VerdictMemo）时沿用上次分析中未改动的条目与病例分块的判定。
+    """
+    try:
+        return evaluate_patient(
+            compiled, patient_case,
+            on_progress=(lambda text: on_delta(text, text)) if on_delta is not None else None,
+            cancel_event=cancel_event,
+            refresh=refresh,
+            memo=memo
+        )
+    except LLMError as e:
+        return f"分析失败：{str(e)}"
+    except LLMCancelled:
+        return "分析失败：已取消"
+    except requests.exceptions.Timeout:
+        return "分析失败：请求超时，请检查网络连接或稍后重试"
+    except requests.exceptions.ConnectionError:
+        return "分析失败：网络连接错误，无法连接到服务器"
+    except Exception as e:
+        return f"分析失败：未知错误 - {str(e)}"
+
+def screen_patient(criteria, patient_case, on_delta=None, cancel_event=None, refresh=False, previous=None, memo=None,
+                   on_stage=None):
+    """分析患者是否符合入排标准：优先按编译好的条目逐条评估，编译失败时退回整体分析
+
+    检验指标明确触发排除时直接给出结论，不再调用模型。传入上一版编译结果 previous 与 memo 时
+    只编译、评估改动过的条目与病例分块；on_stage(阶段, 已完成, 总数) 用于汇报进度。
+    返回 (分析结果, 可作为下次 previous 的编译结果或 None)。
+    """
+    if on_stage is not None:
+        on_stage("编译入排标准", 0, 1)
+    success, compiled = compile_protocol_criteria(criteria, previous=previous)
+    if cancel_event is not None and cancel_event.is_set():
+        return "分析失败：已取消", None
+    if not success or not compiled['items']:
+        return analyze_patient_criteria(criteria, patient_case, on_delta=on_delta, cancel_event=cancel_event,
+                                        refresh=refresh), None
+    reusable = compiled if compiled['source'] != 'split' else None
+    if LAB_RULES_ENABLED:
+        # lab_rules 依赖 NumPy，首次分析时再导入，不拖慢启动
+        from lab_rules import screen_cohort
+        outcome = screen_cohort(compiled, [patient_case])[0]
+        if outcome['excluded']:
+            return outcome['analysis'], reusable
+    if on_stage is not None:
+        on_stage("逐条评估", 1, 1)
+    return analyze_patient_by_criteria(compiled, patient_case, on_delta=on_delta, cancel_event=cancel_event,
+                                       refresh=refresh, memo=memo), reusable
+
+def organize_patient_case(case_text, on_delta=None, cancel_event=None, refresh=False, continuation=False):
+    """使用AI模型整理患者病例
+
+    continuation=True 表示 case_text 是同一病例的后续页面（前面的页面已另行整理），只整理其中的信息。
+    """
+    instruction = "将文本整理成患者病例，至少包含四部分分别是：血液生化指标/尿检/凝血检查/血常规，如有其他涉及到临床研究入排的信息，单独列举出来。"
+    if continuation:
+        instruction = "以下是同一患者病例的后续页面，前面的页面已经整理过。请按相同的分类（血液生化指标/尿检/凝血检查/血常规/其他入排相关信息）整理这些页面中的信息，没有相关内容的分类省略。"
     try:
-        client = OpenAI(api_key=API_KEY, base_url=API_URL)
-        response = client.chat.completions.create(
+        message_content = _complete(
             model="deepseek-chat",
             messages=[
                 {"role": "system", "content": "you are a helpful assistant"},
-                {"role": "user", "content": f"将文本整理成患者病例，至少包含四部分分别是：血液生化指标/尿检/凝血检查/血常规，如有其他涉及到临床研究入排的信息，单独列举出来。\n\n{case_text}"}
+                {"role": "user", "content": f"{instruction}\n\n{compress_markdown(case_text)}"}
             ],
             temperature=0.3,
-            max_tokens=2000
+            max_tokens=2000,
+            on_delta=on_delta,
+            cancel_event=cancel_event,
+            refresh=refresh
         )
-        
-        # 获取响应内容
-        message_content = response.choices[0].message.content
         return True, message_content
 
+    except LLMCancelled:
+        return False, "已取消"
+
     except requests.exceptions.Timeout:
         return False, "连接超时，请检查网络连接"
     except requests.exceptions.ConnectionError:
@@ -0,0 +1,353 @@
+"""无界面的批量筛查：将一个目录下的病例 PDF 与一个或多个试验方案逐一比对，结果逐行写入 JSONL 以便续跑
+
+用法示例：
+    python batch_screening.py cases/ --protocol protocol.pdf --protocol-pages 12-18,25 \
+        --output results.jsonl --csv results.csv --ocr-workers 4 --llm-concurrency 8
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from functools import partial
+
+from ocr_cache import file_sha256
+from ocr_utils import extract_text_from_pdf, init_ocr_worker
+from llm_client import get_llm_client
+from lab_rules import screen_cohort
+from candidate_index import CandidateIndex
+from analysis_engine import extract_conclusion
+from instrumentation import start_exporters, stage_summary
+from config import LAB_RULES_ENABLED, CACHE_DIR
+from api_utils import (extract_criteria_from_text, analyze_patient_criteria, organize_patient_case,
+                       compile_protocol_criteria, analyze_patient_by_criteria)
+
+CSV_FIELDS = ['case', 'protocol', 'status', 'decided_by', 'rank', 'conclusion', 'error', 'finished_at']
+
+
+def parse_pages(spec):
+    """将 '12-18,25' 这样的页码描述解析为页码列表，页码从 1 开始"""
+    if not spec:
+        return None
+    pages = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            pages.update(range(int(start), int(end) + 1))
+        else:
+            pages.add(int(part))
+    return sorted(pages)
+
+
+def load_completed(output_path, top_k=0):
+    """读取已有的 JSONL 结果，返回已完成的 (病例哈希, 方案哈希) 集合
+
+    相同 top_k 下记为 skipped 的组合也算完成：续跑时只剩未处理的病例参与排序，
+    若重新排序，之前落选的病例会顶替已完成的病例进入前 K 名。
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 崩溃时最后一行可能只写了一半
+                continue
+            if record.get('status') == 'ok' or (
+                    top_k and record.get('status') == 'skipped' and record.get('top_k') == top_k):
+                completed.add((record['case_sha256'], record['protocol_sha256']))
+    return completed
+
+
+def write_csv(output_path, csv_path):
+    """由 JSONL 结果生成 CSV，同一组合以最后一次记录为准"""
+    records = {}
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[(record['case_sha256'], record['protocol_sha256'])] = record
+    with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for record in records.values():
+            writer.writerow(record)
+
+
+class ResultWriter:
+    """线程安全地逐行追加 JSONL，并立即落盘以便崩溃后续跑"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def prepare_protocol(path, pages, executor, refresh=False):
+    """OCR 方案 PDF 并提取入排标准，返回 (成功, 入排标准或错误信息)"""
+    result = executor.submit(partial(extract_text_from_pdf, path, pages=pages)).result()
+    if not result['success']:
+        return False, result['message']
+    return extract_criteria_from_text(result['text'], refresh=refresh)
+
+
+def rule_outcome(outcome):
+    """把检验规则的初筛结果转换为结果记录；未能判定时返回 None"""
+    if not outcome['excluded']:
+        return None
+    return {'status': 'ok', 'decided_by': 'rules', 'analysis': outcome['analysis'],
+            'conclusion': extract_conclusion(outcome['analysis'])}
+
+
+def prescreen_by_rules(entries):
+    """对一批 (病例文本, 方案) 用检验规则初筛，同一方案的病例一起向量化求值"""
+    outcomes = [None] * len(entries)
+    by_protocol = {}
+    for index, (text, protocol) in enumerate(entries):
+        if protocol['compiled'] is not None:
+            by_protocol.setdefault(id(protocol), (protocol, []))[1].append(index)
+    for protocol, indices in by_protocol.values():
+        results = screen_cohort(protocol['compiled'], [entries[i][0] for i in indices])
+        for index, result in zip(indices, results):
+            outcomes[index] = rule_outcome(result)
+    return outcomes
+
+
+def screen_case(case_text, protocol, organize, refresh=False, lab_rules=True):
+    """对单个病例和单个方案执行（可选的）病例整理与入排分析"""
+    if organize:
+        success, organized = organize_patient_case(case_text, refresh=refresh)
+        if not success:
+            return {'status': 'error', 'error': f"病例整理失败：{organized}"}
+        case_text = organized
+        # 整理后的检验表格更规整，再用规则判定一次
+        if lab_rules and protocol['compiled'] is not None:
+            outcome = rule_outcome(screen_cohort(protocol['compiled'], [case_text])[0])
+            if outcome is not None:
+                return outcome
+    if protocol['compiled'] is not None:
+        analysis = analyze_patient_by_criteria(protocol['compiled'], case_text, refresh=refresh)
+    else:
+        analysis = analyze_patient_criteria(protocol['criteria'], case_text, refresh=refresh)
+    if not analysis or analysis.startswith("分析失败"):
+        return {'status': 'error', 'error': analysis or "无返回结果"}
+    return {'status': 'ok', 'decided_by': 'llm', 'analysis': analysis, 'conclusion': extract_conclusion(analysis)}
+
+
+def run_batch(args):
+    case_paths = sorted(
+        os.path.join(args.cases_dir, name)
+        for name in os.listdir(args.cases_dir)
+        if name.lower().endswith('.pdf')
+    )
+    if not case_paths:
+        print(f"目录中没有 PDF 文件：{args.cases_dir}")
+        return 1
+
+    completed = load_completed(args.output, args.top_k)
+    writer = ResultWriter(args.output)
+    protocol_pages = parse_pages(args.protocol_pages)
+    client = get_llm_client()
+    if not args.llm_cache:
+        client.cache = None
+
+    ocr_pool = ProcessPoolExecutor(max_workers=args.ocr_workers, initializer=init_ocr_worker)
+    llm_pool = ThreadPoolExecutor(max_workers=args.llm_concurrency)
+    try:
+        protocols = []
+        for path in args.protocol:
+            print(f"正在处理试验方案：{path}")
+            success, criteria = prepare_protocol(path, protocol_pages, ocr_pool, args.refresh_cache)
+            if not success:
+                print(f"试验方案处理失败：{criteria}")
+                return 1
+            protocols.append({'path': path, 'sha256': file_sha256(path), 'criteria': criteria})
+        for path in args.criteria_file:
+            with open(path, encoding='utf-8') as f:
+                criteria = f.read()
+            protocols.append({'path': path, 'sha256': file_sha256(path), 'criteria': criteria})
+        if not protocols:
+            print("请至少指定一个 --protocol 或 --criteria-file")
+            return 1
+
+        # 每个方案的入排标准只编译一次，所有病例按条目逐条评估
+        for protocol in protocols:
+            protocol['compiled'] = None
+            if args.per_criterion:
+                success, compiled = compile_protocol_criteria(protocol['criteria'])
+                if success and compiled['items']:
+                    protocol['compiled'] = compiled
+                    print(f"{protocol['path']}：编译得到 {len(compiled['items'])} 条入排条目")
+                else:
+                    print(f"{protocol['path']}：入排标准编译失败，改用整体分析")
+
+        # 找出仍需处理的病例，已全部完成的病例连 OCR 也跳过
+        pending = {}
+        for path in case_paths:
+            case_hash = file_sha256(path)
+            todo = [p for p in protocols if (case_hash, p['sha256']) not in completed]
+            if todo:
+                pending[path] = (case_hash, todo)
+        print(f"共 {len(case_paths)} 份病例，待处理 {len(pending)} 份")
+
+        ocr_futures = {
+            ocr_pool.submit(extract_text_from_pdf, path): path for path in pending
+        }
+        llm_futures = {}
+        rule_decided = 0
+        # 预排序时先收集全部待分析组合，OCR 结束后按方案排序再提交
+        index = CandidateIndex(args.index) if args.top_k else None
+        try:
+            deferred = []
+            remaining = set(ocr_futures)
+            while remaining:
+                # 每轮取出所有已完成的 OCR 结果，检验规则对这一批病例一起求值
+                finished, remaining = wait(remaining, return_when=FIRST_COMPLETED)
+                wave = []
+                indexed = []
+                for future in finished:
+                    path = ocr_futures[future]
+                    case_hash, todo = pending[path]
+                    result = future.result()
+                    for protocol in todo:
+                        base = {
+                            'case': path,
+                            'case_sha256': case_hash,
+                            'protocol': protocol['path'],
+                            'protocol_sha256': protocol['sha256'],
+                            'criteria_hash': protocol['compiled']['hash'] if protocol['compiled'] else None,
+                        }
+                        if not result['success']:
+                            writer.write({**base, 'status': 'error', 'error': result['message'],
+                                          'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')})
+                            continue
+                        wave.append((base, result['text'], protocol))
+                    if index is not None and result['success']:
+                        indexed.append((case_hash, path, result['text']))
+                # 每轮的病例整批写入索引的一个新段
+                if indexed:
+                    index.add_documents(indexed)
+
+                if args.lab_rules and not args.organize:
+                    outcomes = prescreen_by_rules([(text, protocol) for _, text, protocol in wave])
+                else:
+                    outcomes = [None] * len(wave)
+                for (base, text, protocol), outcome in zip(wave, outcomes):
+                    if outcome is not None:
+                        writer.write({**base, **outcome, 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')})
+                        rule_decided += 1
+                        print(f"[规则] {base['case']} × {base['protocol']}：{outcome['conclusion']}")
+                        continue
+                    if index is not None:
+                        deferred.append((base, text, protocol))
+                        continue
+                    llm_future = llm_pool.submit(screen_case, text, protocol, args.organize, args.refresh_cache,
+                                                 args.lab_rules)
+                    llm_futures[llm_future] = base
+
+            for protocol in protocols:
+                entries = [entry for entry in deferred if entry[2] is protocol]
+                if not entries:
+                    continue
+                ranked = index.rank_for_criteria(
+                    protocol['compiled'] or protocol['criteria'], top_k=args.top_k,
+                    keys={base['case_sha256'] for base, _, _ in entries},
+                )
+                ranks = {key: (rank, score) for rank, (key, _, score) in enumerate(ranked, 1)}
+                print(f"{protocol['path']}：{len(entries)} 份候选病例，按相关度取前 {len(ranked)} 份")
+                for base, text, protocol in entries:
+                    if base['case_sha256'] not in ranks:
+                        writer.write({**base, 'status': 'skipped', 'error': f"未进入相关度前 {args.top_k} 名",
+                                      'top_k': args.top_k, 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')})
+                        continue
+                    rank, score = ranks[base['case_sha256']]
+                    llm_future = llm_pool.submit(screen_case, text, protocol, args.organize, args.refresh_cache,
+                                                 args.lab_rules)
+                    llm_futures[llm_future] = {**base, 'rank': rank, 'score': round(score, 4)}
+        finally:
+            if index is not None:
+                index.close()
+        if rule_decided:
+            print(f"检验指标规则直接判定 {rule_decided} 个组合，其余 {len(llm_futures)} 个交给模型分析")
+
+        done = 0
+        for future in as_completed(llm_futures):
+            base = llm_futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                outcome = {'status': 'error', 'error': str(e)}
+            writer.write({**base, **outcome, 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')})
+            done += 1
+            print(f"[{done}/{len(llm_futures)}] {base['case']} × {base['protocol']}：{outcome['status']}")
+    finally:
+        llm_pool.shutdown(wait=True)
+        ocr_pool.shutdown(wait=True)
+        writer.close()
+
+    if client.cache is not None:
+        stats = client.cache.stats()
+        print(f"响应缓存：命中 {stats['hits']} 次，未命中 {stats['misses']} 次，命中率 {stats['hit_rate']:.0%}")
+    # OCR 在工作进程中计时，其阶段记录只写入 JSON 日志；这里汇总主进程中的阶段
+    for stage, summary in sorted(stage_summary().items()):
+        print(f"阶段 {stage}：{summary['count']} 次，平均 {summary['mean_s']:.2f} 秒，"
+              f"P95 {summary['p95_s']:.2f} 秒，累计 {summary['total_s']:.1f} 秒")
+    if args.csv:
+        write_csv(args.output, args.csv)
+        print(f"CSV 已写入：{args.csv}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量筛查病例 PDF 是否符合试验方案入排标准")
+    parser.add_argument('cases_dir', help="病例 PDF 所在目录")
+    parser.add_argument('--protocol', action='append', default=[], help="试验方案 PDF，可重复指定")
+    parser.add_argument('--protocol-pages', help="方案中入排标准所在页码，如 12-18,25")
+    parser.add_argument('--criteria-file', action='append', default=[],
+                        help="已整理好的入排标准文本文件，可重复指定，跳过方案 OCR 与提取")
+    parser.add_argument('--output', default='screening_results.jsonl', help="JSONL 结果文件（用于续跑）")
+    parser.add_argument('--csv', help="额外导出的 CSV 文件")
+    parser.add_argument('--ocr-workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="OCR 进程数")
+    parser.add_argument('--llm-concurrency', type=int, default=4, help="同时进行的 LLM 请求数")
+    parser.add_argument('--organize', action='store_true', help="分析前先调用模型整理病例")
+    parser.add_argument('--no-per-criterion', dest='per_criterion', action='store_false',
+                        help="不编译入排条目，改为把整段入排标准与病例一起分析")
+    parser.add_argument('--top-k', type=int, default=0,
+                        help="每个方案只分析按入选条目相关度排序的前 K 份病例，0 表示全部分析")
+    parser.add_argument('--index', default=os.path.join(CACHE_DIR, "candidate_index.sqlite3"),
+                        help="病例 BM25 索引文件，跨批次增量更新")
+    parser.add_argument('--no-lab-rules', dest='lab_rules', action='store_false', default=LAB_RULES_ENABLED,
+                        help="不使用检验指标规则初筛，所有组合都交给模型分析")
+    parser.add_argument('--no-llm-cache', dest='llm_cache', action='store_false',
+                        help="不读取也不写入模型响应缓存")
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help="忽略已缓存的模型响应，重新请求并覆盖缓存")
+    args = parser.parse_args(argv)
+    start_exporters()
+    return run_batch(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,399 @@
+"""性能基准：用合成 PDF 与本地桩服务器测量各阶段耗时，输出 JSON 以便不同版本之间对比
+
+用法示例：
+    python benchmark.py --output bench.json
+    python benchmark.py --only llm --llm-delay 0.2 --llm-error-rate 0.1 --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fitz
+
+CASE_PARAGRAPH = (
+    "患者，男，56岁，因“咳嗽、咳痰 2 月余”入院。胸部 CT 示右肺上叶占位，穿刺病理示腺癌，"
+    "EGFR 19 外显子缺失突变。既往高血压病史 5 年，规律服药，血压控制可。否认糖尿病、冠心病病史。"
+)
+LAB_TABLE = [
+    ("项目", "结果", "单位", "参考范围"),
+    ("ALT", "32", "U/L", "7-40"),
+    ("AST", "28", "U/L", "13-35"),
+    ("肌酐", "76", "μmol/L", "57-111"),
+    ("血小板", "210", "10^9/L", "125-350"),
+    ("血红蛋白", "132", "g/L", "130-175"),
+]
+CRITERIA = """Inclusion Criteria
+1. 年龄 ≥ 18 岁
+2. 组织学或细胞学确诊的非小细胞肺癌
+3. ECOG 评分 0-1 分
+Exclusion Criteria
+1. ALT > 3×ULN
+2. 血小板 < 100×10^9/L
+3. 既往接受过 EGFR-TKI 治疗"""
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    """延迟列表的统计摘要（秒）"""
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'mean_s': statistics.fmean(latencies),
+        'p50_s': percentile(latencies, 50),
+        'p95_s': percentile(latencies, 95),
+        'max_s': max(latencies),
+    }
+
+
+def make_digital_pdf(path, pages):
+    """生成带文字层的合成病例 PDF：每页若干段病历文本和一张检验表"""
+    doc = fitz.open()
+    for page_no in range(pages):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((50, 60), f"第 {page_no + 1} 页 住院病历", fontname="china-s", fontsize=16)
+        page.insert_textbox(fitz.Rect(50, 80, 545, 420), CASE_PARAGRAPH * 4, fontname="china-s", fontsize=11)
+        y = 440
+        for row in LAB_TABLE:
+            for col, cell in enumerate(row):
+                page.insert_text((60 + col * 120, y), cell, fontname="china-s", fontsize=11)
+            y += 22
+    doc.save(path)
+    doc.close()
+
+
+def make_scanned_pdf(path, source, dpi=150):
+    """把文字版 PDF 渲染成图片再装回 PDF，模拟没有文字层的扫描件"""
+    with fitz.open(source) as src:
+        doc = fitz.open()
+        for page in src:
+            pix = page.get_pixmap(dpi=dpi)
+            new_page = doc.new_page(width=page.rect.width, height=page.rect.height)
+            new_page.insert_image(new_page.rect, pixmap=pix)
+        doc.save(path)
+        doc.close()
+
+
+def _skipped(error):
+    return {'skipped': f"{type(error).__name__}: {error}"}
+
+
+def _pipeline_probe():
+    """在新进程中执行：测量导入、首次与再次创建转换器、注册表借出的耗时"""
+    start = time.perf_counter()
+    from ocr_utils import setup_ocr_pipeline, get_converter_registry
+    imported = time.perf_counter()
+    setup_ocr_pipeline()
+    first = time.perf_counter()
+    setup_ocr_pipeline()
+    second = time.perf_counter()
+    registry = get_converter_registry()
+    registry.prewarm(background=False)
+    warmed = time.perf_counter()
+    with registry.acquire():
+        pass
+    acquired = time.perf_counter()
+    print(json.dumps({
+        'import_s': imported - start,
+        'cold_setup_s': first - imported,
+        'warm_setup_s': second - first,
+        'registry_prewarm_s': warmed - second,
+        'registry_acquire_s': acquired - warmed,
+    }))
+
+
+def bench_startup(args, workdir):
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', INSTRUMENTATION_CONSOLE='0')
+    runs = []
+    for _ in range(args.repeat):
+        result = subprocess.run(
+            [sys.executable, 'main.py', '--startup-profile'],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        )
+        if result.returncode != 0:
+            return {'skipped': (result.stderr.strip().splitlines() or ["startup failed"])[-1]}
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    # 取窗口显示最快的一次的导入明细，减少磁盘缓存等冷启动噪声
+    best = min(runs, key=lambda run: run['window_shown_s'])
+    return {
+        'window_shown': summarize([run['window_shown_s'] for run in runs]),
+        'imports': best['imports'],
+        'heavy_modules_loaded': best['heavy_modules_loaded'],
+    }
+
+
+def bench_pipeline(args, workdir):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--pipeline-probe'],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        return {'skipped': (result.stderr.strip().splitlines() or ["probe failed"])[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench_triage(args, workdir):
+    from page_triage import triage_pages, extract_text_layer
+    results = {}
+    for kind in ('digital', 'scanned'):
+        path = workdir[kind]
+        pages = list(range(1, args.pages + 1))
+        start = time.perf_counter()
+        triage = triage_pages(path, pages, detect_scanned_tables=True)
+        triaged = time.perf_counter()
+        text_pages = [p for p, (method, _) in triage.items() if method == 'text_layer']
+        page_classes = {}
+        for _, stats in triage.values():
+            page_classes[stats['page_class']] = page_classes.get(stats['page_class'], 0) + 1
+        extract_text_layer(path, text_pages)
+        extracted = time.perf_counter()
+        results[kind] = {
+            'pages': len(pages),
+            'text_layer_pages': len(text_pages),
+            'page_classes': page_classes,
+            'triage_ms_per_page': (triaged - start) * 1000 / len(pages),
+            'extract_ms_per_page': (extracted - triaged) * 1000 / max(len(text_pages), 1),
+        }
+    return results
+
+
+def bench_ocr(args, workdir):
+    try:
+        from ocr_utils import extract_text_from_pdf, prewarm_converters, get_ocr_process_pool
+    except ImportError as e:
+        return _skipped(e)
+    # 转换器初始化计入 pipeline 阶段，这里先预热
+    prewarm_converters(background=False)
+    results = {}
+    # 强制 OCR 与 full_pipeline 对所有页面使用完整参数，作为按页选择参数的对照
+    for kind, text_layer, adaptive, name in (('digital', True, True, 'digital'),
+                                             ('digital', False, False, 'digital_force_ocr'),
+                                             ('scanned', True, True, 'scanned'),
+                                             ('scanned', True, False, 'scanned_full_pipeline')):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = extract_text_from_pdf(workdir[kind], use_cache=False, text_layer=text_layer, adaptive=adaptive,
+                                           executor=get_ocr_process_pool())
+            timings.append(time.perf_counter() - start)
+            if not result['success']:
+                results[name] = {'error': result['message']}
+                break
+        else:
+            best = min(timings)
+            results[name] = {
+                'pages': args.pages,
+                'seconds': best,
+                'pages_per_s': args.pages / best if best else None,
+                'text_chars': len(result['text']),
+            }
+    return results
+
+
+def bench_viewer(args, workdir):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PyQt5.QtWidgets import QApplication
+        from pdf_viewer import PdfViewerDialog, PAGE_ZOOM
+    except ImportError as e:
+        return _skipped(e)
+    app = QApplication.instance() or QApplication([])
+
+    def wait_visible(view, timeout=30.0):
+        """处理事件直到所有可见页面都有清晰版本"""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            app.processEvents()
+            rows = view._visible_rows()
+            if rows and all(view.page_model.cache.get((row, PAGE_ZOOM)) is not None for row in rows):
+                return True
+            time.sleep(0.001)
+        return False
+
+    results = {}
+    for kind in ('digital', 'scanned'):
+        start = time.perf_counter()
+        dialog = PdfViewerDialog(workdir[kind])
+        dialog.show()
+        app.processEvents()
+        opened = time.perf_counter()
+        wait_visible(dialog.page_view)
+        first_screen = time.perf_counter()
+        scrollbar = dialog.page_view.verticalScrollBar()
+        while scrollbar.value() < scrollbar.maximum():
+            scrollbar.setValue(min(scrollbar.maximum(), scrollbar.value() + dialog.page_view.viewport().height()))
+            dialog.page_view._on_scroll_settled()
+            wait_visible(dialog.page_view)
+        scrolled = time.perf_counter()
+        dialog.done(0)
+
+        with fitz.open(workdir[kind]) as doc:
+            render_start = time.perf_counter()
+            for page in doc:
+                page.get_pixmap(matrix=fitz.Matrix(PAGE_ZOOM, PAGE_ZOOM), alpha=False)
+            render_s = time.perf_counter() - render_start
+        results[kind] = {
+            'open_s': opened - start,
+            'first_screen_s': first_screen - opened,
+            'scroll_through_s': scrolled - first_screen,
+            'raw_render_pages_per_s': args.pages / render_s if render_s else None,
+        }
+    return results
+
+
+def bench_llm(args, workdir):
+    from stub_llm_server import StubLLMServer
+    from llm_client import LLMClient, set_llm_client
+    from api_utils import analyze_patient_criteria
+
+    short_case = CASE_PARAGRAPH * 3
+    long_case = "\n".join(f"<!-- 第 {i} 页 -->\n{CASE_PARAGRAPH * 8}" for i in range(1, 60))
+    scenarios = {
+        'short': dict(case=short_case, stream=False),
+        'short_stream': dict(case=short_case, stream=True),
+        'long_map_reduce': dict(case=long_case, stream=False),
+    }
+    results = {}
+    with StubLLMServer(delay=args.llm_delay, stream_interval=args.llm_stream_interval,
+                       error_rate=args.llm_error_rate, seed=0) as server:
+        # 不使用响应缓存，退避基数调小以免错误率场景下测量被重试等待主导
+        client = LLMClient(api_key="stub", api_url=server.url, cache=None, backoff_base=0.05, backoff_cap=0.5)
+        previous = set_llm_client(client)
+        try:
+            for name, scenario in scenarios.items():
+                latencies, first_chunk, failures = [], [], 0
+                before = server.stats()['requests']
+                for _ in range(args.repeat):
+                    marks = []
+                    on_delta = (lambda delta, content: marks.append(time.perf_counter())) if scenario['stream'] else None
+                    start = time.perf_counter()
+                    analysis = analyze_patient_criteria(CRITERIA, scenario['case'], on_delta=on_delta)
+                    latencies.append(time.perf_counter() - start)
+                    if marks:
+                        first_chunk.append(marks[0] - start)
+                    if analysis.startswith("分析失败"):
+                        failures += 1
+                results[name] = {
+                    **summarize(latencies),
+                    'failures': failures,
+                    'requests': server.stats()['requests'] - before,
+                }
+                if first_chunk:
+                    results[name]['first_chunk'] = summarize(first_chunk)
+        finally:
+            set_llm_client(previous)
+            client.close()
+        results['server'] = server.stats()
+    return results
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'pipeline': bench_pipeline,
+    'triage': bench_triage,
+    'ocr': bench_ocr,
+    'viewer': bench_viewer,
+    'llm': bench_llm,
+}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _flatten(data, prefix=""):
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current):
+    """逐项对比两次结果，打印数值变化（耗时类指标比值大于 1 表示变慢）"""
+    old, new = _flatten(baseline['results']), _flatten(current['results'])
+    print(f"对比基线 {baseline['meta'].get('revision')} -> {current['meta'].get('revision')}")
+    for name in sorted(set(old) & set(new)):
+        ratio = new[name] / old[name] if old[name] else float('nan')
+        print(f"  {name:55s} {old[name]:12.4f} -> {new[name]:12.4f}  ×{ratio:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="各阶段性能基准")
+    parser.add_argument('--only', help=f"只运行指定阶段，逗号分隔：{','.join(BENCHMARKS)}")
+    parser.add_argument('--pages', type=int, default=8, help="合成 PDF 的页数")
+    parser.add_argument('--repeat', type=int, default=3, help="每个场景重复次数")
+    parser.add_argument('--llm-delay', type=float, default=0.05, help="桩服务器首字节延迟（秒）")
+    parser.add_argument('--llm-stream-interval', type=float, default=0.005, help="桩服务器流式输出间隔（秒）")
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help="桩服务器错误率")
+    parser.add_argument('--output', help="结果 JSON 文件，缺省输出到标准输出")
+    parser.add_argument('--compare', help="与之前保存的结果 JSON 对比")
+    parser.add_argument('--pipeline-probe', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.pipeline_probe:
+        _pipeline_probe()
+        return 0
+
+    selected = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"未知的阶段：{','.join(unknown)}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = {'digital': os.path.join(tmp, 'digital.pdf'), 'scanned': os.path.join(tmp, 'scanned.pdf')}
+        make_digital_pdf(workdir['digital'], args.pages)
+        make_scanned_pdf(workdir['scanned'], workdir['digital'])
+        results = {}
+        for name in selected:
+            print(f"正在运行：{name}", file=sys.stderr)
+            try:
+                results[name] = BENCHMARKS[name](args, workdir)
+            except ImportError as e:
+                results[name] = _skipped(e)
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'pipeline_probe')},
+        },
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
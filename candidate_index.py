@@ -0,0 +1,325 @@
+"""病例候选预排序：对病例 Markdown 建立分段存储的 BM25 倒排索引，按入选条目取前 K 名"""
+import hashlib
+import itertools
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:
+    jieba = None
+
+from analysis_engine import split_criteria_items, CATEGORY_INCLUSION
+from instrumentation import log_event
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKENIZER_JIEBA = 'jieba'
+TOKENIZER_BIGRAM = 'bigram'
+
+_TOKEN_RE = re.compile(r'[A-Za-z][A-Za-z0-9\-]*|[一-鿿]+')
+
+# 入排标准中的套话，对区分病例没有帮助
+STOP_WORDS = {
+    '患者', '受试者', '研究', '试验', '签署', '知情', '同意', '知情同意', '同意书', '能够', '愿意', '自愿',
+    '年龄', '以上', '以下', '包括', '或者', '并且', '具有', '存在', '需要', '根据', '其他', '任何',
+    '的', '和', '或', '及', '与', '在', '有', '无', '为', '者', '且', '等',
+    'and', 'or', 'the', 'of', 'with', 'to', 'in', 'for', 'a', 'an', 'be', 'is', 'are',
+}
+
+
+def default_tokenizer():
+    return TOKENIZER_JIEBA if jieba is not None else TOKENIZER_BIGRAM
+
+
+def tokenize(text, tokenizer=None):
+    """中文分词：有 jieba 时用搜索引擎模式分词，否则用汉字二元组；英文按单词小写，忽略纯数字"""
+    tokenizer = tokenizer or default_tokenizer()
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        word = match.group(0)
+        if word[0].isascii():
+            word = word.lower()
+            if word not in STOP_WORDS:
+                tokens.append(word)
+        elif tokenizer == TOKENIZER_JIEBA:
+            tokens.extend(w for w in jieba.cut_for_search(word) if w not in STOP_WORDS)
+        elif len(word) == 1:
+            if word not in STOP_WORDS:
+                tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1) if word[i:i + 2] not in STOP_WORDS)
+    return tokens
+
+
+def _term_counts(tokens):
+    counts = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+
+def criteria_query(criteria):
+    """由入排标准构造查询文本：只取入选条目（排除条目中的关键词命中反而说明不合适）
+
+    criteria 可以是入排标准文本，也可以是 criteria_compiler 编译出的结果。
+    """
+    items = criteria['items'] if isinstance(criteria, dict) else split_criteria_items(criteria)
+    inclusion = [item['text'] for item in items if item['category'] == CATEGORY_INCLUSION]
+    return "\n".join(inclusion or [item['text'] for item in items])
+
+
+class CandidateIndex:
+    """持久化、可增量更新的病例 BM25 索引，文档以调用方给定的 key（如病例 PDF 的内容哈希）标识"""
+
+    def __init__(self, path, max_segments=16, tokenizer=None):
+        self.path = path
+        self.max_segments = max_segments
+        self._lock = threading.RLock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY,
+                key TEXT NOT NULL,
+                label TEXT,
+                content_hash TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                added_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_docs_key ON docs (key);
+            CREATE TABLE IF NOT EXISTS segments (segment_id INTEGER PRIMARY KEY, docs INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (
+                segment_id INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                doc_ids BLOB NOT NULL,
+                tfs BLOB NOT NULL,
+                PRIMARY KEY (term, segment_id)
+            );"""
+        )
+        self.tokenizer = tokenizer or default_tokenizer()
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'tokenizer'").fetchone()
+        if row is not None and row[0] != self.tokenizer:
+            # 查询必须与建索引时使用同一种分词方式（如 jieba 已卸载或新装），分词方式变化时清空重建
+            log_event("candidate_index.rebuild", f"索引 {path} 由 {row[0]} 分词建立，当前使用 {self.tokenizer}，清空重建",
+                      level="warning", previous=row[0], tokenizer=self.tokenizer)
+            self._conn.executescript("DELETE FROM postings; DELETE FROM segments; DELETE FROM docs;")
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (self.tokenizer,))
+        self._conn.commit()
+        self._term_cache = {}
+        self._load_docs()
+
+    def _load_docs(self):
+        rows = self._conn.execute("SELECT doc_id, key, label, content_hash, length, deleted FROM docs").fetchall()
+        size = max((row[0] for row in rows), default=0) + 1
+        self._lengths = np.zeros(size, dtype=np.float32)
+        self._alive = np.zeros(size, dtype=bool)
+        self._keys = {}
+        self._labels = {}
+        self._hashes = {}
+        for doc_id, key, label, content_hash, length, deleted in rows:
+            self._lengths[doc_id] = length
+            if not deleted:
+                self._register(doc_id, key, label, content_hash, length)
+        self._term_cache.clear()
+
+    def _register(self, doc_id, key, label, content_hash, length):
+        """在内存中登记一个存活文档，必要时扩容长度与存活数组"""
+        if doc_id >= len(self._lengths):
+            size = max(doc_id + 1, 2 * len(self._lengths))
+            self._lengths = np.concatenate([self._lengths, np.zeros(size - len(self._lengths), dtype=np.float32)])
+            self._alive = np.concatenate([self._alive, np.zeros(size - len(self._alive), dtype=bool)])
+        self._lengths[doc_id] = length
+        self._alive[doc_id] = True
+        self._keys[key] = doc_id
+        self._labels[doc_id] = (key, label)
+        self._hashes[key] = content_hash
+
+    def _unregister(self, key):
+        doc_id = self._keys.pop(key, None)
+        if doc_id is not None:
+            self._alive[doc_id] = False
+            self._labels.pop(doc_id, None)
+            self._hashes.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add_documents(self, documents):
+        """加入一批文档 [(key, label, text)]，整批写入一个新段；返回实际加入（新增或内容有变化）的数量"""
+        with self._lock:
+            fresh = []
+            for key, label, text in documents:
+                content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                if self._hashes.get(key) == content_hash:
+                    continue
+                fresh.append((key, label, content_hash, _term_counts(tokenize(text, self.tokenizer))))
+            if not fresh:
+                return 0
+
+            postings = {}
+            added = []
+            now = time.time()
+            for key, label, content_hash, counts in fresh:
+                self._conn.execute("UPDATE docs SET deleted = 1 WHERE key = ? AND deleted = 0", (key,))
+                length = sum(counts.values())
+                doc_id = self._conn.execute(
+                    "INSERT INTO docs (key, label, content_hash, length, added_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, label, content_hash, length, now),
+                ).lastrowid
+                added.append((doc_id, key, label, content_hash, length))
+                for term, tf in counts.items():
+                    postings.setdefault(term, ([], []))
+                    postings[term][0].append(doc_id)
+                    postings[term][1].append(tf)
+            self._write_segment(len(fresh), (
+                (term, np.asarray(ids, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+                for term, (ids, tfs) in postings.items()
+            ))
+            self._conn.commit()
+            # 只更新内存中的文档表，不重新扫描 docs 表（逐个加入病例时保持线性开销）
+            for doc_id, key, label, content_hash, length in added:
+                self._unregister(key)
+                self._register(doc_id, key, label, content_hash, length)
+            self._term_cache.clear()
+            if self._conn.execute("SELECT COUNT(*) FROM segments").fetchone()[0] > self.max_segments:
+                self.merge_segments()
+            return len(fresh)
+
+    def add_document(self, key, label, text):
+        return self.add_documents([(key, label, text)])
+
+    def remove(self, key):
+        with self._lock:
+            self._conn.execute("UPDATE docs SET deleted = 1 WHERE key = ?", (key,))
+            self._conn.commit()
+            self._unregister(key)
+            self._term_cache.clear()
+
+    def _write_segment(self, doc_count, term_arrays):
+        segment_id = self._conn.execute("INSERT INTO segments (docs) VALUES (?)", (doc_count,)).lastrowid
+        self._conn.executemany(
+            "INSERT INTO postings (segment_id, term, doc_ids, tfs) VALUES (?, ?, ?, ?)",
+            ((segment_id, term, ids.tobytes(), tfs.tobytes()) for term, ids, tfs in term_arrays),
+        )
+
+    def merge_segments(self, segment_ids=None):
+        """合并段并清除已删除文档的倒排；默认合并较小的一半段，传入全部段号即为完全压缩"""
+        with self._lock:
+            if segment_ids is None:
+                rows = self._conn.execute("SELECT segment_id FROM segments ORDER BY docs ASC").fetchall()
+                segment_ids = [row[0] for row in rows[:max(2, len(rows) // 2)]]
+            if not segment_ids:
+                return
+            placeholders = ",".join("?" * len(segment_ids))
+            rows = self._conn.execute(
+                f"SELECT term, doc_ids, tfs FROM postings WHERE segment_id IN ({placeholders}) ORDER BY term",
+                segment_ids,
+            )
+            alive = self._alive
+
+            def merged_terms():
+                for term, group in itertools.groupby(rows, key=lambda row: row[0]):
+                    group = list(group)
+                    ids = np.concatenate([np.frombuffer(row[1], dtype=np.int32) for row in group])
+                    tfs = np.concatenate([np.frombuffer(row[2], dtype=np.float32) for row in group])
+                    keep = alive[ids]
+                    if keep.any():
+                        yield term, ids[keep], tfs[keep]
+
+            # 先物化合并结果，再删除旧段，避免边读边写同一张表
+            merged = list(merged_terms())
+            doc_count = self._conn.execute(
+                f"SELECT COALESCE(SUM(docs), 0) FROM segments WHERE segment_id IN ({placeholders})", segment_ids
+            ).fetchone()[0]
+            self._conn.execute(f"DELETE FROM postings WHERE segment_id IN ({placeholders})", segment_ids)
+            self._conn.execute(f"DELETE FROM segments WHERE segment_id IN ({placeholders})", segment_ids)
+            self._write_segment(doc_count, merged)
+            self._conn.commit()
+            self._term_cache.clear()
+
+    def compact(self):
+        """合并所有段并删除已删除文档的记录"""
+        with self._lock:
+            segment_ids = [row[0] for row in self._conn.execute("SELECT segment_id FROM segments")]
+            if segment_ids:
+                self.merge_segments(segment_ids)
+            self._conn.execute("DELETE FROM docs WHERE deleted = 1")
+            self._conn.commit()
+            self._conn.execute("VACUUM")
+            self._load_docs()
+
+    def _postings(self, term):
+        """某个词在所有段中的倒排表（仅存活文档），带内存缓存"""
+        cached = self._term_cache.get(term)
+        if cached is not None:
+            return cached
+        rows = self._conn.execute("SELECT doc_ids, tfs FROM postings WHERE term = ?", (term,)).fetchall()
+        if rows:
+            ids = np.concatenate([np.frombuffer(row[0], dtype=np.int32) for row in rows])
+            tfs = np.concatenate([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+            keep = self._alive[ids]
+            cached = (ids[keep], tfs[keep])
+        else:
+            cached = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+        self._term_cache[term] = cached
+        return cached
+
+    def search(self, query, top_k=50, keys=None):
+        """按 BM25 得分返回前 top_k 个文档 [(key, label, score)]；keys 可限定只在这些文档中排序"""
+        with self._lock:
+            if not self._keys:
+                return []
+            alive_count = int(self._alive.sum())
+            average_length = float(self._lengths[self._alive].mean()) or 1.0
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths / average_length)
+            scores = np.zeros(len(self._lengths), dtype=np.float32)
+            for term, weight in _term_counts(tokenize(query, self.tokenizer)).items():
+                ids, tfs = self._postings(term)
+                if not len(ids):
+                    continue
+                idf = math.log(1 + (alive_count - len(ids) + 0.5) / (len(ids) + 0.5))
+                scores[ids] += weight * idf * tfs * (BM25_K1 + 1) / (tfs + norm[ids])
+
+            if keys is not None:
+                mask = np.zeros(len(scores), dtype=bool)
+                mask[[self._keys[key] for key in keys if key in self._keys]] = True
+            else:
+                mask = self._alive
+            candidates = np.flatnonzero(mask)
+            if top_k is not None and top_k < len(candidates):
+                top = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+                candidates = candidates[top]
+            order = candidates[np.argsort(-scores[candidates], kind='stable')]
+            return [(*self._labels[doc_id], float(scores[doc_id])) for doc_id in order]
+
+    def rank_for_criteria(self, criteria, top_k=50, keys=None):
+        """按入排标准（文本或编译结果）中的入选条目对病例排序"""
+        return self.search(criteria_query(criteria), top_k=top_k, keys=keys)
+
+    def stats(self):
+        with self._lock:
+            segments, = self._conn.execute("SELECT COUNT(*) FROM segments").fetchone()
+            terms, = self._conn.execute("SELECT COUNT(DISTINCT term) FROM postings").fetchone()
+        return {'documents': len(self._keys), 'segments': segments, 'terms': terms, 'tokenizer': self.tokenizer}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
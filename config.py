@@ -8,3 +8,91 @@ load_dotenv()
 API_KEY = os.getenv("API_KEY")
 API_URL = os.getenv("API_URL")
 
+
+# OCR 配置
+# 每组流水线参数最多常驻的 DocumentConverter 实例数
+OCR_CONVERTER_POOL_SIZE = int(os.getenv("OCR_CONVERTER_POOL_SIZE", "1"))
+
+# 本地缓存目录
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "patientfilter"))
+# OCR 结果磁盘缓存
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "1") == "1"
+OCR_CACHE_MAX_MB = int(os.getenv("OCR_CACHE_MAX_MB", "512"))
+
+# LLM 客户端配置（限流值为 0 表示不限流）
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "16"))
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+
+# 界面中 OCR 使用的进程数，0 表示在后台线程中复用已预热的转换器
+GUI_OCR_PROCESSES = int(os.getenv("GUI_OCR_PROCESSES", "0"))
+
+# PDF 页面像素图缓存上限（MB）
+PDF_PIXMAP_CACHE_MB = int(os.getenv("PDF_PIXMAP_CACHE_MB", "256"))
+
+# OCR 并行：进程数（<= 1 表示在当前进程内顺序转换）与每个转换单元的最大页数
+OCR_PROCESSES = int(os.getenv("OCR_PROCESSES", str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+OCR_CHUNK_PAGES = int(os.getenv("OCR_CHUNK_PAGES", "4"))
+# 逐页流式识别时同时转换的单元数上限（0 表示进程数的 2 倍），限制同时驻留内存的页面图像
+OCR_STREAM_WINDOW = int(os.getenv("OCR_STREAM_WINDOW", "0"))
+
+# 有可用文字层的页面直接提取文字、跳过 OCR
+OCR_TEXT_LAYER_FAST_PATH = os.getenv("OCR_TEXT_LAYER_FAST_PATH", "1") == "1"
+# 按页面类型选择 docling 流水线参数：只在扫描页上做 OCR、只在含表格的页面上识别表格结构（0 表示所有页面使用完整参数）
+OCR_ADAPTIVE_PIPELINE = os.getenv("OCR_ADAPTIVE_PIPELINE", "1") == "1"
+
+# 长病例分块分析：并发请求数、病例分块的 token 上限与条目批次的字符上限
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "4"))
+ANALYSIS_CHUNK_TOKENS = int(os.getenv("ANALYSIS_CHUNK_TOKENS", "8000"))
+ANALYSIS_CRITERIA_BATCH_CHARS = int(os.getenv("ANALYSIS_CRITERIA_BATCH_CHARS", "6000"))
+# 每批并发评估的条目数上限
+ANALYSIS_CRITERIA_BATCH_SIZE = int(os.getenv("ANALYSIS_CRITERIA_BATCH_SIZE", "5"))
+
+# LLM 响应磁盘缓存：有效期（小时，0 表示不过期）与容量上限（MB）
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "168"))
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "256"))
+
+# 检验指标阈值规则：明确触发排除的病例在本地判定，不再调用模型
+LAB_RULES_ENABLED = os.getenv("LAB_RULES_ENABLED", "1") == "1"
+
+# 埋点：JSON 行日志（留空关闭）、是否同时打印到控制台、Prometheus 指标文件与端口（0 表示不开启）
+INSTRUMENTATION_LOG = os.getenv("INSTRUMENTATION_LOG", os.path.join(CACHE_DIR, "logs", "events.jsonl"))
+INSTRUMENTATION_LOG_MAX_MB = int(os.getenv("INSTRUMENTATION_LOG_MAX_MB", "50"))
+INSTRUMENTATION_CONSOLE = os.getenv("INSTRUMENTATION_CONSOLE", "1") == "1"
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# 提示词预算：分词器（tokenizer.json 路径或 tiktoken:编码名，不可用时按字符估算）、
+# 各模型上下文窗口（模型:token 数，逗号分隔）、单次提示词上限（0 表示只受窗口限制）与安全余量
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", os.path.join(CACHE_DIR, "tokenizer.json"))
+LLM_CONTEXT_TOKENS = os.getenv("LLM_CONTEXT_TOKENS", "deepseek-chat:65536,deepseek-reasoner:65536")
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "24000"))
+PROMPT_SAFETY_TOKENS = int(os.getenv("PROMPT_SAFETY_TOKENS", "1024"))
+# 发送前压缩 OCR 输出中的页眉页脚与表格冗余标记
+PROMPT_COMPRESSION = os.getenv("PROMPT_COMPRESSION", "1") == "1"
+
+# 多用户筛查服务：监听地址与端口、OCR / 模型调用通道的工作线程数、每个用户最多同时排队的任务数、
+# 已结束任务的保留时间（秒）、上传 PDF 的大小上限（MB）与访问令牌（留空不校验）
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8765"))
+SERVICE_OCR_WORKERS = int(os.getenv("SERVICE_OCR_WORKERS", "2"))
+SERVICE_LLM_WORKERS = int(os.getenv("SERVICE_LLM_WORKERS", "4"))
+SERVICE_MAX_QUEUED_PER_USER = int(os.getenv("SERVICE_MAX_QUEUED_PER_USER", "20"))
+SERVICE_JOB_TTL = float(os.getenv("SERVICE_JOB_TTL", "3600"))
+SERVICE_MAX_UPLOAD_MB = int(os.getenv("SERVICE_MAX_UPLOAD_MB", "200"))
+SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", "")
+# 界面作为筛查服务的客户端：服务地址（如 http://10.0.0.5:8765，留空则在本机运行全部流程）、
+# 用户名（默认为系统登录名）与长轮询每次最多等待的秒数
+SCREENING_SERVICE_URL = os.getenv("SCREENING_SERVICE_URL", "")
+SCREENING_SERVICE_USER = os.getenv("SCREENING_SERVICE_USER", "")
+SCREENING_SERVICE_WAIT = float(os.getenv("SCREENING_SERVICE_WAIT", "0.5"))
+
+# 工作区：保存筛查会话（方案、入排标准、病例、整理结果与分析结果），重新打开时不必重新识别或调用模型；
+# 数据库路径、压缩后内容的总大小上限（MB）与会话数上限（0 表示不限），超出时删除最久未打开的会话
+WORKSPACE_ENABLED = os.getenv("WORKSPACE_ENABLED", "1") == "1"
+WORKSPACE_DB = os.getenv("WORKSPACE_DB", os.path.join(CACHE_DIR, "workspace.sqlite3"))
+WORKSPACE_MAX_MB = int(os.getenv("WORKSPACE_MAX_MB", "1024"))
+WORKSPACE_MAX_SESSIONS = int(os.getenv("WORKSPACE_MAX_SESSIONS", "500"))
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+from llm_client import get_llm_client, response_content
+from instrumentation import span, log_event
+from analysis_engine import (split_criteria_items, parse_json_response, map_reduce_analysis,
+                             CATEGORY_INCLUSION, CATEGORY_EXCLUSION)
+from config import CACHE_DIR
+
+# 编译结果的结构版本；结构或提示词变化时递增，旧缓存自动失效
+COMPILER_VERSION = 1
+
+OPERATORS = {'>', '>=', '<', '<=', '='}
+
+
+def criteria_hash(criteria_text):
+    """入排标准文本的哈希（忽略空白差异），作为编译结果的缓存键"""
+    normalized = re.sub(r'\s+', ' ', criteria_text).strip()
+    return hashlib.sha256(f"v{COMPILER_VERSION}:{normalized}".encode('utf-8')).hexdigest()
+
+
+def _cache_path(digest):
+    return os.path.join(CACHE_DIR, "criteria", f"{digest}.json")
+
+
+def _normalize_threshold(threshold):
+    """校验并规范化一条数值阈值，不合法时返回 None"""
+    operator = str(threshold.get('operator', '')).replace('≥', '>=').replace('≤', '<=').strip()
+    if operator not in OPERATORS:
+        return None
+    try:
+        value = float(threshold.get('value'))
+    except (TypeError, ValueError):
+        return None
+    analyte = str(threshold.get('analyte') or '').strip()
+    if not analyte:
+        return None
+    return {
+        'analyte': analyte,
+        'operator': operator,
+        'value': value,
+        'unit': str(threshold.get('unit') or '').strip(),
+    }
+
+
+def _normalize_items(raw_items):
+    items = []
+    counters = {CATEGORY_INCLUSION: 0, CATEGORY_EXCLUSION: 0}
+    for raw in raw_items:
+        text = str(raw.get('text') or '').strip()
+        if not text:
+            continue
+        category = CATEGORY_EXCLUSION if raw.get('category') == CATEGORY_EXCLUSION else CATEGORY_INCLUSION
+        counters[category] += 1
+        # 编号按类别重新生成，保证稳定且不重复
+        prefix = 'I' if category == CATEGORY_INCLUSION else 'E'
+        thresholds = [t for t in (_normalize_threshold(t) for t in raw.get('thresholds') or []) if t]
+        items.append({
+            'id': f"{prefix}{counters[category]}",
+            'category': category,
+            'text': text,
+            'thresholds': thresholds,
+        })
+    return items
+
+
+def _compile_with_llm(criteria_text):
+    response = get_llm_client().chat_completion(
+        model="deepseek-chat",
+        messages=[
+            {"role": "system", "content": "you are a helpful assistant"},
+            {"role": "user", "content": f"""请把以下试验方案的入排标准拆分为独立的条目，保持原文，不要加入任何新内容。
+对包含数值界限的条目（如 ALT > 3×ULN、eGFR < 30 mL/min/1.73m²、血小板 < 100×10^9/L），在 thresholds 中列出：
+analyte 为检验项目名称，operator 为 >、>=、<、<=、= 之一，value 为数值，unit 为单位（相对正常值上限时写 ULN，相对下限写 LLN）。
+请只输出 JSON，格式为：
+{{"items": [{{"category": "inclusion|exclusion", "text": "条目原文", "thresholds": [{{"analyte": "ALT", "operator": ">", "value": 3, "unit": "ULN"}}]}}]}}
+
+入排标准：
+{criteria_text}"""}
+        ],
+        temperature=0.0,
+        max_tokens=8000,
+        response_format={"type": "json_object"},
+    )
+    return _normalize_items(parse_json_response(response_content(response)).get('items', []))
+
+
+def _match_key(category, text):
+    # 比较条目时忽略空白与标点，模型“保持原文”拆出的条目与按编号拆分的文本通常只差这些
+    return category, re.sub(r'[\s，,。.；;：:]', '', text)
+
+
+def _compile_incrementally(criteria_text, previous):
+    """在上一版编译结果的基础上只编译改动过的条目；改动过多时返回 None，由调用方整体编译"""
+    segments = split_criteria_items(criteria_text)
+    known = {_match_key(item['category'], item['text']): item for item in previous['items']}
+    runs = []  # [(起始位置, [未匹配的条目])]
+    merged = []
+    changed = 0
+    for segment in segments:
+        item = known.get(_match_key(segment['category'], segment['text']))
+        if item is not None:
+            merged.append(item)
+            continue
+        changed += 1
+        if runs and runs[-1][0] + len(runs[-1][1]) == len(merged):
+            runs[-1][1].append(segment)
+        else:
+            runs.append((len(merged), [segment]))
+        merged.append(None)
+    if not segments or changed * 2 > len(segments):
+        return None
+
+    # 每段连续改动单独编译，结果放回原位置
+    for start, run in reversed(runs):
+        lines = []
+        category = None
+        for segment in run:
+            if segment['category'] != category:
+                category = segment['category']
+                lines.append("Inclusion Criteria:" if category == CATEGORY_INCLUSION else "Exclusion Criteria:")
+            lines.append(f"- {segment['text']}")
+        compiled_run = _compile_with_llm("\n".join(lines))
+        if not compiled_run:
+            return None
+        merged[start:start + len(run)] = compiled_run
+    log_event("analysis.compile_incremental", level="debug", items=len(segments), changed=changed)
+    return _normalize_items(merged)
+
+
+def compile_criteria(criteria_text, use_cache=True, previous=None):
+    """把入排标准编译为结构化条目列表
+
+    返回 {'version', 'hash', 'source', 'items': [{'id', 'category', 'text', 'thresholds'}]}，
+    按文本哈希缓存在磁盘上，同一方案只编译一次。模型编译失败时退回按编号拆分（不含阈值）。
+    传入上一版的编译结果 previous 时，只把改动过的条目交给模型编译，其余条目（含阈值）沿用。
+    """
+    digest = criteria_hash(criteria_text)
+    path = _cache_path(digest)
+    if use_cache and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    source = 'llm'
+    with span("analysis.compile_criteria", chars=len(criteria_text)) as compile_span:
+        try:
+            items = None
+            if previous and previous.get('source') in ('llm', 'incremental'):
+                items = _compile_incrementally(criteria_text, previous)
+                if items:
+                    source = 'incremental'
+            if not items:
+                items = _compile_with_llm(criteria_text)
+        except Exception as e:
+            log_event("analysis.compile_failed", f"入排标准编译失败，改为按编号拆分：{str(e)}", level="warning")
+            items = []
+        compile_span.set(items=len(items), source=source)
+    if not items:
+        source = 'split'
+        items = [dict(item, thresholds=[]) for item in split_criteria_items(criteria_text)]
+
+    compiled = {
+        'version': COMPILER_VERSION,
+        'hash': digest,
+        'source': source,
+        'compiled_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'items': items,
+    }
+    # 仅缓存模型编译成功的结果，拆分结果下次仍尝试用模型编译
+    if use_cache and source in ('llm', 'incremental'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(compiled, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    return compiled
+
+
+def evaluate_patient(compiled, patient_case, on_progress=None, cancel_event=None, refresh=False, memo=None):
+    """按编译好的条目逐条评估患者，返回三段式分析文本
+
+    条目分批并发评估；所有请求共用“条目列表 → 病例”的稳定前缀，方案复用时可命中服务端前缀缓存。
+    memo（VerdictMemo）记忆各条目在各病例分块上的判定，修改后再次分析时只评估改动部分。
+    """
+    return map_reduce_analysis(
+        "", patient_case, on_progress=on_progress, cancel_event=cancel_event, items=compiled['items'],
+        refresh=refresh, memo=memo
+    )
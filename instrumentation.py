@@ -0,0 +1,333 @@
+"""结构化埋点：阶段耗时（span）、事件日志、计数器 / 直方图 / 仪表与 Prometheus 导出"""
+import atexit
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from config import (INSTRUMENTATION_LOG, INSTRUMENTATION_LOG_MAX_MB, INSTRUMENTATION_CONSOLE,
+                    METRICS_FILE, METRICS_PORT)
+
+METRIC_PREFIX = "patientfilter_"
+
+# 耗时直方图的分桶上界（秒）
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+_counters = {}      # (名称, 标签) -> 值
+_gauges = {}        # (名称, 标签) -> 值
+_histograms = {}    # (名称, 标签) -> [各桶计数, 总和, 次数]
+_stage_samples = {}  # 阶段名 -> 最近的耗时样本
+_recent = deque(maxlen=500)
+_listeners = []
+
+
+def _rss_bytes():
+    """当前进程的常驻内存；不支持时返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 以字节为单位，Linux 以 KB 为单位
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, AttributeError):
+        return None
+
+
+class _JsonLog:
+    """追加写入的 JSON 行日志，超过上限时轮转为 .1"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError:
+                pass
+
+
+_log = _JsonLog(INSTRUMENTATION_LOG, INSTRUMENTATION_LOG_MAX_MB * 1024 * 1024) if INSTRUMENTATION_LOG else None
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """计数器加 value"""
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, _labels_key(labels))] = value
+
+
+def observe(name, value, **labels):
+    """向直方图记录一个观测值（秒）"""
+    key = (name, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(SECONDS_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(SECONDS_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def add_listener(callback):
+    """注册回调，每条 span / 事件记录生成后以 callback(记录) 调用（在产生记录的线程中）"""
+    _listeners.append(callback)
+
+
+def remove_listener(callback):
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+
+def _emit(record):
+    with _lock:
+        _recent.append(record)
+    if _log is not None:
+        _log.write(record)
+    for callback in list(_listeners):
+        try:
+            callback(record)
+        except Exception:
+            pass
+
+
+def log_event(name, message="", level="info", **fields):
+    """记录一条结构化事件；message 非空且开启控制台输出时同时打印"""
+    record = {'type': 'event', 'name': name, 'level': level, 'time': time.time(), 'pid': os.getpid()}
+    if message:
+        record['message'] = message
+    record.update(fields)
+    if level in ("warning", "error"):
+        increment("events_total", event=name, level=level)
+    if message and INSTRUMENTATION_CONSOLE:
+        print(message, file=sys.stderr if level in ("warning", "error") else sys.stdout)
+    _emit(record)
+
+
+class Span:
+    """一个计时区间；attrs 中的数值属性随日志输出，set() 可在区间内补充属性"""
+
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs = attrs
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+            increment("stage_errors_total", stage=self.name)
+        observe("stage_seconds", self.duration, stage=self.name)
+        rss = _rss_bytes()
+        if rss is not None:
+            set_gauge("process_resident_memory_bytes", rss)
+        with _lock:
+            samples = _stage_samples.setdefault(self.name, deque(maxlen=200))
+            samples.append(self.duration)
+        record = {
+            'type': 'span', 'name': self.name, 'span_id': self.span_id, 'parent_id': self.parent_id,
+            'start': self.start_time, 'duration_s': round(self.duration, 6), 'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+        }
+        if rss is not None:
+            record['rss_mb'] = round(rss / 1024 / 1024, 1)
+        if self.error:
+            record['error'] = self.error
+        record.update(self.attrs)
+        _emit(record)
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current_span():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def start_span(name, **attrs):
+    """开始一个不进入线程栈的区间（跨协程 / 生成器使用），需手动调用 finish()"""
+    return Span(name, parent=current_span(), **attrs)
+
+
+@contextmanager
+def span(name, **attrs):
+    """计时上下文：with span("ocr.convert", pages=4) as s: ...；异常会记录在 span 上并继续抛出"""
+    stack = _stack()
+    current = Span(name, parent=stack[-1] if stack else None, **attrs)
+    stack.append(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.finish(error=e)
+        raise
+    finally:
+        stack.pop()
+        current.finish()
+
+
+def stage_summary():
+    """各阶段耗时摘要 {阶段: {'count', 'last_s', 'mean_s', 'p95_s', 'total_s'}}"""
+    with _lock:
+        histograms = {dict(labels)['stage']: (h[1], h[2]) for (name, labels), h in _histograms.items()
+                      if name == "stage_seconds"}
+        samples = {stage: sorted(values) for stage, values in _stage_samples.items()}
+        last = {stage: values[-1] for stage, values in _stage_samples.items() if values}
+    summary = {}
+    for stage, (total, count) in histograms.items():
+        ordered = samples.get(stage) or [0.0]
+        summary[stage] = {
+            'count': count,
+            'last_s': last.get(stage, 0.0),
+            'mean_s': total / count if count else 0.0,
+            'p95_s': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+            'total_s': total,
+        }
+    return summary
+
+
+def recent_records(limit=100):
+    with _lock:
+        return list(_recent)[-limit:]
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_prometheus():
+    """以 Prometheus 文本格式导出全部指标"""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+    lines = []
+    for metric_type, metrics in (("counter", counters), ("gauge", gauges)):
+        for name in sorted({name for name, _ in metrics}):
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {metric_type}")
+            for (metric, labels), value in sorted(metrics.items()):
+                if metric == name:
+                    lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {value}")
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+        for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, bucket_count in zip(SECONDS_BUCKETS, buckets):
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=METRICS_FILE):
+    """把指标写入文件（供 node_exporter textfile collector 读取），先写临时文件再替换"""
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+_exporters_started = False
+
+
+def start_exporters(interval=15.0):
+    """按配置启动指标导出：定期写 METRICS_FILE，并在 METRICS_PORT 上提供 /metrics；重复调用无效"""
+    global _exporters_started
+    if _exporters_started:
+        return
+    _exporters_started = True
+    if METRICS_FILE:
+        def _write_periodically():
+            while True:
+                time.sleep(interval)
+                try:
+                    write_prometheus()
+                except OSError:
+                    pass
+
+        threading.Thread(target=_write_periodically, name="metrics-file", daemon=True).start()
+        atexit.register(write_prometheus)
+    if METRICS_PORT:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            server = ThreadingHTTPServer(('127.0.0.1', METRICS_PORT), Handler)
+        except OSError as e:
+            log_event("metrics.server_failed", f"指标端口 {METRICS_PORT} 启动失败：{str(e)}", level="warning")
+            return
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
@@ -0,0 +1,224 @@
+import itertools
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class JobCancelled(Exception):
+    """任务在执行过程中被取消"""
+
+
+class StreamBuffer:
+    """在任务之间传递逐步产生的结果：生产者 append / close，消费者用 wait_for 取出新增的部分"""
+
+    def __init__(self):
+        self.items = []
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def append(self, item):
+        with self._cond:
+            self.items.append(item)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return list(self.items)
+
+    def wait_for(self, start, cancel_event=None, poll=0.2):
+        """等待第 start 项之后出现新内容并返回新增的各项；已关闭且没有新内容时返回空列表"""
+        with self._cond:
+            while len(self.items) <= start and not self.closed:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise JobCancelled()
+                self._cond.wait(poll)
+            return self.items[start:]
+
+
+class JobSignals(QObject):
+    """任务信号；对象创建于主线程，工作线程发出的信号会排队交给主线程处理"""
+    started = pyqtSignal(str)
+    progress = pyqtSignal(str, str, int, int)  # 任务ID, 阶段, 已完成, 总数
+    partial = pyqtSignal(str, object)          # 任务ID, 阶段性结果（如流式文本）
+    finished = pyqtSignal(str, object)         # 任务ID, 结果
+    failed = pyqtSignal(str, str)              # 任务ID, 错误信息
+    cancelled = pyqtSignal(str)
+
+
+class Job(QRunnable):
+    """在线程池中执行的后台任务
+
+    fn(job) 在工作线程中运行，可通过 job.report_progress / job.emit_partial 汇报进度，
+    并通过 job.cancel_event 或 job.check_cancelled() 响应取消。
+    """
+
+    PARTIAL_INTERVAL = 0.1  # 流式结果的最小刷新间隔（秒）
+
+    def __init__(self, job_id, lane, description, fn, scheduler):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.job_id = job_id
+        self.lane = lane
+        self.description = description
+        self.fn = fn
+        self.scheduler = scheduler
+        self.signals = JobSignals()
+        self.cancel_event = threading.Event()
+        self.state = 'queued'
+        self._last_partial = 0.0
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def report_progress(self, stage, done, total):
+        self.signals.progress.emit(self.job_id, stage, done, total)
+
+    def emit_partial(self, payload, force=False):
+        """发出阶段性结果，默认按 PARTIAL_INTERVAL 节流"""
+        now = time.monotonic()
+        if force or now - self._last_partial >= self.PARTIAL_INTERVAL:
+            self._last_partial = now
+            self.signals.partial.emit(self.job_id, payload)
+
+    def run_in_process(self, fn, *args):
+        """在调度器的进程池中执行 fn(*args)；未配置进程池时直接在当前线程执行"""
+        executor = self.scheduler.process_executor()
+        if executor is None:
+            return fn(*args)
+        future = executor.submit(fn, *args)
+        while True:
+            done, _ = wait([future], timeout=0.2, return_when=FIRST_COMPLETED)
+            if done:
+                return future.result()
+            if self.cancel_event.is_set():
+                future.cancel()
+                raise JobCancelled()
+
+    def run(self):
+        try:
+            if self.cancel_event.is_set():
+                raise JobCancelled()
+            self.state = 'running'
+            self.signals.started.emit(self.job_id)
+            result = self.fn(self)
+            self.check_cancelled()
+            self.state = 'finished'
+            self.signals.finished.emit(self.job_id, result)
+        except JobCancelled:
+            self.state = 'cancelled'
+            self.signals.cancelled.emit(self.job_id)
+        except Exception as e:
+            self.state = 'failed'
+            self.signals.failed.emit(self.job_id, str(e))
+        finally:
+            self.scheduler._job_done(self)
+
+
+class JobScheduler(QObject):
+    """按“通道”排队的后台任务调度器
+
+    每个通道（如 'ocr'、'llm'）有独立的队列与并发上限，因此 OCR 下一份病例
+    可以与上一份病例的分析同时进行；同一通道内的任务按提交顺序执行。
+    OCR 等 CPU 密集型任务可通过 Job.run_in_process 交给进程池。
+    """
+    queue_changed = pyqtSignal()
+
+    def __init__(self, lane_limits=None, process_workers=0, process_initializer=None, parent=None):
+        super().__init__(parent)
+        self.lane_limits = lane_limits or {'ocr': 1, 'llm': 2}
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(sum(self.lane_limits.values()))
+        self.process_workers = process_workers
+        self.process_initializer = process_initializer
+        self._executor = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._queues = {lane: deque() for lane in self.lane_limits}
+        self._running = {lane: 0 for lane in self.lane_limits}
+        self.jobs = {}
+
+    def process_executor(self):
+        if self.process_workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                # 界面进程中有 Qt 与后台线程，工作进程用 spawn 启动而不是 fork
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.process_workers, initializer=self.process_initializer,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def submit(self, lane, description, fn, on_finished=None, on_failed=None, on_partial=None,
+               on_progress=None, on_cancelled=None):
+        """提交任务，回调均在主线程中执行；返回 Job"""
+        job = Job(f"job-{next(self._ids)}", lane, description, fn, self)
+        if on_finished:
+            job.signals.finished.connect(lambda job_id, result: on_finished(result))
+        if on_failed:
+            job.signals.failed.connect(lambda job_id, message: on_failed(message))
+        if on_partial:
+            job.signals.partial.connect(lambda job_id, payload: on_partial(payload))
+        if on_progress:
+            job.signals.progress.connect(lambda job_id, stage, done, total: on_progress(stage, done, total))
+        if on_cancelled:
+            job.signals.cancelled.connect(lambda job_id: on_cancelled())
+        for signal in (job.signals.started, job.signals.finished, job.signals.failed, job.signals.cancelled):
+            signal.connect(lambda *args: self.queue_changed.emit())
+        with self._lock:
+            self.jobs[job.job_id] = job
+            self._queues[lane].append(job)
+        self._dispatch()
+        self.queue_changed.emit()
+        return job
+
+    def _dispatch(self):
+        with self._lock:
+            for lane, queue in self._queues.items():
+                while queue and self._running[lane] < self.lane_limits[lane]:
+                    job = queue.popleft()
+                    self._running[lane] += 1
+                    self.pool.start(job)
+
+    def _job_done(self, job):
+        with self._lock:
+            self._running[job.lane] -= 1
+        self._dispatch()
+
+    def cancel(self, job_id):
+        """取消任务：排队中的任务直接移出队列，运行中的任务在下一个检查点停止"""
+        job = self.jobs.get(job_id)
+        if job is None or job.state in ('finished', 'failed', 'cancelled'):
+            return
+        job.cancel_event.set()
+        with self._lock:
+            queue = self._queues[job.lane]
+            dequeued = job in queue
+            if dequeued:
+                queue.remove(job)
+                job.state = 'cancelled'
+        if dequeued:
+            job.signals.cancelled.emit(job.job_id)
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+
+    def active_jobs(self):
+        return [job for job in self.jobs.values() if job.state in ('queued', 'running')]
+
+    def shutdown(self):
+        self.cancel_all()
+        self.pool.waitForDone()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
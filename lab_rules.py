@@ -0,0 +1,457 @@
+"""检验指标阈值规则：解析病例中的检验表格，按编译好的阈值在本地判定数值型入排条目"""
+import operator
+import re
+
+import numpy as np
+
+from analysis_engine import (CATEGORY_INCLUSION, CATEGORY_EXCLUSION, STATUS_MET, STATUS_NOT_MET,
+                             STATUS_UNKNOWN, render_verdicts)
+from instrumentation import span
+
+# 标准检验项目 -> 别名；拉丁字母别名区分大小写（避免把 EGFR 基因误认为 eGFR），
+# 中文别名不匹配“尿”字之后的内容（尿白细胞、尿蛋白不是血液指标）
+LAB_ALIASES = {
+    'ALT': ['ALT', 'GPT', 'SGPT', '丙氨酸氨基转移酶', '丙氨酸转氨酶', '谷丙转氨酶'],
+    'AST': ['AST', 'GOT', 'SGOT', '天门冬氨酸氨基转移酶', '天冬氨酸氨基转移酶', '谷草转氨酶'],
+    'TBIL': ['TBIL', 'TBil', 'T-BIL', '总胆红素', 'Total bilirubin'],
+    'DBIL': ['DBIL', 'DBil', 'D-BIL', '直接胆红素'],
+    'ALP': ['ALP', '碱性磷酸酶'],
+    'ALB': ['ALB', 'Alb', '白蛋白'],
+    'CREA': ['CREA', 'Cr', 'Scr', 'SCr', '血肌酐', '肌酐', 'Creatinine'],
+    'CRCL': ['CrCl', 'Ccr', 'CCr', '肌酐清除率'],
+    'EGFR': ['eGFR', '估算肾小球滤过率', '肾小球滤过率'],
+    'BUN': ['BUN', '尿素氮', '尿素'],
+    'WBC': ['WBC', '白细胞计数', '白细胞'],
+    'ANC': ['ANC', 'NEUT#', '中性粒细胞绝对值', '中性粒细胞计数'],
+    'PLT': ['PLT', '血小板计数', '血小板'],
+    'HGB': ['HGB', 'Hb', 'HB', '血红蛋白'],
+    'INR': ['INR', 'PT-INR', '国际标准化比值'],
+    'PT': ['PT', '凝血酶原时间'],
+    'APTT': ['APTT', '活化部分凝血活酶时间'],
+}
+
+# 同样用于尿液、粪便、体液检查的名称：不在明确的血液检查段落中时无法确定标本，交给模型判断
+SHARED_ALIASES = {'白细胞', 'WBC', '白蛋白', 'ALB', 'Alb', '肌酐', 'Cr', 'CREA', 'Creatinine'}
+
+# 段落标题：非血液标本的检查不参与阈值判定；同时出现两类关键词时视为不确定
+_NON_BLOOD_SECTION = re.compile(
+    r'尿常规|尿液|尿检|尿沉渣|尿分析|24\s*h?小?时?尿|粪|大便|便常规|脑脊液|胸水|腹水|积液|痰|引流液|关节液|'
+    r'urinalysis|urine|stool|feces|csf', re.IGNORECASE)
+_BLOOD_SECTION = re.compile(r'血常规|血液|全血|血生化|生化|肝功|肾功|凝血|血清|血浆|blood|serum|plasma|cbc',
+                            re.IGNORECASE)
+SECTION_BLOOD = 'blood'
+SECTION_OTHER = 'other'
+# 检查日期，用于同一项目多次检查时取最近一次
+_DATE = re.compile(r'((?:19|20)\d{2})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})')
+
+# 各项目可换算的单位及换算到标准单位（第一个）的系数
+UNIT_FACTORS = {
+    'ALT': {'u/l': 1.0},
+    'AST': {'u/l': 1.0},
+    'ALP': {'u/l': 1.0},
+    'TBIL': {'μmol/l': 1.0, 'mg/dl': 17.1},
+    'DBIL': {'μmol/l': 1.0, 'mg/dl': 17.1},
+    'ALB': {'g/l': 1.0, 'g/dl': 10.0},
+    'CREA': {'μmol/l': 1.0, 'mg/dl': 88.4},
+    'CRCL': {'ml/min': 1.0},
+    'EGFR': {'ml/min/1.73m2': 1.0, 'ml/min': 1.0},
+    'BUN': {'mmol/l': 1.0, 'mg/dl': 0.357},
+    'WBC': {'10^9/l': 1.0, '10^3/μl': 1.0, '/μl': 0.001},
+    'ANC': {'10^9/l': 1.0, '10^3/μl': 1.0, '/μl': 0.001},
+    'PLT': {'10^9/l': 1.0, '10^3/μl': 1.0, '/μl': 0.001},
+    'HGB': {'g/l': 1.0, 'g/dl': 10.0},
+    'INR': {'': 1.0},
+    'PT': {'s': 1.0},
+    'APTT': {'s': 1.0},
+}
+
+RELATIVE_UNITS = {'uln', 'lln'}
+
+OPERATOR_FUNCS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '=': operator.eq,
+}
+
+# 条目中出现这些措辞时说明阈值带有附加条件，交给模型判断
+_QUALIFIERS = re.compile(r'(除非|除外|以外|若|如果|转移者|unless|except)', re.IGNORECASE)
+
+_NUMBER = r'\d+(?:\.\d+)?'
+_RANGE = re.compile(rf'^\s*(?:({_NUMBER})\s*(?:-{{1,2}}|~|～|—|–|至)\s*({_NUMBER})|([<≤＜])\s*=?\s*({_NUMBER})|([>≥＞])\s*=?\s*({_NUMBER}))\s*$')
+_VALUE = re.compile(rf'^\s*[<>≤≥＜＞]?\s*({_NUMBER})\s*[↑↓]?\s*(?:\(?[HL]\)?\s*)?(.*?)\s*[↑↓]?\s*$')
+_UNIT = re.compile(r'^[A-Za-zμµ%/^\d.×x*·²³⁹¹⁰]+(?:/[A-Za-z\d.²]+)*$|^秒$')
+_INLINE_VALUE = re.compile(
+    rf'\s*(?:[（(][^）)]{{0,20}}[）)])?\s*[:：=]?\s*(?:为|是)?\s*[<>≤≥＜＞]?\s*({_NUMBER})\s*[↑↓]?'
+    r'\s*([A-Za-zμµ%/^\d.×*·²³⁹¹⁰]*(?:/[A-Za-z\d.²]+)*|秒)?'
+)
+_INLINE_RANGE = re.compile(
+    rf'(?:参考|正常|范围|ref)[^\d<>≤≥]{{0,10}}([<>≤≥]?\s*{_NUMBER}(?:\s*(?:-{{1,2}}|~|～|—|至)\s*{_NUMBER})?)'
+    rf'|[（(]\s*([<>≤≥]?\s*{_NUMBER}(?:\s*(?:-{{1,2}}|~|～|—|至)\s*{_NUMBER})?)\s*[）)]',
+    re.IGNORECASE,
+)
+
+
+def _alias_pattern():
+    aliases = sorted(((alias, key) for key, names in LAB_ALIASES.items() for alias in names),
+                     key=lambda pair: -len(pair[0]))
+    parts = []
+    for alias, _ in aliases:
+        escaped = re.escape(alias)
+        if re.search(r'[A-Za-z]', alias):
+            escaped = rf'(?<![A-Za-z]){escaped}(?![A-Za-z])'
+        else:
+            escaped = rf'(?<!尿){escaped}'
+        parts.append(escaped)
+    lookup = {alias: key for alias, key in aliases}
+    return re.compile('|'.join(parts)), lookup
+
+
+_ALIAS_RE, _ALIAS_LOOKUP = _alias_pattern()
+
+
+def _section_of(text):
+    """按标题文字判断检查段落的标本类型，无法判断时返回 None"""
+    other = _NON_BLOOD_SECTION.search(text)
+    blood = _BLOOD_SECTION.search(text)
+    if other and not blood:
+        return SECTION_OTHER
+    if blood and not other:
+        return SECTION_BLOOD
+    return None
+
+
+def _heading_text(line):
+    """标题行（Markdown 标题、加粗行、短行或“标题：”前缀）的标题文字；不是标题时返回 None"""
+    stripped = line.strip()
+    if stripped.startswith('#'):
+        return stripped.lstrip('#').strip()
+    stripped = stripped.strip('*_ ')
+    prefix = re.split(r'[:：]', stripped, maxsplit=1)[0]
+    if len(prefix) <= 20 and prefix != stripped:
+        return prefix
+    if len(stripped) <= 20 and not _DATE.fullmatch(stripped):
+        return stripped
+    return None
+
+
+def _find_date(text):
+    match = _DATE.search(text)
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def canonical_analyte(name):
+    """把检验项目名称归一为标准项目（如“谷丙转氨酶”-> ALT），无法识别或含多个项目时返回 None"""
+    found = {_ALIAS_LOOKUP[m.group(0)] for m in _ALIAS_RE.finditer(name or "")}
+    return found.pop() if len(found) == 1 else None
+
+
+def normalize_unit(unit):
+    """统一单位写法：小写、去空白、×10^9/L -> 10^9/l、µmol -> μmol 等"""
+    unit = (unit or "").strip().lower().replace(' ', '')
+    unit = unit.replace('µ', 'μ').replace('²', '2').replace('⁹', '^9').replace('¹²', '^12')
+    unit = re.sub(r'^[×x*·]', '', unit)
+    unit = re.sub(r'10(?:e|\*\*)', '10^', unit)
+    unit = re.sub(r'(?<![a-z])u(?=mol|l$)', 'μ', unit)
+    unit = unit.replace('iu/l', 'u/l').replace('秒', 's').replace('sec', 's')
+    return unit
+
+
+def parse_range(text):
+    """解析参考范围，返回 (下限, 上限)，缺失的一侧为 None"""
+    match = _RANGE.match((text or "").replace(' ', ''))
+    if not match:
+        return None
+    low, high, lt, lt_value, gt, gt_value = match.groups()
+    if low is not None:
+        return float(low), float(high)
+    if lt is not None:
+        return None, float(lt_value)
+    return float(gt_value), None
+
+
+def _table_columns(cells):
+    """识别表头中的 结果 / 单位 / 参考范围 列"""
+    columns = {}
+    for index, cell in enumerate(cells):
+        if re.search(r'结果|数值|result|value', cell, re.IGNORECASE):
+            columns.setdefault('value', index)
+        elif re.search(r'单位|unit', cell, re.IGNORECASE):
+            columns.setdefault('unit', index)
+        elif re.search(r'参考|范围|正常值|range|reference', cell, re.IGNORECASE):
+            columns.setdefault('range', index)
+    return columns if 'value' in columns else None
+
+
+def _parse_row(cells, columns):
+    analyte_index = None
+    for index, cell in enumerate(cells):
+        if canonical_analyte(cell):
+            analyte_index = index
+            break
+    if analyte_index is None:
+        return None
+    aliases = {m.group(0) for m in _ALIAS_RE.finditer(cells[analyte_index])}
+    record = {'analyte': canonical_analyte(cells[analyte_index]), 'value': None, 'unit': '',
+              'ref_low': None, 'ref_high': None, 'source': " | ".join(cells), 'shared': aliases <= SHARED_ALIASES}
+
+    if columns:
+        value_cell = cells[columns['value']] if columns['value'] < len(cells) else ""
+        match = _VALUE.match(value_cell)
+        if match:
+            record['value'] = float(match.group(1))
+            record['unit'] = match.group(2) if _UNIT.match(match.group(2) or "-") else ""
+        if 'unit' in columns and columns['unit'] < len(cells) and cells[columns['unit']]:
+            record['unit'] = cells[columns['unit']]
+        if 'range' in columns and columns['range'] < len(cells):
+            bounds = parse_range(cells[columns['range']])
+            if bounds:
+                record['ref_low'], record['ref_high'] = bounds
+    else:
+        # 没有表头时按内容猜测：范围形如 a-b / <b，数值之后的单位形如 U/L
+        for cell in cells[analyte_index + 1:]:
+            bounds = parse_range(cell)
+            if bounds and record['value'] is not None:
+                if record['ref_low'] is None and record['ref_high'] is None:
+                    record['ref_low'], record['ref_high'] = bounds
+                continue
+            match = _VALUE.match(cell)
+            if record['value'] is None and match:
+                record['value'] = float(match.group(1))
+                if match.group(2) and _UNIT.match(match.group(2)):
+                    record['unit'] = match.group(2)
+            elif record['value'] is not None and not record['unit'] and _UNIT.match(cell):
+                record['unit'] = cell
+    return record if record['value'] is not None else None
+
+
+def _parse_inline(line):
+    records = []
+    position = 0
+    for match in _ALIAS_RE.finditer(line):
+        if match.start() < position:
+            continue
+        value = _INLINE_VALUE.match(line, match.end())
+        if not value:
+            continue
+        position = value.end()
+        record = {'analyte': _ALIAS_LOOKUP[match.group(0)], 'value': float(value.group(1)),
+                  'unit': value.group(2) or "", 'ref_low': None, 'ref_high': None,
+                  'source': line.strip().lstrip('-*• '), 'shared': match.group(0) in SHARED_ALIASES}
+        # 参考范围需出现在下一个检验项目之前
+        following = line[position:]
+        next_alias = _ALIAS_RE.search(following)
+        reference = _INLINE_RANGE.search(following[:next_alias.start()] if next_alias else following)
+        if reference:
+            bounds = parse_range(reference.group(1) or reference.group(2))
+            if bounds:
+                record['ref_low'], record['ref_high'] = bounds
+        records.append(record)
+    return records
+
+
+def parse_lab_values(case_text):
+    """从病例文本（Markdown 表格或“项目：数值 单位（参考范围）”行）中解析血液检验结果
+
+    返回 {标准项目: {'value', 'unit', 'ref_low', 'ref_high', 'source'}}。尿液、粪便等非血液段落中的结果不计入；
+    同一项目多次检查时取日期最近的一次，无法确定取哪次（同一日期或都无日期而数值不同）、
+    或只以通用名称出现在标本不明的段落中时不返回该项目，交给模型判断。
+    """
+    candidates = {}
+    columns = None
+    section = None
+    date = None
+    for position, line in enumerate(case_text.splitlines()):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped.startswith('|') and stripped.count('|') >= 2:
+            cells = [cell.strip() for cell in stripped.strip('|').split('|')]
+            if all(re.fullmatch(r':?-{2,}:?', cell) or not cell for cell in cells):
+                continue
+            row_date = _find_date(stripped)
+            if not any(canonical_analyte(cell) for cell in cells):
+                # 表头或分组行：可能带有标本类型
+                section = _section_of(stripped) or section
+                header = _table_columns(cells)
+                if header:
+                    columns = header
+                date = row_date or date
+                continue
+            records = [_parse_row(cells, columns)]
+        else:
+            columns = None
+            heading = _heading_text(stripped)
+            if heading is not None:
+                heading_section = _section_of(heading)
+                # Markdown 标题与加粗标题开始新的段落，其余短行只在能判断标本类型时切换段落
+                if heading_section is not None or stripped.startswith(('#', '**')):
+                    section = heading_section
+            row_date = _find_date(stripped)
+            date = row_date or date
+            records = _parse_inline(line)
+        if section == SECTION_OTHER:
+            continue
+        for record in records:
+            if record is None:
+                continue
+            shared = record.pop('shared')
+            if shared and section != SECTION_BLOOD:
+                record['ambiguous'] = True
+            candidates.setdefault(record.pop('analyte'), []).append((row_date or date, position, record))
+
+    labs = {}
+    for analyte, found in candidates.items():
+        if any(record.get('ambiguous') for _, _, record in found):
+            continue
+        dated = [entry for entry in found if entry[0] is not None]
+        found = dated or found
+        latest = max(entry[0] or () for entry in found)
+        same_day = [record for day, _, record in found if (day or ()) == latest]
+        if len({(record['value'], normalize_unit(record['unit'])) for record in same_day}) > 1:
+            continue
+        labs[analyte] = max((entry for entry in found if (entry[0] or ()) == latest), key=lambda entry: entry[1])[2]
+    return labs
+
+
+class LabCohort:
+    """一批患者的检验结果矩阵：行是患者，列是检验项目，缺失值为 NaN"""
+
+    def __init__(self, lab_records):
+        self.size = len(lab_records)
+        self.records = lab_records
+        self.analytes = sorted({analyte for labs in lab_records for analyte in labs})
+        self._index = {analyte: i for i, analyte in enumerate(self.analytes)}
+        shape = (self.size, len(self.analytes))
+        self.values = np.full(shape, np.nan)
+        self.ref_low = np.full(shape, np.nan)
+        self.ref_high = np.full(shape, np.nan)
+        self.units = np.full(shape, '', dtype=object)
+        for row, labs in enumerate(lab_records):
+            for analyte, lab in labs.items():
+                col = self._index[analyte]
+                self.values[row, col] = lab['value']
+                self.units[row, col] = normalize_unit(lab['unit'])
+                if lab['ref_low'] is not None:
+                    self.ref_low[row, col] = lab['ref_low']
+                if lab['ref_high'] is not None:
+                    self.ref_high[row, col] = lab['ref_high']
+
+    @classmethod
+    def from_texts(cls, case_texts):
+        return cls([parse_lab_values(text) for text in case_texts])
+
+    def column(self, analyte):
+        return self._index.get(analyte)
+
+    def _unit_factors(self, analyte, col, target_unit):
+        """每位患者的数值换算到 target_unit 的系数，无法换算为 NaN"""
+        factors = np.full(self.size, np.nan)
+        table = UNIT_FACTORS.get(analyte, {})
+        target = table.get(target_unit)
+        for unit in set(self.units[:, col]):
+            mask = self.units[:, col] == unit
+            if unit == target_unit:
+                factors[mask] = 1.0
+            elif target is not None and unit in table:
+                factors[mask] = table[unit] / target
+        return factors
+
+    def evaluate(self, analyte, threshold):
+        """对整批患者求一条阈值，返回 (判定数组, 比较用数值数组)；判定为 STATUS_* 字符串"""
+        status = np.full(self.size, STATUS_UNKNOWN, dtype=object)
+        col = self.column(analyte)
+        if col is None:
+            return status, np.full(self.size, np.nan)
+        unit = normalize_unit(threshold['unit'])
+        if unit == 'uln':
+            lhs = self.values[:, col] / self.ref_high[:, col]
+        elif unit == 'lln':
+            lhs = self.values[:, col] / self.ref_low[:, col]
+        else:
+            if not unit and UNIT_FACTORS.get(analyte):
+                # 阈值未写单位时按该项目的标准单位理解
+                unit = next(iter(UNIT_FACTORS[analyte]))
+            lhs = self.values[:, col] * self._unit_factors(analyte, col, unit)
+        known = ~np.isnan(lhs)
+        hit = OPERATOR_FUNCS[threshold['operator']](np.where(known, lhs, 0.0), threshold['value'])
+        status[known & hit] = STATUS_MET
+        status[known & ~hit] = STATUS_NOT_MET
+        return status, lhs
+
+
+def rule_items(compiled):
+    """可在本地判定的条目：恰好一条阈值、检验项目可识别、单位可比较且没有附加条件"""
+    eligible = []
+    for item in compiled.get('items', []):
+        thresholds = item.get('thresholds') or []
+        if len(thresholds) != 1 or _QUALIFIERS.search(item['text']):
+            continue
+        threshold = thresholds[0]
+        analyte = canonical_analyte(threshold['analyte'])
+        if analyte is None or threshold['operator'] not in OPERATOR_FUNCS:
+            continue
+        unit = normalize_unit(threshold['unit'])
+        if unit and unit not in RELATIVE_UNITS and unit not in UNIT_FACTORS.get(analyte, {}):
+            continue
+        eligible.append((item, analyte, threshold))
+    return eligible
+
+
+def _quantity(value, unit, digits=6):
+    unit = unit or ""
+    return f"{value:.{digits}g}{'' if unit.startswith(('×', 'x', '*')) else ' '}{unit}".strip()
+
+
+def _describe(lab, threshold, compared):
+    """生成一条规则判定的解释，如“150 U/L = 3.75×ULN，阈值 > 3×ULN”"""
+    unit = threshold['unit'] or ""
+    if normalize_unit(unit) in RELATIVE_UNITS:
+        return f"{_quantity(lab['value'], lab['unit'])} = {compared:.2f}×{unit}，阈值 {threshold['operator']} {threshold['value']:g}×{unit}"
+    shown = _quantity(lab['value'], lab['unit'])
+    if normalize_unit(lab['unit']) != normalize_unit(unit):
+        shown += f" = {_quantity(compared, unit, 4)}"
+    return f"{shown}，阈值 {threshold['operator']} {_quantity(threshold['value'], unit)}"
+
+
+def screen_cohort(compiled, case_texts):
+    """用检验指标规则对一批病例做初筛
+
+    返回与 case_texts 等长的列表，每项为 {'excluded', 'verdicts', 'analysis'}：
+    excluded 为 True 表示已由规则明确判定不符合，analysis 为与模型分析相同格式的结果文本；
+    否则 analysis 为 None，需继续交给模型分析。
+    """
+    rules = rule_items(compiled)
+    outcomes = [{'excluded': False, 'verdicts': {}, 'analysis': None} for _ in case_texts]
+    if not rules or not case_texts:
+        return outcomes
+    with span("rules.screen_cohort", cases=len(case_texts), rules=len(rules)):
+        cohort = LabCohort.from_texts(case_texts)
+        for item, analyte, threshold in rules:
+            status, compared = cohort.evaluate(analyte, threshold)
+            for row in np.flatnonzero(status != STATUS_UNKNOWN):
+                lab = cohort.records[row][analyte]
+                outcomes[row]['verdicts'][item['id']] = {
+                    'status': status[row], 'evidence': [lab['source']],
+                    'reasons': [_describe(lab, threshold, compared[row])],
+                }
+
+    items_by_id = {item['id']: item for item in compiled['items']}
+    for outcome in outcomes:
+        verdicts = outcome['verdicts']
+        decisive = [
+            item_id for item_id, verdict in verdicts.items()
+            if (items_by_id[item_id]['category'] == CATEGORY_EXCLUSION and verdict['status'] == STATUS_MET)
+            or (items_by_id[item_id]['category'] == CATEGORY_INCLUSION and verdict['status'] == STATUS_NOT_MET)
+        ]
+        if not decisive:
+            continue
+        outcome['excluded'] = True
+        decided = [item for item in compiled['items'] if item['id'] in verdicts]
+        remaining = len(compiled['items']) - len(decided)
+        outcome['analysis'] = render_verdicts(
+            decided, verdicts,
+            note=f"以上由本地检验指标规则判定，其余 {remaining} 条条目未送模型评估。" if remaining else "",
+        )
+    return outcomes
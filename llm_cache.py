@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 不影响模型输出、不参与缓存键的请求参数
+_IGNORED_PARAMS = {'stream', 'stream_options', 'user'}
+
+
+def normalize_payload(payload):
+    """规范化请求：统一消息文本首尾空白与数值类型，去掉不影响输出的参数"""
+    normalized = {k: v for k, v in payload.items() if k not in _IGNORED_PARAMS}
+    normalized['messages'] = [
+        {'role': message.get('role'), 'content': (message.get('content') or '').strip()}
+        for message in payload.get('messages', [])
+    ]
+    if normalized.get('temperature') is not None:
+        normalized['temperature'] = round(float(normalized['temperature']), 4)
+    if normalized.get('max_tokens') is not None:
+        normalized['max_tokens'] = int(normalized['max_tokens'])
+    return normalized
+
+
+def cache_key(payload):
+    """请求的确定性缓存键：模型、完整消息列表、temperature、max_tokens 等参数的哈希"""
+    text = json.dumps(normalize_payload(payload), sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """SQLite 持久化的模型响应缓存
+
+    条目超过 ttl_seconds 视为过期；总大小超过 max_bytes 时按最近访问时间淘汰（LRU）。
+    界面与批量筛查共用同一个数据库文件。
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                hit_count INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access)")
+        self._conn.commit()
+
+    def get(self, payload):
+        """查找缓存的响应 JSON，未命中或已过期时返回 None"""
+        key = cache_key(payload)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ?, hit_count = hit_count + 1 WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, payload, response_json):
+        """保存响应，并在超出容量时淘汰最久未访问的条目"""
+        key = cache_key(payload)
+        text = json.dumps(response_json, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, payload.get('model'), text, len(text.encode('utf-8')), now, now),
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self):
+        if self.ttl_seconds:
+            cursor = self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            )
+            self.evictions += max(cursor.rowcount, 0)
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        self.evictions += len(doomed)
+
+    def invalidate(self, payload):
+        """删除某个请求的缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (cache_key(payload),))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self):
+        """命中率与当前占用"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
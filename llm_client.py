@@ -0,0 +1,458 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (API_KEY, API_URL, LLM_MAX_CONNECTIONS, LLM_REQUESTS_PER_MINUTE,
+                    LLM_TOKENS_PER_MINUTE, LLM_MAX_RETRIES, LLM_TIMEOUT, CACHE_DIR,
+                    LLM_CACHE_ENABLED, LLM_CACHE_TTL_HOURS, LLM_CACHE_MAX_MB)
+from llm_cache import LLMResponseCache
+from prompt_budget import count_message_tokens
+from instrumentation import span, start_span, log_event, increment, observe
+
+# 遇到这些状态码时退避重试
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """API 返回了非 200 且不可重试（或重试耗尽）的响应"""
+
+    def __init__(self, status_code, body):
+        super().__init__(f"API响应状态码 {status_code} - {body}")
+        self.status_code = status_code
+        self.body = body
+
+
+class LLMCancelled(Exception):
+    """流式生成被调用方取消"""
+
+
+class TokenBucket:
+    """令牌桶限流：rate_per_minute 为每分钟补充的令牌数，0 表示不限流
+
+    采用“预约”方式：令牌不足时允许透支，调用方按返回的等待时间休眠，
+    因此同步（time.sleep）与异步（asyncio.sleep）两种调用方式共用同一个桶。
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount):
+        """预约 amount 个令牌，返回需要等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def adjust(self, delta):
+        """按实际用量修正（delta 为正表示多用了，负表示退还）"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens - delta)
+
+    def acquire(self, amount=1):
+        wait = self._reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, amount=1):
+        wait = self._reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """估算一次请求消耗的 token 数（提示词按本地分词计数，再加上输出上限）"""
+    return count_message_tokens(messages) + (max_tokens or 0)
+
+
+def chat_completions_url(api_url):
+    """拼出 chat/completions 的完整地址，兼容 API_URL 是否已带 /v1"""
+    base = (api_url or "").rstrip('/')
+    if base.endswith('/v1'):
+        return f"{base}/chat/completions"
+    return f"{base}/v1/chat/completions"
+
+
+class LLMClient:
+    """共享的 OpenAI 兼容接口客户端
+
+    - 复用 requests.Session 的 keep-alive 连接池，避免每次请求重新建立 TCP/TLS 连接
+    - 请求数 / token 数两个令牌桶限流
+    - 429、5xx 与网络错误按带抖动的指数退避重试，遵循 Retry-After
+    - 完全相同且仍在进行中的请求只发送一次，结果共享
+    - 成功的响应写入磁盘缓存，相同请求（模型、消息、temperature、max_tokens 等）直接返回缓存结果；
+      use_cache=False 完全绕过缓存，refresh=True 忽略已有缓存、重新请求并覆盖
+    同时提供同步（chat_completion）与 asyncio（achat_completion）两套接口。
+    """
+
+    def __init__(self, api_key=API_KEY, api_url=API_URL, max_connections=LLM_MAX_CONNECTIONS,
+                 requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 max_retries=LLM_MAX_RETRIES, timeout=LLM_TIMEOUT, backoff_base=1.0, backoff_cap=30.0,
+                 cache=None):
+        self.url = chat_completions_url(api_url)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        })
+
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}        # 请求键 -> concurrent.futures.Future
+        self._async_inflight = {}  # (事件循环, 请求键) -> asyncio.Future
+
+    @staticmethod
+    def build_payload(messages, model="deepseek-chat", temperature=None, max_tokens=None, **extra):
+        payload = {"model": model, "messages": messages}
+        if temperature is not None:
+            payload["temperature"] = temperature
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        payload.update(extra)
+        return payload
+
+    @staticmethod
+    def request_key(payload):
+        """请求的规范化键：相同内容的请求得到相同的键"""
+        return json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+    def _backoff(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(self.backoff_cap, float(retry_after))
+                except ValueError:
+                    pass
+        # 全抖动（full jitter）指数退避
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _send_once(self, payload, timeout, stream=False):
+        """发送一次请求：返回 (响应 JSON 或流式响应对象, None) 或 (None, 需退避重试的响应)"""
+        response = self.session.post(self.url, json=payload, timeout=timeout or self.timeout, stream=stream)
+        if response.status_code == 200:
+            return (response if stream else response.json()), None
+        if stream:
+            # 读出错误正文后释放连接
+            response.content
+            response.close()
+        if response.status_code in RETRYABLE_STATUS:
+            return None, response
+        raise LLMError(response.status_code, response.text)
+
+    def _settle_tokens(self, estimate, result):
+        usage = (result or {}).get("usage") or {}
+        if usage.get("total_tokens"):
+            self.token_bucket.adjust(usage["total_tokens"] - estimate)
+
+    def _retry_wait(self, attempt, retry_response, request_span):
+        """记录一次重试并返回退避秒数"""
+        delay = self._backoff(attempt, retry_response)
+        reason = retry_response.status_code if retry_response is not None else "network"
+        increment("llm_retries_total", reason=reason)
+        if request_span is not None:
+            request_span.set(retries=attempt + 1)
+        log_event("llm.retry", f"请求失败，{delay:.1f} 秒后第 {attempt + 1} 次重试", level="warning",
+                  reason=reason, delay_s=round(delay, 3))
+        return delay
+
+    def _request(self, payload, timeout, stream=False, request_span=None):
+        estimate = estimate_tokens(payload["messages"], payload.get("max_tokens"))
+        attempt = 0
+        while True:
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(estimate)
+            try:
+                result, retry_response = self._send_once(payload, timeout, stream)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                if attempt >= self.max_retries:
+                    raise
+                retry_response = None
+                result = None
+            if result is not None:
+                if not stream:
+                    self._settle_tokens(estimate, result)
+                return result
+            if attempt >= self.max_retries:
+                raise LLMError(retry_response.status_code, retry_response.text)
+            time.sleep(self._retry_wait(attempt, retry_response, request_span))
+            attempt += 1
+
+    def _cache_lookup(self, payload, use_cache, refresh):
+        if self.cache is None or not use_cache or refresh:
+            return None
+        cached = self.cache.get(payload)
+        increment("llm_cache_lookups_total", result="hit" if cached is not None else "miss")
+        return cached
+
+    @staticmethod
+    def _record_usage(request_span, payload, usage):
+        """把 token 用量记到区间与计数器上；接口未返回用量时记录估算的输入 token 数"""
+        model = payload.get("model")
+        if usage and usage.get("prompt_tokens") is not None:
+            prompt, completion = usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+            request_span.set(prompt_tokens=prompt, completion_tokens=completion)
+            increment("llm_tokens_total", prompt, model=model, type="prompt")
+            increment("llm_tokens_total", completion, model=model, type="completion")
+        else:
+            request_span.set(prompt_tokens_estimated=estimate_tokens(payload["messages"]))
+
+    def _cache_store(self, payload, result, use_cache):
+        content = response_content(result)
+        if self.cache is None or not use_cache or not content:
+            return
+        if (payload.get("response_format") or {}).get("type") == "json_object":
+            # 要求 JSON 输出却无法解析的响应不缓存，下次重新请求
+            try:
+                parse_json_response(content)
+            except ValueError:
+                increment("llm_cache_rejected_total", reason="unparsable_json")
+                return
+        try:
+            self.cache.put(payload, result)
+        except Exception as e:
+            # 缓存写入失败不影响本次结果
+            log_event("llm.cache_write_failed", f"写入响应缓存失败：{str(e)}", level="warning")
+
+    def chat_completion(self, messages, model="deepseek-chat", temperature=None, max_tokens=None,
+                        timeout=None, use_cache=True, refresh=False, **extra):
+        """同步调用 chat/completions，返回响应 JSON；失败时抛出 LLMError 或 requests 异常"""
+        payload = self.build_payload(messages, model, temperature, max_tokens, **extra)
+        cached = self._cache_lookup(payload, use_cache, refresh)
+        if cached is not None:
+            return cached
+        key = self.request_key(payload)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            return future.result()
+        try:
+            with span("llm.request", model=model, stream=False) as request_span:
+                result = self._request(payload, timeout, request_span=request_span)
+                self._record_usage(request_span, payload, result.get("usage"))
+            self._cache_store(payload, result, use_cache)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    def stream_chat_completion(self, messages, model="deepseek-chat", temperature=None, max_tokens=None,
+                               timeout=None, cancel_event=None, use_cache=True, refresh=False, **extra):
+        """以 SSE 流式调用 chat/completions，逐段产出新增文本
+
+        只在收到首字节之前重试；cancel_event（threading.Event）被置位时关闭连接并抛出 LLMCancelled。
+        命中缓存时一次性产出完整文本；完整接收（未取消）的结果写入缓存，与非流式请求共用。
+        """
+        payload = self.build_payload(messages, model, temperature, max_tokens, stream=True, **extra)
+        cached = self._cache_lookup(payload, use_cache, refresh)
+        if cached is not None:
+            content = response_content(cached)
+            if content:
+                yield content
+            return
+        # 生成器会跨越调用方的多次迭代，区间不进入线程栈，手动结束
+        request_span = start_span("llm.request", model=model, stream=True)
+        parts = []
+        usage = None
+        try:
+            response = self._request(payload, timeout, stream=True, request_span=request_span)
+            # SSE 响应通常不带 charset，按 UTF-8 解码避免中文乱码
+            response.encoding = "utf-8"
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise LLMCancelled()
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    usage = chunk.get("usage") or usage
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    delta = choices[0].get("delta", {}).get("content")
+                    if delta:
+                        if not parts:
+                            ttft = request_span.elapsed()
+                            request_span.set(ttft_s=round(ttft, 4))
+                            observe("llm_ttft_seconds", ttft, model=model)
+                        parts.append(delta)
+                        yield delta
+            finally:
+                response.close()
+        except GeneratorExit:
+            request_span.set(abandoned=True)
+            request_span.finish()
+            raise
+        except BaseException as e:
+            request_span.finish(error=e)
+            raise
+        self._record_usage(request_span, payload, usage)
+        request_span.set(completion_chars=sum(len(part) for part in parts))
+        request_span.finish()
+        self._cache_store(payload, {"choices": [{"message": {"role": "assistant", "content": "".join(parts)}}]},
+                          use_cache)
+
+    async def _arequest(self, payload, timeout, request_span=None):
+        loop = asyncio.get_running_loop()
+        estimate = estimate_tokens(payload["messages"], payload.get("max_tokens"))
+        attempt = 0
+        while True:
+            await self.request_bucket.acquire_async(1)
+            await self.token_bucket.acquire_async(estimate)
+            try:
+                result, retry_response = await loop.run_in_executor(None, self._send_once, payload, timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                if attempt >= self.max_retries:
+                    raise
+                retry_response = None
+                result = None
+            if result is not None:
+                self._settle_tokens(estimate, result)
+                return result
+            if attempt >= self.max_retries:
+                raise LLMError(retry_response.status_code, retry_response.text)
+            await asyncio.sleep(self._retry_wait(attempt, retry_response, request_span))
+            attempt += 1
+
+    async def achat_completion(self, messages, model="deepseek-chat", temperature=None, max_tokens=None,
+                               timeout=None, use_cache=True, refresh=False, **extra):
+        """chat_completion 的 asyncio 版本，网络 I/O 在默认线程池中执行，共用连接池、限流与缓存"""
+        payload = self.build_payload(messages, model, temperature, max_tokens, **extra)
+        cached = self._cache_lookup(payload, use_cache, refresh)
+        if cached is not None:
+            return cached
+        loop = asyncio.get_running_loop()
+        key = (id(loop), self.request_key(payload))
+        future = self._async_inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = loop.create_future()
+        self._async_inflight[key] = future
+        # 同一线程中交错执行的协程不能共用线程栈，区间手动结束
+        request_span = start_span("llm.request", model=model, stream=False)
+        try:
+            result = await self._arequest(payload, timeout, request_span)
+            self._record_usage(request_span, payload, result.get("usage"))
+            request_span.finish()
+            self._cache_store(payload, result, use_cache)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError as e:
+            request_span.finish(error=e)
+            future.cancel()
+            raise
+        except Exception as e:
+            request_span.finish(error=e)
+            future.set_exception(e)
+            # 没有其他等待者时避免“异常未被获取”的警告
+            future.exception()
+            raise
+        finally:
+            self._async_inflight.pop(key, None)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """返回进程内共享的 LLM 响应缓存；未启用时返回 None"""
+    global _llm_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMResponseCache(
+                os.path.join(CACHE_DIR, "llm_cache.sqlite3"),
+                max_bytes=LLM_CACHE_MAX_MB * 1024 * 1024,
+                ttl_seconds=LLM_CACHE_TTL_HOURS * 3600,
+            )
+        return _llm_cache
+
+
+def get_llm_client():
+    """返回进程内共享的 LLMClient"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient(cache=get_llm_cache())
+        return _client
+
+
+def set_llm_client(client):
+    """替换进程内共享的 LLMClient（如指向桩服务器），返回原来的客户端"""
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+        return previous
+
+
+def response_content(response_json):
+    """取出第一条 choice 的文本内容，无法解析时返回空字符串"""
+    choices = response_json.get("choices") or []
+    if not choices:
+        return ""
+    return choices[0].get("message", {}).get("content", "") or ""
+
+
+def parse_json_response(content):
+    """解析模型返回的 JSON，容忍 ```json 代码块包裹；失败时的错误信息只含长度与摘要，不含原文"""
+    content = content.strip()
+    fenced = re.search(r'```(?:json)?\s*(.*?)```', content, re.DOTALL)
+    if fenced:
+        content = fenced.group(1)
+    start, end = content.find('{'), content.rfind('}')
+    try:
+        if start < 0 or end < start:
+            raise ValueError("未找到 JSON 对象")
+        return json.loads(content[start:end + 1])
+    except ValueError as e:
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+        raise ValueError(f"无法解析模型返回的 JSON（{len(content)} 字符，sha256 {digest}）") from e
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """计算文件内容的 SHA-256，作为内容寻址的键"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def options_key(fingerprint):
+    """将流水线参数指纹序列化为稳定的字符串"""
+    return json.dumps(dict(fingerprint), sort_keys=True, ensure_ascii=False)
+
+
+class OcrCache:
+    """按页存储 OCR/Markdown 转换结果的磁盘缓存
+
+    键为 (PDF 内容哈希, 流水线参数, 页码)，按页存储使得不同的页码选择可以复用已转换的页面。
+    总大小超过 max_bytes 时按最近访问时间淘汰（LRU）。
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                doc_hash TEXT NOT NULL,
+                options TEXT NOT NULL,
+                page_no INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (doc_hash, options, page_no)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_access ON pages (last_access)")
+        self._conn.commit()
+
+    def get_pages(self, doc_hash, fingerprint, pages):
+        """查询一组页码，返回 {页码: 文本}，未命中的页码不在结果中"""
+        pages = list(pages)
+        if not pages:
+            return {}
+        options = options_key(fingerprint)
+        found = {}
+        with self._lock:
+            for start in range(0, len(pages), 500):
+                batch = pages[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT page_no, text FROM pages WHERE doc_hash = ? AND options = ? "
+                    f"AND page_no IN ({placeholders})",
+                    [doc_hash, options, *batch],
+                ).fetchall()
+                found.update(rows)
+            if found:
+                self._conn.executemany(
+                    "UPDATE pages SET last_access = ? WHERE doc_hash = ? AND options = ? AND page_no = ?",
+                    [(time.time(), doc_hash, options, page_no) for page_no in found],
+                )
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(pages) - len(found)
+        return found
+
+    def put_pages(self, doc_hash, fingerprint, page_texts):
+        """写入 {页码: 文本}，并在超出容量时淘汰最久未访问的页面"""
+        if not page_texts:
+            return
+        options = options_key(fingerprint)
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pages (doc_hash, options, page_no, text, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (doc_hash, options, page_no, text, len(text.encode('utf-8')), now)
+                    for page_no, text in page_texts.items()
+                ],
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT rowid, size FROM pages ORDER BY last_access ASC"
+        ).fetchall()
+        doomed = []
+        for rowid, size in rows:
+            if total <= self.max_bytes:
+                break
+            doomed.append((rowid,))
+            total -= size
+        self._conn.executemany("DELETE FROM pages WHERE rowid = ?", doomed)
+        self.evictions += len(doomed)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM pages")
+            self._conn.commit()
+
+    def stats(self):
+        """命中 / 未命中计数及当前占用"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,20 +1,109 @@
-from docling.datamodel.pipeline_options import PdfPipelineOptions, RapidOcrOptions
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling.datamodel.base_models import InputFormat
-def setup_ocr_pipeline():
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+import fitz
+
+from config import (OCR_CONVERTER_POOL_SIZE, CACHE_DIR, OCR_CACHE_ENABLED, OCR_CACHE_MAX_MB,
+                    OCR_PROCESSES, OCR_CHUNK_PAGES, OCR_TEXT_LAYER_FAST_PATH, OCR_STREAM_WINDOW,
+                    OCR_ADAPTIVE_PIPELINE)
+from ocr_cache import OcrCache, file_sha256
+from page_triage import (triage_pages, extract_text_layer, METHOD_TEXT_LAYER, METHOD_OCR, PAGE_PROSE, PAGE_TABLES,
+                         PAGE_SCANNED)
+from instrumentation import span, log_event, increment
+
+# 拼接多页 Markdown 时插入的页码标记
+PAGE_MARKER = "<!-- 第 {page_no} 页 -->"
+# 匹配页码标记的正则（由 PAGE_MARKER 生成，页码为第 1 组），其他模块据此识别分页
+PAGE_MARKER_RE = re.compile(re.escape(PAGE_MARKER).replace(re.escape('{page_no}'), r'(\d+)'))
+
+# 默认流水线参数（与原先硬编码的配置一致）
+DEFAULT_PIPELINE_CONFIG = {
+    'ocr_engine': 'rapidocr',
+    'do_ocr': True,
+    'force_full_page_ocr': True,
+    'generate_page_images': True,
+    'do_table_structure': True,
+    'do_cell_matching': True,
+}
+
+
+# 按页面类型选用的流水线参数：只在需要的页面上做 OCR 与表格结构识别；
+# 页面图像只在导出图片时才用得上，各类页面都不生成
+PAGE_CLASS_PIPELINES = {
+    PAGE_PROSE: {'do_ocr': False, 'do_table_structure': False, 'generate_page_images': False},
+    PAGE_TABLES: {'do_ocr': False, 'do_table_structure': True, 'generate_page_images': False},
+    PAGE_SCANNED: {'do_ocr': True, 'do_table_structure': False, 'generate_page_images': False},
+}
+
+
+def pipeline_config(**overrides):
+    """合并默认参数与覆盖项，返回完整的流水线参数字典"""
+    unknown = set(overrides) - set(DEFAULT_PIPELINE_CONFIG)
+    if unknown:
+        raise ValueError(f"未知的流水线参数：{', '.join(sorted(unknown))}")
+    config = dict(DEFAULT_PIPELINE_CONFIG)
+    config.update(overrides)
+    return config
+
+
+def pipeline_fingerprint(config=None):
+    """流水线参数指纹，用作转换器注册表（及后续缓存）的键"""
+    config = pipeline_config(**(config or {}))
+    return tuple(sorted(config.items()))
+
+
+def page_pipeline(page_stats, overrides=None):
+    """按页面分类（page_triage.classify_page 的统计信息）选择流水线参数，调用方显式传入的参数优先"""
+    config = dict(PAGE_CLASS_PIPELINES[page_stats['page_class']])
+    if page_stats['page_class'] == PAGE_SCANNED and page_stats.get('tables'):
+        # 扫描的检验单等：OCR 与表格结构都需要
+        config['do_table_structure'] = True
+    config.update(overrides or {})
+    return config
+
+
+def default_prewarm_configs():
+    """启动时预热的流水线参数：按页选择参数时为扫描页（不含 / 含表格）两组，否则为默认参数
+
+    文字层页面大多直接提取，含表格的文字层页面较少，对应的转换器在首次用到时再构建。
+    """
+    if not OCR_ADAPTIVE_PIPELINE:
+        return [{}]
+    return [page_pipeline({'page_class': PAGE_SCANNED, 'tables': tables}) for tables in (False, True)]
+
+
+def setup_ocr_pipeline(**overrides):
+    """按给定参数新建一个 DocumentConverter（不经过注册表）"""
+    # docling 连同其模型依赖导入需要数秒，推迟到第一次构建转换器时（通常在后台预热线程中）
+    from docling.datamodel.pipeline_options import (PdfPipelineOptions, RapidOcrOptions, EasyOcrOptions,
+                                                    TesseractOcrOptions)
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+    from docling.datamodel.base_models import InputFormat
+
+    config = pipeline_config(**overrides)
     # pipeline_options = PdfPipelineOptions(artifacts_path=ARTIFACTS_PATH)
     pipeline_options = PdfPipelineOptions(enable_remote_services=True)
-    pipeline_options.do_ocr = True
-    pipeline_options.generate_page_images = True
-    pipeline_options.do_table_structure = True
-    pipeline_options.table_structure_options.do_cell_matching = True
-    # pipeline_options.ocr_options = EasyOcrOptions(
-    #     lang=["ch_sim","en"],force_full_page_ocr=True
-    # )
-    pipeline_options.ocr_options = RapidOcrOptions(force_full_page_ocr = True)
-    # pipeline_options.ocr_options = TesseractOcrOptions(
-    #     lang=["chi_sim","eng"]
-    # )
+    pipeline_options.do_ocr = config['do_ocr']
+    pipeline_options.generate_page_images = config['generate_page_images']
+    pipeline_options.do_table_structure = config['do_table_structure']
+    pipeline_options.table_structure_options.do_cell_matching = config['do_cell_matching']
+    if config['ocr_engine'] == 'rapidocr':
+        pipeline_options.ocr_options = RapidOcrOptions(force_full_page_ocr=config['force_full_page_ocr'])
+    elif config['ocr_engine'] == 'easyocr':
+        pipeline_options.ocr_options = EasyOcrOptions(
+            lang=["ch_sim", "en"], force_full_page_ocr=config['force_full_page_ocr']
+        )
+    elif config['ocr_engine'] == 'tesseract':
+        pipeline_options.ocr_options = TesseractOcrOptions(
+            lang=["chi_sim", "eng"], force_full_page_ocr=config['force_full_page_ocr']
+        )
+    else:
+        raise ValueError(f"不支持的 OCR 引擎：{config['ocr_engine']}")
     pipeline_options.enable_remote_services = True
 
     return DocumentConverter(
@@ -23,25 +112,422 @@ def setup_ocr_pipeline():
         }
     )
 
-def extract_text_from_pdf(pdf_path, page_range=None):
-    """使用 docling 将 PDF 中的关键页码转换为 Markdown 格式并提取文本"""
-    try:
-        # 使用 docling 仅转换特定页码或全文
-        doc_converter = setup_ocr_pipeline()
-        if page_range is not None:
-            result = doc_converter.convert(pdf_path, page_range=page_range)
+
+class ConverterRegistry:
+    """常驻的 DocumentConverter 注册表
+
+    按流水线参数指纹缓存已构建（模型已加载）的转换器，跨调用复用。
+    每个指纹下最多保留 pool_size 个实例，同一实例同一时间只借给一个线程使用。
+    注册表是进程内对象：进程池中的每个工作进程各自持有一份，
+    可用 init_ocr_worker 作为进程池 initializer 在子进程启动时预热。
+    """
+
+    def __init__(self, pool_size=1):
+        self.pool_size = max(1, pool_size)
+        self._cond = threading.Condition()
+        self._idle = {}        # 指纹 -> 空闲转换器列表
+        self._total = {}       # 指纹 -> 已构建（含借出）数量
+        self._generation = {}  # 指纹 -> 代号，淘汰后借出的旧实例归还时直接丢弃
+        self._prewarm_threads = []
+
+    def _build(self, config):
+        from docling.datamodel.base_models import InputFormat
+        with span("ocr.converter_setup", engine=config['ocr_engine']):
+            converter = setup_ocr_pipeline(**config)
+            # 提前加载 OCR / 表格结构模型，避免首次 convert 时才付出初始化开销
+            converter.initialize_pipeline(InputFormat.PDF)
+        return converter
+
+    def _checkout(self, key, config):
+        with self._cond:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    return idle.pop(), self._generation.get(key, 0)
+                if self._total.get(key, 0) < self.pool_size:
+                    self._total[key] = self._total.get(key, 0) + 1
+                    generation = self._generation.get(key, 0)
+                    break
+                self._cond.wait()
+        try:
+            return self._build(config), generation
+        except Exception:
+            with self._cond:
+                self._total[key] -= 1
+                self._cond.notify_all()
+            raise
+
+    def _checkin(self, key, converter, generation):
+        with self._cond:
+            if generation == self._generation.get(key, 0):
+                self._idle.setdefault(key, []).append(converter)
+            elif key in self._total:
+                self._total[key] -= 1
+                if self._total[key] <= 0:
+                    self._total.pop(key, None)
+            self._cond.notify_all()
+
+    @contextmanager
+    def acquire(self, **overrides):
+        """借出一个与参数匹配的转换器，用完自动归还"""
+        config = pipeline_config(**overrides)
+        key = pipeline_fingerprint(config)
+        converter, generation = self._checkout(key, config)
+        try:
+            yield converter
+        finally:
+            self._checkin(key, converter, generation)
+
+    def prewarm(self, configs=None, background=True, on_done=None):
+        """预先构建转换器；background=True 时在后台线程中进行，返回该线程
+
+        on_done(错误信息或 None, 耗时秒数) 在预热结束后调用（后台预热时在预热线程中调用）。
+        """
+        configs = configs or [{}]
+
+        def _run():
+            start = time.perf_counter()
+            error = None
+            for overrides in configs:
+                try:
+                    with self.acquire(**overrides):
+                        pass
+                except Exception as e:
+                    error = str(e)
+                    log_event("ocr.prewarm_failed", f"OCR 模型预热失败：{str(e)}", level="error")
+            if on_done is not None:
+                on_done(error, time.perf_counter() - start)
+
+        if not background:
+            _run()
+            return None
+        thread = threading.Thread(target=_run, name="ocr-prewarm", daemon=True)
+        thread.start()
+        self._prewarm_threads.append(thread)
+        return thread
+
+    def evict(self, **overrides):
+        """淘汰指定参数的转换器；不传参数时淘汰全部"""
+        with self._cond:
+            if overrides:
+                keys = [pipeline_fingerprint(overrides)]
+            else:
+                keys = list(set(self._total) | set(self._idle))
+            for key in keys:
+                idle = self._idle.pop(key, [])
+                # 借出中的实例仍计入总数，归还时按代号丢弃
+                self._total[key] = self._total.get(key, 0) - len(idle)
+                if self._total[key] <= 0:
+                    self._total.pop(key, None)
+                self._generation[key] = self._generation.get(key, 0) + 1
+            self._cond.notify_all()
+
+    def shutdown(self, wait=True):
+        """等待预热线程结束并释放全部转换器"""
+        if wait:
+            for thread in self._prewarm_threads:
+                thread.join()
+        self._prewarm_threads = []
+        self.evict()
+
+    def stats(self):
+        """各指纹下已构建 / 空闲的转换器数量"""
+        with self._cond:
+            return {
+                key: {'total': total, 'idle': len(self._idle.get(key, []))}
+                for key, total in self._total.items()
+            }
+
+
+_registry = ConverterRegistry(pool_size=OCR_CONVERTER_POOL_SIZE)
+
+
+def get_converter_registry():
+    """返回进程内共享的转换器注册表"""
+    return _registry
+
+
+def prewarm_converters(configs=None, background=True, on_done=None):
+    """在启动时预热转换器（默认后台进行），on_done(错误信息或 None, 耗时秒数) 在结束时调用"""
+    return _registry.prewarm(configs or default_prewarm_configs(), background=background, on_done=on_done)
+
+
+def evict_converters(**overrides):
+    """淘汰指定参数（不传则全部）的转换器"""
+    _registry.evict(**overrides)
+
+
+def shutdown_converters(wait=True):
+    """关闭注册表与 OCR 进程池，释放全部转换器"""
+    _registry.shutdown(wait=wait)
+    shutdown_ocr_process_pool(wait=wait)
+
+
+_in_ocr_worker = False
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def init_ocr_worker(configs=None):
+    """进程池 initializer：在工作进程内同步预热转换器"""
+    global _in_ocr_worker
+    # 工作进程内不再嵌套创建进程池
+    _in_ocr_worker = True
+    _registry.prewarm(configs or default_prewarm_configs(), background=False)
+
+
+def get_ocr_process_pool():
+    """返回共享的 OCR 进程池，供命令行工具与筛查服务作为 executor 显式传入
+
+    OCR_PROCESSES <= 1 或已身处工作进程时返回 None（在本进程内转换）。
+    调用方进程通常已有多个线程，工作进程用 spawn 方式启动，不 fork 带锁的线程状态。
+    """
+    global _process_pool
+    if OCR_PROCESSES <= 1 or _in_ocr_worker:
+        return None
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=OCR_PROCESSES, initializer=init_ocr_worker,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return _process_pool
+
+
+def shutdown_ocr_process_pool(wait=True):
+    """关闭共享的 OCR 进程池"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=wait, cancel_futures=True)
+            _process_pool = None
+
+
+_ocr_cache = None
+_ocr_cache_lock = threading.Lock()
+
+
+def get_ocr_cache():
+    """返回进程内共享的 OCR 结果缓存；未启用时返回 None"""
+    global _ocr_cache
+    if not OCR_CACHE_ENABLED:
+        return None
+    with _ocr_cache_lock:
+        if _ocr_cache is None:
+            _ocr_cache = OcrCache(
+                os.path.join(CACHE_DIR, "ocr_cache.sqlite3"),
+                max_bytes=OCR_CACHE_MAX_MB * 1024 * 1024,
+            )
+        return _ocr_cache
+
+
+def _contiguous_runs(pages):
+    """将有序页码拆分为连续区间，例如 [1,2,3,7,8] -> [(1,3),(7,8)]"""
+    runs = []
+    for page_no in pages:
+        if runs and page_no == runs[-1][1] + 1:
+            runs[-1][1] = page_no
         else:
-            result = doc_converter.convert(pdf_path)
-        markdown_text = result.document.export_to_markdown()
-        
-        return {
-            'success': True,
-            'text': markdown_text,
-            'message': "PDF 成功转换为 Markdown 格式",
-            'is_filtered': page_range is not None
-        }
+            runs.append([page_no, page_no])
+    return [tuple(run) for run in runs]
+
+
+def _conversion_units(pages, chunk_pages=OCR_CHUNK_PAGES):
+    """将待转换页码拆成转换单元：每个单元是一段不超过 chunk_pages 页的连续页码"""
+    units = []
+    for start, end in _contiguous_runs(pages):
+        for chunk_start in range(start, end + 1, chunk_pages):
+            units.append((chunk_start, min(end, chunk_start + chunk_pages - 1)))
+    return units
+
+
+def _convert_unit(pdf_path, unit, pipeline_overrides):
+    """用 docling 转换一个连续页码单元，返回 {页码: Markdown}（可在工作进程中执行）"""
+    start, end = unit
+    config = pipeline_config(**pipeline_overrides)
+    with span("ocr.convert", first_page=start, pages=end - start + 1, do_ocr=config['do_ocr'],
+              tables=config['do_table_structure']) as convert_span:
+        with _registry.acquire(**pipeline_overrides) as doc_converter:
+            result = doc_converter.convert(pdf_path, page_range=(start, end))
+        convert_span.set(seconds_per_page=round(convert_span.elapsed() / (end - start + 1), 4))
+    page_texts = {}
+    for page_no in range(start, end + 1):
+        with span("ocr.export_markdown", page=page_no):
+            page_texts[page_no] = result.document.export_to_markdown(page_no=page_no)
+    return page_texts
+
+
+def _iter_converted_units(pdf_path, page_groups, executor=None, window=None, chunk_pages=None):
+    """转换各组页码，每完成一个转换单元产出一次 (流水线参数, {页码: Markdown})
+
+    page_groups 为 [(流水线参数, 页码列表)]，每组页码拆成若干转换单元（单元不跨组），
+    所有单元按首页页码排序。传入 executor 时在其中并行转换，同时在转换的单元不超过 window 个，
+    因此 docling 持有的页面图像只限于窗口内的页面，而不是整份文档；
+    不传时在当前线程中依次转换，使用本进程内已预热的转换器。
+    """
+    units = sorted(
+        ((unit, overrides) for overrides, pages in page_groups
+         for unit in _conversion_units(pages, chunk_pages or OCR_CHUNK_PAGES)),
+        key=lambda entry: entry[0],
+    )
+    pool = executor if len(units) > 1 else None
+    if pool is None:
+        for unit, overrides in units:
+            yield overrides, _convert_unit(pdf_path, unit, overrides)
+        return
+    window = window or OCR_STREAM_WINDOW or 2 * max(1, OCR_PROCESSES)
+    pending = list(reversed(units))
+    in_flight = {}
+    try:
+        while pending or in_flight:
+            # 按页码顺序提交，靠前的页面先转换完成
+            while pending and len(in_flight) < window:
+                unit, overrides = pending.pop()
+                in_flight[pool.submit(_convert_unit, pdf_path, unit, overrides)] = overrides
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future.result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def normalize_pages(pages, page_count):
+    """整理页码集合：去重、排序并去掉超出文档范围的页码（页码从 1 开始）"""
+    return sorted({int(page_no) for page_no in pages if 1 <= int(page_no) <= page_count})
+
+
+def iter_pdf_pages(pdf_path, pages=None, page_range=None, use_cache=True, text_layer=OCR_TEXT_LAYER_FAST_PATH,
+                   executor=None, window=None, chunk_pages=None, stats=None, adaptive=OCR_ADAPTIVE_PIPELINE,
+                   **pipeline_overrides):
+    """逐页产出 (页码, Markdown, 方式)，按页码顺序，每页一就绪就产出
+
+    文字层页面与缓存命中的页面立即产出，其余页面按转换单元交给 docling，前面的单元完成后即可产出，
+    不必等整份文档转换完。executor 指定执行转换单元的进程池（如 get_ocr_process_pool()，默认在当前线程中转换），
+    window 为同时转换的单元数上限，chunk_pages 为每个单元的页数（默认 OCR_CHUNK_PAGES，
+    需要尽早显示首页时可设为 1）。stats 传入字典时写入 pages、page_methods、page_classes、cache_hits、
+    cache_misses。adaptive=True 时按页面类型（正文、含表格、扫描）分别选择流水线参数（见 page_pipeline），
+    只在扫描页上做 OCR、只在含表格的页面上识别表格结构，否则所有页面使用同一组参数。
+    提前关闭生成器会取消尚未开始的转换单元。
+    """
+    stats = stats if stats is not None else {}
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+    if pages is not None:
+        pages = normalize_pages(pages, page_count)
+    elif page_range is not None:
+        pages = list(range(max(1, page_range[0]), min(page_count, page_range[1]) + 1))
+    else:
+        pages = list(range(1, page_count + 1))
+
+    # 带有可用文字层的页面直接提取（毫秒级），其余页面走 OCR
+    page_methods = {page_no: METHOD_OCR for page_no in pages}
+    page_configs = {page_no: pipeline_overrides for page_no in pages}
+    page_classes = {}
+    ready = {}
+    if text_layer or adaptive:
+        with span("ocr.triage", pages=len(pages)):
+            triage = triage_pages(pdf_path, pages, detect_scanned_tables=adaptive)
+            text_pages = []
+            if text_layer:
+                text_pages = [page_no for page_no in pages if triage[page_no][0] == METHOD_TEXT_LAYER]
+                ready.update(extract_text_layer(pdf_path, text_pages))
+        page_methods.update({page_no: METHOD_TEXT_LAYER for page_no in text_pages})
+        page_classes = {page_no: page_stats['page_class'] for page_no, (_, page_stats) in triage.items()}
+        if adaptive:
+            page_configs = {page_no: page_pipeline(triage[page_no][1], pipeline_overrides) for page_no in pages}
+    ocr_pages = [page_no for page_no in pages if page_methods[page_no] == METHOD_OCR]
+
+    # 按流水线参数分组：每组有各自的缓存键与转换器
+    groups = {}
+    for page_no in ocr_pages:
+        fingerprint = pipeline_fingerprint(page_configs[page_no])
+        groups.setdefault(fingerprint, (page_configs[page_no], []))[1].append(page_no)
+
+    cache = get_ocr_cache() if use_cache else None
+    cached = {}
+    if cache is not None and ocr_pages:
+        doc_hash = file_sha256(pdf_path)
+        for fingerprint, (_, group_pages) in groups.items():
+            cached.update(cache.get_pages(doc_hash, fingerprint, group_pages))
+        ready.update(cached)
+    missing_groups = []
+    for overrides, group_pages in groups.values():
+        group_missing = [page_no for page_no in group_pages if page_no not in ready]
+        if group_missing:
+            missing_groups.append((overrides, group_missing))
+    missing_count = sum(len(group_pages) for _, group_pages in missing_groups)
+
+    text_layer_count = len(pages) - len(ocr_pages)
+    table_pages = sum(len(group_pages) for overrides, group_pages in missing_groups
+                      if pipeline_config(**overrides)['do_table_structure'])
+    stats.update(pages=pages, page_methods=page_methods, page_classes=page_classes, text_layer_pages=text_layer_count,
+                 table_pages=table_pages if adaptive else 0, cache_hits=len(cached), cache_misses=missing_count)
+    increment("ocr_pages_total", text_layer_count, method=METHOD_TEXT_LAYER)
+    increment("ocr_pages_total", len(cached), method="cache")
+    increment("ocr_pages_total", missing_count, method=METHOD_OCR)
+    for page_class in (PAGE_PROSE, PAGE_TABLES, PAGE_SCANNED):
+        count = sum(1 for value in page_classes.values() if value == page_class)
+        if count:
+            increment("ocr_page_classes_total", count, page_class=page_class)
+
+    position = 0
+
+    def _drain():
+        # 按页码顺序产出已就绪的页面，产出后即释放
+        nonlocal position
+        while position < len(pages) and pages[position] in ready:
+            page_no = pages[position]
+            position += 1
+            yield page_no, ready.pop(page_no), page_methods[page_no]
+
+    yield from _drain()
+    # 使用 docling 仅转换缓存未命中的页码，转换器从注册表借用
+    if missing_groups:
+        units = _iter_converted_units(pdf_path, missing_groups, executor, window, chunk_pages)
+        try:
+            for overrides, unit_texts in units:
+                # 每完成一个单元就写入缓存，中途失败时已完成的页面不会白做
+                if cache is not None:
+                    cache.put_pages(doc_hash, pipeline_fingerprint(overrides), unit_texts)
+                ready.update(unit_texts)
+                yield from _drain()
+        finally:
+            units.close()
+
+
+def conversion_message(stats):
+    """按 iter_pdf_pages 的统计信息生成转换结果提示"""
+    message = "PDF 成功转换为 Markdown 格式"
+    notes = []
+    if stats.get('text_layer_pages'):
+        notes.append(f"{stats['text_layer_pages']} 页直接读取文字层")
+    if stats.get('table_pages'):
+        notes.append(f"{stats['table_pages']} 页识别表格")
+    if stats.get('cache_hits'):
+        notes.append(f"{stats['cache_hits']} 页来自缓存")
+    if notes:
+        message += f"（{'，'.join(notes)}）"
+    return message
+
+
+def extract_text_from_pdf(pdf_path, page_range=None, use_cache=True, progress_callback=None, pages=None,
+                          page_markers=True, text_layer=OCR_TEXT_LAYER_FAST_PATH, adaptive=OCR_ADAPTIVE_PIPELINE,
+                          executor=None, **pipeline_overrides):
+    """使用 docling 将 PDF 中的关键页码转换为 Markdown 格式并提取文本
+
+    pages 为任意页码集合（从 1 开始），只转换这些页；也可用 page_range=(起始页, 结束页) 指定连续范围，
+    两者都不传时转换全文。结果按页缓存在磁盘上（键为 PDF 内容哈希 + 流水线参数 + 页码），
+    只有未命中的页面才交给 docling，传入 executor 时按转换单元在该进程池中并行处理，最后按页码顺序拼接，
+    page_markers=True 时在每页前插入页码标记。progress_callback(已完成页数, 总页数) 用于汇报进度。
+    text_layer=True 时先逐页检查文字层，质量合格的页面直接提取文字、跳过 OCR，
+    每页采用的方式记录在返回值的 page_methods 中。adaptive=True 时按页面类型分别选择流水线参数，
+    页面类型记录在 page_classes 中。需要边转换边显示时改用 iter_pdf_pages。
+    """
+    try:
+        with span("ocr.extract", path=os.path.basename(pdf_path)) as extract_span:
+            return _extract_text(pdf_path, page_range, use_cache, progress_callback, pages, page_markers,
+                                 text_layer, adaptive, executor, pipeline_overrides, extract_span)
     except Exception as e:
-        print(f"PDF 处理出错：{str(e)}")
+        log_event("ocr.failed", f"PDF 处理出错：{str(e)}", level="error", path=pdf_path)
         return {
             'success': False,
             'text': "",
@@ -49,3 +535,36 @@ def extract_text_from_pdf(pdf_path, page_range=None):
             'is_filtered': False
         }
 
+
+def _extract_text(pdf_path, page_range, use_cache, progress_callback, pages, page_markers, text_layer, adaptive,
+                  executor, pipeline_overrides, extract_span):
+    """extract_text_from_pdf 的主体，各页的处理方式与缓存命中情况记录在 extract_span 上"""
+    is_filtered = pages is not None or page_range is not None
+    stats = {}
+    parts = []
+    done = 0
+    for page_no, page_text, _ in iter_pdf_pages(pdf_path, pages, page_range, use_cache, text_layer,
+                                                executor=executor, stats=stats, adaptive=adaptive,
+                                                **pipeline_overrides):
+        if page_markers:
+            parts.append(PAGE_MARKER.format(page_no=page_no))
+        if page_text:
+            parts.append(page_text)
+        done += 1
+        if progress_callback is not None:
+            progress_callback(done, len(stats['pages']))
+    markdown_text = "\n\n".join(parts)
+
+    extract_span.set(pages=len(stats['pages']), text_layer_pages=stats['text_layer_pages'],
+                     table_pages=stats['table_pages'], cache_hits=stats['cache_hits'], ocr_pages=stats['cache_misses'])
+    return {
+        'success': True,
+        'text': markdown_text,
+        'message': conversion_message(stats),
+        'is_filtered': is_filtered,
+        'pages': stats['pages'],
+        'page_methods': stats['page_methods'],
+        'page_classes': stats['page_classes'],
+        'cache_hits': stats['cache_hits'],
+        'cache_misses': stats['cache_misses'],
+    }
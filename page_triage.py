@@ -0,0 +1,168 @@
+import fitz
+
+# 文字层质量判定阈值
+MIN_TEXT_CHARS = 50          # 少于该字数视为没有可用的文字层
+MAX_GARBAGE_RATIO = 0.05     # 乱码字符（替换符、私用区、控制字符）占比上限
+MAX_IMAGE_COVERAGE = 0.5     # 图片覆盖页面面积的比例上限，超过则多半是扫描件
+MIN_TEXT_COVERAGE = 0.02     # 文字块覆盖页面面积的比例下限
+
+METHOD_TEXT_LAYER = 'text_layer'
+METHOD_OCR = 'ocr'
+
+# 页面类型，决定交给 docling 时采用的流水线参数
+PAGE_PROSE = 'prose'        # 文字层可用、没有表格
+PAGE_TABLES = 'tables'      # 文字层可用、含表格
+PAGE_SCANNED = 'scanned'    # 没有可用的文字层，需要 OCR；是否含表格另记在 stats['tables'] 中
+
+# 扫描页表格估计：低分辨率灰度图上按水平条带统计列方向的空白
+SCAN_TRIAGE_DPI = 40
+INK_THRESHOLD = 160          # 灰度低于该值视为墨迹
+BAND_HEIGHT_INCH = 0.4       # 条带高度，约两行文字
+MIN_GUTTER_INCH = 0.25       # 两侧都有墨迹的竖向空白不窄于此宽度时视为列间隔
+MIN_GUTTERS = 2              # 条带内至少有这么多列间隔才算表格行
+MIN_TABLE_BANDS = 2          # 至少有这么多条表格行才认为页面含表格
+RULE_FILL_RATIO = 0.6        # 墨迹占整行宽度的比例超过该值视为表格横线
+MIN_RULES = 3
+
+
+def _is_garbage(ch):
+    code = ord(ch)
+    if ch == '�' or 0xE000 <= code <= 0xF8FF:
+        return True
+    return code < 32 and ch not in '\n\r\t'
+
+
+def _rect_area(rect):
+    rect = fitz.Rect(rect)
+    return max(rect.width, 0) * max(rect.height, 0)
+
+
+def text_layer_stats(page):
+    """统计页面文字层的质量指标"""
+    page_area = _rect_area(page.rect) or 1.0
+    blocks = page.get_text("blocks")
+    text = "".join(block[4] for block in blocks if block[6] == 0)
+    chars = [ch for ch in text if not ch.isspace()]
+    garbage = sum(1 for ch in chars if _is_garbage(ch))
+    text_area = sum(_rect_area(block[:4]) for block in blocks if block[6] == 0)
+    image_area = 0.0
+    for info in page.get_image_info():
+        image_area += _rect_area(fitz.Rect(info['bbox']) & page.rect)
+    return {
+        'chars': len(chars),
+        'garbage_ratio': garbage / len(chars) if chars else 0.0,
+        'text_coverage': min(text_area / page_area, 1.0),
+        'image_coverage': min(image_area / page_area, 1.0),
+    }
+
+
+def has_tables(page):
+    """页面上是否检测到表格（旧版 PyMuPDF 没有 find_tables 时视为没有）"""
+    find_tables = getattr(page, 'find_tables', None)
+    if find_tables is None:
+        return False
+    try:
+        return len(find_tables().tables) > 0
+    except Exception:
+        return False
+
+
+def _gutter_count(columns, min_gap):
+    """一行列方向墨迹标记中，两侧都有墨迹且宽度不小于 min_gap 的空白段数"""
+    inked = columns.nonzero()[0]
+    if len(inked) < 2:
+        return 0
+    gaps = inked[1:] - inked[:-1] - 1
+    return int((gaps >= min_gap).sum())
+
+
+def scanned_has_tables(page, dpi=SCAN_TRIAGE_DPI):
+    """估计扫描页是否含表格
+
+    把页面渲染成低分辨率灰度图，满足以下任一条件即认为有表格：
+    至少 MIN_RULES 条贯穿大半页宽的横线（有边框的表格），
+    或至少 MIN_TABLE_BANDS 个水平条带中出现 MIN_GUTTERS 条以上的列间空白（无边框的检验单）。
+    正文段落的字间距远小于列间距，单栏、双栏正文都不会被误判。
+    """
+    # NumPy 只在遇到扫描页时才需要，不在启动时导入
+    import numpy as np
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+    ink = gray < INK_THRESHOLD
+    if not ink.any():
+        return False
+    rules = ink.mean(axis=1) >= RULE_FILL_RATIO
+    # 相邻的多行像素属于同一条横线
+    if int((rules[1:] & ~rules[:-1]).sum() + rules[0]) >= MIN_RULES:
+        return True
+    band = max(2, int(BAND_HEIGHT_INCH * dpi))
+    min_gap = max(2, int(MIN_GUTTER_INCH * dpi))
+    table_bands = 0
+    for top in range(0, pix.height, band):
+        rows = ink[top:top + band]
+        if _gutter_count(rows.any(axis=0), min_gap) >= MIN_GUTTERS:
+            table_bands += 1
+            if table_bands >= MIN_TABLE_BANDS:
+                return True
+    return False
+
+
+def classify_page(page, detect_scanned_tables=False):
+    """判断页面走文字层直取还是 OCR，返回 (方式, 统计信息)
+
+    文字层足量、乱码少、不是整页图片且没有表格（表格交给 docling 还原结构）时直接提取文字。
+    统计信息中的 page_class 为页面类型；detect_scanned_tables=True 时还会估计扫描页是否含表格。
+    """
+    stats = text_layer_stats(page)
+    usable = (
+        stats['chars'] >= MIN_TEXT_CHARS
+        and stats['garbage_ratio'] <= MAX_GARBAGE_RATIO
+        and stats['image_coverage'] <= MAX_IMAGE_COVERAGE
+        and stats['text_coverage'] >= MIN_TEXT_COVERAGE
+    )
+    if usable:
+        stats['tables'] = has_tables(page)
+        stats['page_class'] = PAGE_TABLES if stats['tables'] else PAGE_PROSE
+    else:
+        stats['tables'] = scanned_has_tables(page) if detect_scanned_tables else None
+        stats['page_class'] = PAGE_SCANNED
+    return (METHOD_TEXT_LAYER if stats['page_class'] == PAGE_PROSE else METHOD_OCR), stats
+
+
+def _is_cjk(ch):
+    return '\u4e00' <= ch <= '\u9fff' or '\u3000' <= ch <= '\u303f' or '\uff00' <= ch <= '\uffef'
+
+
+def _join_lines(lines):
+    """合并块内折行：与中文相接处直接相连，其余以空格分隔"""
+    text = ""
+    for line in lines:
+        if text and not (_is_cjk(text[-1]) or _is_cjk(line[0])):
+            text += " "
+        text += line
+    return text
+
+
+def page_text_markdown(page):
+    """按阅读顺序提取页面文字块，块之间以空行分隔，作为该页的 Markdown"""
+    blocks = page.get_text("blocks", sort=True)
+    paragraphs = []
+    for block in blocks:
+        if block[6] != 0:
+            continue
+        text = _join_lines([line.strip() for line in block[4].splitlines() if line.strip()])
+        if text:
+            paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+
+def triage_pages(pdf_path, pages, detect_scanned_tables=False):
+    """对给定页码（从 1 开始）逐页分类，返回 {页码: (方式, 统计信息)}"""
+    with fitz.open(pdf_path) as doc:
+        return {page_no: classify_page(doc.load_page(page_no - 1), detect_scanned_tables) for page_no in pages}
+
+
+def extract_text_layer(pdf_path, pages):
+    """直接从文字层提取给定页码的文本，返回 {页码: Markdown}"""
+    with fitz.open(pdf_path) as doc:
+        return {page_no: page_text_markdown(doc.load_page(page_no - 1)) for page_no in pages}
@@ -1,6 +1,266 @@
-from PyQt5.QtWidgets import QDialog, QVBoxLayout, QScrollArea, QWidget, QLabel, QPushButton
-from PyQt5.QtGui import QImage, QPixmap, QPainter, QColor
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QPushButton, QListView, QStyledItemDelegate, QAbstractItemView
+from PyQt5.QtGui import QImage, QPixmap, QColor, QPen
+from PyQt5.QtCore import Qt, QObject, QAbstractListModel, QModelIndex, QSize, QRect, QTimer, pyqtSignal
 import fitz
+from config import PDF_PIXMAP_CACHE_MB
+from instrumentation import span
+
+THUMBNAIL_ZOOM = 0.25  # 先渲染的低分辨率缩略图
+PAGE_ZOOM = 1.0        # 显示时的清晰度，与原先 get_pixmap() 的默认分辨率一致
+PAGE_SPACING = 8
+
+
+class PixmapCache:
+    """按占用字节数限制大小的 LRU 像素图缓存（仅在界面线程中使用）"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def _size(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth() // 8, 1)
+
+    def get(self, key):
+        pixmap = self._items.get(key)
+        if pixmap is not None:
+            self._items.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._bytes -= self._size(old)
+        self._items[key] = pixmap
+        self._bytes += self._size(pixmap)
+        while self._bytes > self.max_bytes and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self._bytes -= self._size(evicted)
+
+    def clear(self):
+        self._items.clear()
+        self._bytes = 0
+
+
+class PageRenderer(QObject):
+    """在后台线程中用 fitz 渲染页面
+
+    渲染线程独占自己打开的 fitz 文档；请求按优先级（缩略图优先）与提交先后排序，
+    已经过期的请求（页面滚出视野）会被 discard 掉。渲染结果以 QImage 形式通过信号送回界面线程。
+    """
+    rendered = pyqtSignal(int, float, QImage)
+
+    def __init__(self, pdf_path, parent=None):
+        super().__init__(parent)
+        self.pdf_path = pdf_path
+        self._cond = threading.Condition()
+        self._heap = []
+        self._pending = set()
+        self._order = itertools.count()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="pdf-render", daemon=True)
+        self._thread.start()
+
+    def request(self, page_num, zoom, priority=1):
+        key = (page_num, zoom)
+        with self._cond:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            # 后提交的请求排在前面：最新滚动到的页面先渲染
+            heapq.heappush(self._heap, (priority, -next(self._order), page_num, zoom))
+            self._cond.notify()
+
+    def discard(self, keep):
+        """丢弃不在 keep 中的待渲染页面"""
+        with self._cond:
+            self._heap = [item for item in self._heap if item[2] in keep]
+            heapq.heapify(self._heap)
+            self._pending = {(item[2], item[3]) for item in self._heap}
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        doc = fitz.open(self.pdf_path)
+        try:
+            while True:
+                with self._cond:
+                    while not self._heap and not self._stopped:
+                        self._cond.wait()
+                    if self._stopped:
+                        return
+                    _, _, page_num, zoom = heapq.heappop(self._heap)
+                    self._pending.discard((page_num, zoom))
+                with span("viewer.render_page", page=page_num + 1, zoom=round(zoom, 3)):
+                    pix = doc.load_page(page_num).get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                    # 拷贝一份，fitz 的像素缓冲区随 pix 一起释放
+                    image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888).copy()
+                self.rendered.emit(page_num, zoom, image)
+        finally:
+            doc.close()
+
+
+class PdfPageModel(QAbstractListModel):
+    """PDF 页面列表模型：只有视图实际绘制到的页面才会触发渲染"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.page_sizes = []
+        self.renderer = None
+        self.cache = PixmapCache(PDF_PIXMAP_CACHE_MB * 1024 * 1024)
+        self.selected_pages = set()
+
+    def set_document(self, pdf_path):
+        self.beginResetModel()
+        self._stop_renderer()
+        self.cache.clear()
+        self.selected_pages = set()
+        # 只读取页面尺寸用于布局，不做任何渲染
+        with fitz.open(pdf_path) as doc:
+            self.page_sizes = [(page.rect.width, page.rect.height) for page in doc]
+        self.renderer = PageRenderer(pdf_path)
+        self.renderer.rendered.connect(self._on_rendered)
+        self.endResetModel()
+
+    def clear_document(self):
+        self.beginResetModel()
+        self._stop_renderer()
+        self.cache.clear()
+        self.page_sizes = []
+        self.selected_pages = set()
+        self.endResetModel()
+
+    def _stop_renderer(self):
+        if self.renderer is not None:
+            self.renderer.rendered.disconnect(self._on_rendered)
+            self.renderer.stop()
+            self.renderer = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.page_sizes)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.SizeHintRole:
+            width, height = self.page_sizes[index.row()]
+            return QSize(int(width * PAGE_ZOOM), int(height * PAGE_ZOOM))
+        return None
+
+    def pixmap(self, page_num, sharp=True):
+        """返回已缓存的最佳像素图；缺失时提交渲染请求（缩略图优先）"""
+        full = self.cache.get((page_num, PAGE_ZOOM))
+        if full is not None:
+            return full
+        thumbnail = self.cache.get((page_num, THUMBNAIL_ZOOM))
+        if self.renderer is not None:
+            if thumbnail is None:
+                self.renderer.request(page_num, THUMBNAIL_ZOOM, priority=0)
+            if sharp:
+                self.renderer.request(page_num, PAGE_ZOOM, priority=1)
+        return thumbnail
+
+    def _on_rendered(self, page_num, zoom, image):
+        # 忽略已被替换的文档在切换前排队送达的结果
+        if self.sender() is not self.renderer:
+            return
+        self.cache.put((page_num, zoom), QPixmap.fromImage(image))
+        index = self.index(page_num)
+        self.dataChanged.emit(index, index)
+
+
+class PdfPageDelegate(QStyledItemDelegate):
+    """绘制页面像素图，选中状态以叠加边框表示，不修改缓存中的像素图"""
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+
+    def sizeHint(self, option, index):
+        size = index.data(Qt.SizeHintRole)
+        return QSize(size.width(), size.height() + PAGE_SPACING)
+
+    def paint(self, painter, option, index):
+        model = index.model()
+        page_num = index.row()
+        size = index.data(Qt.SizeHintRole)
+        target = QRect(option.rect.x(), option.rect.y(), size.width(), size.height())
+        pixmap = model.pixmap(page_num, sharp=not self.view.is_scrolling())
+        if pixmap is not None:
+            painter.drawPixmap(target, pixmap)
+        else:
+            painter.fillRect(target, QColor("white"))
+        if page_num in model.selected_pages:
+            painter.save()
+            painter.setPen(QPen(QColor("blue"), 3))
+            painter.drawRect(target.adjusted(1, 1, -2, -2))
+            painter.restore()
+
+
+class PdfPageView(QListView):
+    """虚拟化的 PDF 页面列表：只渲染可见页面，滚动停止后再补清晰版本"""
+    page_clicked = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.page_model = PdfPageModel(self)
+        self.setModel(self.page_model)
+        self.setItemDelegate(PdfPageDelegate(self))
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSpacing(0)
+        self._scrolling = False
+        self._scroll_timer = QTimer(self)
+        self._scroll_timer.setSingleShot(True)
+        self._scroll_timer.setInterval(150)
+        self._scroll_timer.timeout.connect(self._on_scroll_settled)
+        self.verticalScrollBar().valueChanged.connect(self._on_scrolled)
+        self.clicked.connect(lambda index: self.page_clicked.emit(index.row()))
+
+    def set_document(self, pdf_path):
+        self.page_model.set_document(pdf_path)
+
+    def clear_document(self):
+        self.page_model.clear_document()
+
+    def is_scrolling(self):
+        return self._scrolling
+
+    def _visible_rows(self):
+        rows = set()
+        viewport = self.viewport().rect()
+        index = self.indexAt(viewport.topLeft())
+        row = index.row() if index.isValid() else 0
+        while 0 <= row < self.page_model.rowCount():
+            rect = self.visualRect(self.page_model.index(row))
+            if rect.top() > viewport.bottom():
+                break
+            rows.add(row)
+            row += 1
+        return rows
+
+    def _on_scrolled(self):
+        # 滚动过程中只请求缩略图，并丢弃已滚出视野的渲染请求
+        self._scrolling = True
+        self._scroll_timer.start()
+        if self.page_model.renderer is not None:
+            self.page_model.renderer.discard(self._visible_rows())
+
+    def _on_scroll_settled(self):
+        self._scrolling = False
+        self.viewport().update()
+
+    def refresh_page(self, page_num):
+        self.update(self.page_model.index(page_num))
+
 
 class PdfViewerDialog(QDialog):
     # 现有的PdfViewerDialog类
@@ -9,36 +269,26 @@ class PdfViewerDialog(QDialog):
         self.setWindowTitle("PDF 浏览器")
         self.setGeometry(100, 100, 800, 600)
         self.selected_pages = set()
-        
+
         layout = QVBoxLayout()
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.content_widget = QWidget()
-        self.content_layout = QVBoxLayout()
-        self.content_widget.setLayout(self.content_layout)
-        self.scroll_area.setWidget(self.content_widget)
-        layout.addWidget(self.scroll_area)
-        
+        self.page_view = PdfPageView()
+        self.page_view.page_clicked.connect(self.toggle_page_selection)
+        layout.addWidget(self.page_view)
+
         self.load_pdf_pages(pdf_path)
-        
+
         self.select_button = QPushButton("确认选择")
         self.select_button.clicked.connect(self.accept)
         layout.addWidget(self.select_button)
-        
+
         self.setLayout(layout)
 
     def load_pdf_pages(self, pdf_path):
-        doc = fitz.open(pdf_path)
-        for i in range(len(doc)):
-            page = doc.load_page(i)
-            pix = page.get_pixmap()
-            image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
-            label = QLabel()
-            label.setPixmap(QPixmap.fromImage(image))
-            label.mousePressEvent = lambda event, page_num=i: self.toggle_page_selection(event, page_num)
-            self.content_layout.addWidget(label)
-
-    def toggle_page_selection(self, event, page_num):
+        # 页面按需在后台渲染，这里只建立页面列表
+        self.page_view.set_document(pdf_path)
+        self.page_view.page_model.selected_pages = self.selected_pages
+
+    def toggle_page_selection(self, page_num):
         if page_num in self.selected_pages:
             self.selected_pages.remove(page_num)
         else:
@@ -46,18 +296,13 @@ class PdfViewerDialog(QDialog):
         self.update_page_highlight(page_num)
 
     def update_page_highlight(self, page_num):
-        item = self.content_layout.itemAt(page_num)
-        label = item.widget()
-        pixmap = label.pixmap()
-        painter = QPainter(pixmap)
-        if page_num in self.selected_pages:
-            painter.setPen(QColor("blue"))
-            painter.drawRect(0, 0, pixmap.width() - 1, pixmap.height() - 1)
-        else:
-            painter.setPen(QColor("transparent"))
-            painter.drawRect(0, 0, pixmap.width() - 1, pixmap.height() - 1)
-        painter.end()
-        label.setPixmap(pixmap)
+        # 选中边框由委托在绘制时叠加，只需重绘该页
+        self.page_view.refresh_page(page_num)
 
     def select_pages(self):
-        self.accept()
\ No newline at end of file
+        self.accept()
+
+    def done(self, result):
+        # 关闭对话框时停止渲染线程并关闭 fitz 文档
+        self.page_view.clear_document()
+        super().done(result)
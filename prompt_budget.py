@@ -0,0 +1,244 @@
+"""提示词预算：按 token 计量文本、压缩 OCR 噪声，并按模型的上下文窗口切分"""
+import math
+import os
+import re
+import threading
+
+from ocr_utils import PAGE_MARKER_RE
+from config import (PROMPT_TOKENIZER, LLM_CONTEXT_TOKENS, PROMPT_MAX_TOKENS, PROMPT_SAFETY_TOKENS,
+                    PROMPT_COMPRESSION)
+
+# 未在 LLM_CONTEXT_TOKENS 中列出的模型按此窗口计算
+DEFAULT_CONTEXT_TOKENS = 65536
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+# 超过该长度的行不视为页眉页脚
+BOILERPLATE_MAX_CHARS = 60
+
+_IMAGE_PLACEHOLDER = re.compile(r'^\s*<!-- image -->\s*$', re.MULTILINE)
+_SEPARATOR_CELL = re.compile(r'^:?-+:?$')
+_PAGE_NUMBER = re.compile(r'[第共]\s*\d+\s*页|\bpage\s*\d+(\s*of\s*\d+)?|^[-—\s]*\d+(\s*/\s*\d+)?[-—\s]*$',
+                          re.IGNORECASE)
+_ESTIMATE_TOKEN = re.compile(r'[一-鿿]|[A-Za-z]+|\d+|[^\sA-Za-z\d一-鿿]')
+
+_tokenizer_lock = threading.Lock()
+_encoder = None
+_encoder_loaded = False
+
+
+def parse_context_tokens(spec):
+    """解析 "模型:窗口,模型:窗口" 形式的配置"""
+    windows = {}
+    for entry in spec.split(','):
+        model, _, size = entry.strip().partition(':')
+        if model and size.strip().isdigit():
+            windows[model.strip()] = int(size)
+    return windows
+
+
+CONTEXT_WINDOWS = parse_context_tokens(LLM_CONTEXT_TOKENS)
+
+
+def _load_encoder():
+    """按 PROMPT_TOKENIZER 加载分词器，返回 encode(text) -> 列表；不可用时返回 None"""
+    spec = PROMPT_TOKENIZER
+    if spec.startswith('tiktoken:'):
+        try:
+            import tiktoken
+            return tiktoken.get_encoding(spec[len('tiktoken:'):]).encode_ordinary
+        except Exception:
+            return None
+    if spec and os.path.exists(spec):
+        try:
+            from tokenizers import Tokenizer
+            tokenizer = Tokenizer.from_file(spec)
+            return lambda text: tokenizer.encode(text, add_special_tokens=False).ids
+        except Exception:
+            return None
+    return None
+
+
+def _get_encoder():
+    global _encoder, _encoder_loaded
+    if not _encoder_loaded:
+        with _tokenizer_lock:
+            if not _encoder_loaded:
+                _encoder = _load_encoder()
+                _encoder_loaded = True
+    return _encoder
+
+
+def tokenizer_name():
+    """当前使用的分词器，写入埋点与基准测试结果"""
+    return PROMPT_TOKENIZER if _get_encoder() is not None else 'estimate'
+
+
+def _estimate_tokens(text):
+    total = 0
+    for match in _ESTIMATE_TOKEN.finditer(text):
+        piece = match.group(0)
+        if piece[0].isascii() and piece[0].isalnum():
+            total += math.ceil(len(piece) / 4) if piece[0].isalpha() else math.ceil(len(piece) / 3)
+        else:
+            total += 1
+    return total
+
+
+def count_tokens(text):
+    """文本的 token 数"""
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder(text))
+    return _estimate_tokens(text)
+
+
+def count_message_tokens(messages):
+    """一组对话消息的提示词 token 数"""
+    return sum(count_tokens(message.get('content') or "") + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def context_window(model):
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_TOKENS)
+
+
+def prompt_budget(model, max_tokens=None):
+    """一次请求中提示词可用的 token 数：上下文窗口减去输出上限与安全余量，且不超过 PROMPT_MAX_TOKENS"""
+    budget = context_window(model) - (max_tokens or 0) - PROMPT_SAFETY_TOKENS
+    if PROMPT_MAX_TOKENS > 0:
+        budget = min(budget, PROMPT_MAX_TOKENS)
+    return max(0, budget)
+
+
+def fits_budget(messages, model, max_tokens=None):
+    return count_message_tokens(messages) <= prompt_budget(model, max_tokens)
+
+
+def split_at_tokens(text, max_tokens):
+    """把 text 切成 (不超过 max_tokens 的前半部分, 剩余部分)，尽量在空白处断开"""
+    if count_tokens(text) <= max_tokens:
+        return text, ""
+    low, high = 1, len(text)
+    # 二分查找满足预算的最长前缀
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    cut = low
+    space = max(text.rfind(' ', 0, cut), text.rfind('\t', 0, cut))
+    if space > cut // 2:
+        cut = space + 1
+    return text[:cut], text[cut:]
+
+
+def _edge_lines(lines, edge):
+    """页面开头与结尾各 edge 个非空行的下标（不含页码标记与表格行）"""
+    candidates = [i for i, line in enumerate(lines)
+                  if line.strip() and not PAGE_MARKER_RE.fullmatch(line.strip()) and not line.lstrip().startswith('|')]
+    return set(candidates[:edge] + candidates[-edge:])
+
+
+def _boilerplate_key(line):
+    """页眉页脚的比较键：只考虑短行；页码行中的数字每页不同，比较时统一替换，其余行须逐字相同"""
+    stripped = re.sub(r'\s+', ' ', line.strip().strip('#').strip())
+    if not stripped or len(stripped) > BOILERPLATE_MAX_CHARS:
+        return None
+    # 页码之外不能再有数字，以免把“第 2 页 血红蛋白 98”这类正文当成页脚
+    if _PAGE_NUMBER.search(stripped) and not re.search(r'\d', _PAGE_NUMBER.sub('', stripped)):
+        return re.sub(r'\d+', '#', stripped)
+    return stripped
+
+
+def strip_repeated_lines(text, min_pages=3, ratio=0.5, edge=3):
+    """去掉在多数页面开头或结尾重复出现的行（页眉、页脚、“第 x 页 共 y 页”等）
+
+    只在每页首尾 edge 行内查找不超过 BOILERPLATE_MAX_CHARS 字的短行，且该行需出现在至少 min_pages 页、
+    不少于 ratio 比例的页面上；除页码行外须逐字相同，避免误删每页格式相同但数值不同的检验记录。
+    """
+    pages = []
+    current = []
+    for line in text.split('\n'):
+        if PAGE_MARKER_RE.fullmatch(line.strip()) and current:
+            pages.append(current)
+            current = []
+        current.append(line)
+    pages.append(current)
+    if len(pages) < min_pages:
+        return text
+
+    seen = {}
+    page_edges = []
+    for lines in pages:
+        edges = _edge_lines(lines, edge)
+        page_edges.append(edges)
+        for key in {_boilerplate_key(lines[i]) for i in edges} - {None}:
+            seen[key] = seen.get(key, 0) + 1
+    threshold = max(min_pages, math.ceil(ratio * len(pages)))
+    repeated = {key for key, count in seen.items() if count >= threshold}
+    if not repeated:
+        return text
+
+    kept = []
+    for lines, edges in zip(pages, page_edges):
+        kept.extend(line for i, line in enumerate(lines)
+                    if i not in edges or _boilerplate_key(line) not in repeated)
+    return '\n'.join(kept)
+
+
+def _compact_table(rows):
+    """压缩一个 Markdown 表格：去掉对齐空格、全空的行与列，以及与左侧完全相同的重复列"""
+    cells = [[cell.strip() for cell in row.strip().strip('|').split('|')] for row in rows]
+    width = max(len(row) for row in cells)
+    cells = [row + [''] * (width - len(row)) for row in cells]
+    separators = [all(_SEPARATOR_CELL.match(cell) for cell in row if cell) and any(row) for row in cells]
+    data = [row for row, separator in zip(cells, separators) if not separator]
+
+    columns = []
+    for column in range(width):
+        values = [row[column] for row in data]
+        if not any(values):
+            continue
+        if columns and values == [row[columns[-1]] for row in data]:
+            continue
+        columns.append(column)
+    if not columns:
+        return []
+
+    compacted = []
+    for row, separator in zip(cells, separators):
+        if separator:
+            compacted.append('|' + '|'.join('-' for _ in columns) + '|')
+        elif any(row[column] for column in columns):
+            compacted.append('|' + '|'.join(row[column] for column in columns) + '|')
+    return compacted
+
+
+def compact_tables(text):
+    """压缩文本中的所有 Markdown 表格"""
+    lines = text.split('\n')
+    output = []
+    table = []
+    for line in lines + ['']:
+        if line.lstrip().startswith('|'):
+            table.append(line)
+            continue
+        if table:
+            output.extend(_compact_table(table))
+            table = []
+        output.append(line)
+    output.pop()
+    return '\n'.join(output)
+
+
+def compress_markdown(text):
+    """压缩 docling 导出的 Markdown，减少提示词 token 而不丢失临床信息；PROMPT_COMPRESSION=0 时原样返回"""
+    if not PROMPT_COMPRESSION or not text:
+        return text
+    text = _IMAGE_PLACEHOLDER.sub('', text)
+    text = strip_repeated_lines(text)
+    text = compact_tables(text)
+    text = re.sub(r'[ \t]+\n', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
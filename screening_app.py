@@ -1,18 +1,133 @@
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QPushButton, 
-                           QTextEdit, QFileDialog, QLabel, QHBoxLayout, QSplitter, QDialog, QListWidget, QScrollArea, QStackedLayout, QTextBrowser)
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QImage, QPixmap
-from pdf_viewer import PdfViewerDialog
-from ocr_utils import extract_text_from_pdf
-from api_utils import extract_criteria_from_text, analyze_patient_criteria, organize_patient_case
+                           QTextEdit, QFileDialog, QLabel, QHBoxLayout, QSplitter, QDialog, QListWidget, QStackedLayout, QTextBrowser,
+                           QListWidgetItem, QProgressBar, QCheckBox, QTableWidget, QTableWidgetItem, QHeaderView)
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QTextCursor, QTextDocument, QTextDocumentFragment
+from pdf_viewer import PdfViewerDialog, PdfPageView
+from ocr_utils import (extract_text_from_pdf, init_ocr_worker, iter_pdf_pages, conversion_message, PAGE_MARKER,
+                       prewarm_converters)
+from api_utils import extract_criteria_from_text, organize_patient_case, screen_patient
+from service_client import ScreeningServiceClient
+from jobs import JobScheduler, JobCancelled, StreamBuffer
+from analysis_engine import VerdictMemo, extract_conclusion
+from ocr_cache import file_sha256
+from workspace_store import (get_workspace_store, content_hash, DOC_PROTOCOL, DOC_CRITERIA, DOC_COMPILED, DOC_CASE,
+                             DOC_ORGANIZED, DOC_ANALYSIS)
+from instrumentation import span, log_event, stage_summary
+from config import GUI_OCR_PROCESSES, SCREENING_SERVICE_URL, WORKSPACE_ENABLED
+import json
+import os
+import sqlite3
 import sys
-import fitz
+import threading
+import time
+from functools import partial
+
+JOB_STATE_LABELS = {
+    'queued': '排队中',
+    'running': '进行中',
+    'finished': '已完成',
+    'failed': '失败',
+    'cancelled': '已取消',
+}
+
+class SessionsDialog(QDialog):
+    """历史会话列表：只读取会话元数据，双击或点“打开”后才加载会话内容"""
+
+    def __init__(self, store, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.selected_session = None
+        self.deleted = set()
+        self.setWindowTitle("历史会话")
+        self.resize(680, 420)
+        
+        layout = QVBoxLayout()
+        self.session_list = QListWidget()
+        self.session_list.itemDoubleClicked.connect(self.accept_selected)
+        layout.addWidget(self.session_list)
+        self.info_label = QLabel("")
+        layout.addWidget(self.info_label)
+        
+        buttons_layout = QHBoxLayout()
+        open_button = QPushButton("打开")
+        open_button.clicked.connect(self.accept_selected)
+        buttons_layout.addWidget(open_button)
+        delete_button = QPushButton("删除")
+        delete_button.clicked.connect(self.delete_selected)
+        buttons_layout.addWidget(delete_button)
+        close_button = QPushButton("关闭")
+        close_button.clicked.connect(self.reject)
+        buttons_layout.addWidget(close_button)
+        layout.addLayout(buttons_layout)
+        self.setLayout(layout)
+        self.refresh()
+
+    def refresh(self):
+        self.session_list.clear()
+        for session in self.store.list_sessions():
+            updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(session['updated_at']))
+            text = f"{updated}  {session['title']}"
+            if session['summary']:
+                text += f"  —— {session['summary'][:60]}"
+            item = QListWidgetItem(text)
+            item.setData(Qt.UserRole, session['id'])
+            item.setToolTip("\n".join(filter(None, [session['protocol_path'], session['case_path'],
+                                                     session['summary']])))
+            self.session_list.addItem(item)
+        stats = self.store.stats()
+        self.info_label.setText(
+            f"共 {stats['sessions']} 个会话，占用 {stats['size_bytes'] / 1024 / 1024:.1f} MB"
+            f"（上限 {stats['max_bytes'] / 1024 / 1024:.0f} MB）"
+        )
+
+    def accept_selected(self, *args):
+        item = self.session_list.currentItem()
+        if item is not None:
+            self.selected_session = item.data(Qt.UserRole)
+            self.accept()
+
+    def delete_selected(self):
+        item = self.session_list.currentItem()
+        if item is not None:
+            self.store.delete_session(item.data(Qt.UserRole))
+            self.deleted.add(item.data(Qt.UserRole))
+            self.refresh()
 
 class ScreeningApp(QWidget):
+    # OCR 模型预热结束：错误信息（成功时为空）, 耗时秒数；由预热线程发出，在主线程处理
+    prewarm_done = pyqtSignal(str, float)
+
     def __init__(self):
         super().__init__()
         self.criteria_text = ""
         self.current_pdf_path = None
+        # 后台任务：OCR 与模型调用分别排队，界面线程不再被阻塞
+        self.scheduler = JobScheduler(process_workers=GUI_OCR_PROCESSES, process_initializer=init_ocr_worker)
+        self.scheduler.queue_changed.connect(self.refresh_job_list)
+        # 配置了筛查服务时作为其客户端：OCR 与模型调用交给服务，本机不加载 OCR 模型
+        self.service = ScreeningServiceClient() if SCREENING_SERVICE_URL else None
+        # 每次加载新方案/新病例时递增，旧任务的结果不再写回当前界面
+        self.protocol_generation = 0
+        self.case_generation = 0
+        self.job_results = {}
+        self.displayed_job_id = None
+        # 当前方案 / 病例的识别任务：OCR 通道同时只运行一个任务，加载新文件时先取消旧的识别
+        self.protocol_ocr_job = None
+        self.case_ocr_job = None
+        # 增量重新分析：上一版入排标准的编译结果，以及各条目在各病例分块上的判定
+        self.last_compiled = None
+        self.verdict_memo = VerdictMemo()
+        # 病例逐页识别：已识别的各页依次放入 case_feed，整理病例可以在识别完成前开始
+        self.case_feed = None
+        self.case_organizing = False
+        # 病例文本框对应的 Markdown 原文（含页码标记）：文本框的 toMarkdown() 会丢掉 HTML 注释，
+        # 分析与整理都以原文为准
+        self.case_markdown = ""
+        self.ocr_ready = False
+        self.prewarm_done.connect(self.on_prewarm_done)
+        # 当前会话在工作区中的编号：第一次保存内容时创建，重新开始后换成新会话
+        self.session_id = None
         self.initUI()
     
     def initUI(self):
@@ -45,6 +160,35 @@ class ScreeningApp(QWidget):
         self.status_label = QLabel("")
         left_layout.addWidget(self.status_label)
         
+        # 任务进度与任务队列
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setVisible(False)
+        left_layout.addWidget(self.progress_bar)
+        
+        left_layout.addWidget(QLabel("任务队列"))
+        self.job_list = QListWidget()
+        self.job_list.setMaximumHeight(150)
+        self.job_list.itemClicked.connect(self.show_job_result)
+        left_layout.addWidget(self.job_list)
+        
+        # 取消所选任务（未选择时取消全部进行中的任务）
+        self.stop_button = QPushButton("取消任务")
+        self.stop_button.clicked.connect(self.cancel_jobs)
+        left_layout.addWidget(self.stop_button)
+        
+        # 阶段耗时面板：各阶段的次数与耗时（秒），定时刷新
+        left_layout.addWidget(QLabel("阶段耗时"))
+        self.stage_table = QTableWidget(0, 6)
+        self.stage_table.setHorizontalHeaderLabels(["阶段", "次数", "最近", "平均", "P95", "累计"])
+        self.stage_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.stage_table.verticalHeader().setVisible(False)
+        self.stage_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.stage_table.setMaximumHeight(180)
+        left_layout.addWidget(self.stage_table)
+        self.stage_timer = QTimer(self)
+        self.stage_timer.timeout.connect(self.refresh_stage_table)
+        self.stage_timer.start(1000)
+        
         left_widget.setLayout(left_layout)
         
         # 右侧面板 - 患者病例
@@ -84,18 +228,9 @@ class ScreeningApp(QWidget):
         self.case_text_edit.setOpenLinks(True)  # 允许打开链接
         self.case_stack.addWidget(self.case_text_edit)
         
-        # PDF显示模式
-        pdf_widget = QWidget()
-        pdf_layout = QVBoxLayout()
-        self.pdf_scroll = QScrollArea()
-        self.pdf_scroll.setWidgetResizable(True)
-        self.pdf_content = QWidget()
-        self.pdf_layout = QVBoxLayout()
-        self.pdf_content.setLayout(self.pdf_layout)
-        self.pdf_scroll.setWidget(self.pdf_content)
-        pdf_layout.addWidget(self.pdf_scroll)
-        pdf_widget.setLayout(pdf_layout)
-        self.case_stack.addWidget(pdf_widget)
+        # PDF显示模式（只渲染可见页面）
+        self.pdf_view = PdfPageView()
+        self.case_stack.addWidget(self.pdf_view)
         
         right_layout.addLayout(self.case_stack)
         
@@ -118,15 +253,25 @@ class ScreeningApp(QWidget):
         self.classify_case_button.clicked.connect(self.classify_case)
         right_layout.addWidget(self.classify_case_button)
         
+        # 勾选后忽略已缓存的模型响应，重新请求并覆盖缓存
+        self.refresh_cache_checkbox = QCheckBox("忽略缓存，重新请求模型")
+        right_layout.addWidget(self.refresh_cache_checkbox)
+        
         self.result_text_edit = QTextEdit()
         self.result_text_edit.setPlaceholderText("分析结果将显示在这里")
         right_layout.addWidget(self.result_text_edit)
         
-        # 添加重启按钮
+        # 添加重启按钮与历史会话按钮
+        session_layout = QHBoxLayout()
         self.restart_button = QPushButton("重新开始")
         self.restart_button.clicked.connect(self.restart)
         self.restart_button.setStyleSheet("background-color: #ffb1a3;")  # 设置红色背景
-        right_layout.addWidget(self.restart_button)
+        session_layout.addWidget(self.restart_button)
+        self.history_button = QPushButton("历史会话")
+        self.history_button.clicked.connect(self.show_sessions)
+        self.history_button.setEnabled(WORKSPACE_ENABLED)
+        session_layout.addWidget(self.history_button)
+        right_layout.addLayout(session_layout)
         
         right_widget.setLayout(right_layout)
         
@@ -145,27 +290,43 @@ class ScreeningApp(QWidget):
             if dialog.exec_() == QDialog.Accepted:
                 # 将页码从0开始转换为1开始
                 selected_pages = [page + 1 for page in dialog.selected_pages]
-                print(f"Selected pages: {selected_pages}")  # 添加调试信息
+                log_event("app.pages_selected", level="debug", pages=selected_pages)
                 
-                # 获取页码范围
+                # 只识别选中的页面（而不是最小到最大页码之间的全部页面）
                 if selected_pages:
-                    page_range = (min(selected_pages), max(selected_pages))
-                    print(f"Page range: {page_range}")  # 打印页码范围
-                    result = extract_text_from_pdf(file_path, page_range=page_range)
+                    self.protocol_generation += 1
+                    generation = self.protocol_generation
                     
-                    if result['success']:
-                        self.criteria_text_edit.setPlainText(result['text'])
-                        
-                        # 设置状态提示
-                        if result['is_filtered']:
-                            self.status_label.setText(result['message'])
-                            self.status_label.setStyleSheet("color: green;")
+                    def on_finished(result):
+                        if generation != self.protocol_generation:
+                            return
+                        if result['success']:
+                            self.criteria_text_edit.setPlainText(result['text'])
+                            protocol_hash = result['sha256']
+                            self._save_document(
+                                DOC_PROTOCOL, result['text'], content_hash(protocol_hash, str(selected_pages)),
+                                protocol_path=file_path, protocol_hash=protocol_hash
+                            )
+                            
+                            # 设置状态提示
+                            if result['is_filtered']:
+                                self.status_label.setText(result['message'])
+                                self.status_label.setStyleSheet("color: green;")
+                            else:
+                                self.status_label.setText(result['message'])
+                                self.status_label.setStyleSheet("color: blue;")
                         else:
                             self.status_label.setText(result['message'])
-                            self.status_label.setStyleSheet("color: blue;")
-                    else:
-                        self.status_label.setText(result['message'])
-                        self.status_label.setStyleSheet("color: red;")
+                            self.status_label.setStyleSheet("color: red;")
+                    
+                    self.status_label.setText("正在识别方案 PDF...")
+                    self.status_label.setStyleSheet("color: blue;")
+                    self._cancel_job(self.protocol_ocr_job)
+                    self.protocol_ocr_job = self._submit_job(
+                        'ocr', f"识别方案 {os.path.basename(file_path)}",
+                        lambda job: self._run_ocr(job, file_path, pages=selected_pages),
+                        on_finished=on_finished
+                    )
     
     def extract_criteria(self):
         """提取入排标准"""
@@ -177,62 +338,99 @@ class ScreeningApp(QWidget):
             
         self.status_label.setText("正在连接 DeepSeek 服务器，请稍候...")
         self.status_label.setStyleSheet("color: blue;")
-        QApplication.processEvents()  # 立即更新界面
+        generation = self.protocol_generation
         
-        success, result = extract_criteria_from_text(text)
+        def on_partial(content):
+            # 流式输出：提取结果边生成边显示在入排标准框中
+            if generation == self.protocol_generation:
+                self._show_streamed(self.criteria_text_edit, content)
         
-        if success:
-            self.criteria_text = result
-            self.criteria_text_edit.setPlainText(self.criteria_text)
-            self.status_label.setText("入排标准提取成功！")
-            self.status_label.setStyleSheet("color: green;")
-        else:
-            self.status_label.setText(f"错误：{result}")
-            self.status_label.setStyleSheet("color: red;")
+        def on_finished(outcome):
+            if generation != self.protocol_generation:
+                return
+            success, result = outcome
+            if success:
+                self.criteria_text = result
+                self.criteria_text_edit.setPlainText(self.criteria_text)
+                self._save_document(DOC_CRITERIA, result, content_hash(text))
+                self.status_label.setText("入排标准提取成功！")
+                self.status_label.setStyleSheet("color: green;")
+            else:
+                # 失败或取消时恢复原文
+                self.criteria_text_edit.setPlainText(text)
+                self.status_label.setText(f"错误：{result}")
+                self.status_label.setStyleSheet("color: red;")
+        
+        refresh = self.refresh_cache_checkbox.isChecked()
+        extract = self.service.extract_criteria_from_text if self.service else extract_criteria_from_text
+        self._submit_job(
+            'llm', "提取入排标准",
+            lambda job: extract(
+                text, on_delta=lambda delta, content: job.emit_partial(content), cancel_event=job.cancel_event,
+                refresh=refresh
+            ),
+            on_finished=on_finished, on_partial=on_partial,
+            on_cancelled=lambda: on_finished((False, "已取消"))
+        )
     
     def load_case_pdf(self):
         """选择并加载病例 PDF"""
         file_path, _ = QFileDialog.getOpenFileName(self, "选择病例 PDF", "", "PDF Files (*.pdf)")
         if file_path:
             self.current_pdf_path = file_path
+            self.case_generation += 1
+            generation = self.case_generation
+            self._set_case_markdown("")
             
-            # 清除现有的PDF内容
-            for i in reversed(range(self.pdf_layout.count())): 
-                self.pdf_layout.itemAt(i).widget().setParent(None)
-            
-            # 加载PDF并显示
+            # 加载PDF并显示，页面在滚动到时才在后台渲染
             try:
-                doc = fitz.open(file_path)
-                for i in range(len(doc)):
-                    page = doc.load_page(i)
-                    pix = page.get_pixmap()
-                    image = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
-                    label = QLabel()
-                    label.setPixmap(QPixmap.fromImage(image))
-                    self.pdf_layout.addWidget(label)
-                doc.close()
+                self.pdf_view.set_document(file_path)
             except Exception as e:
                 self.status_label.setText(f"加载PDF失败：{str(e)}")
                 self.status_label.setStyleSheet("color: red;")
                 return
             
-            # 右上角患者病例转换全部页面
-            result = extract_text_from_pdf(file_path)
+            feed = StreamBuffer()
+            self.case_feed = feed
+            self.case_organizing = False
             
-            if result['success']:
-                # 设置Markdown内容
-                self.case_text_edit.setMarkdown(result['text'])
-                
-                # 设置状态提示
-                if result['is_filtered']:
-                    self.status_label.setText(result['message'])
-                    self.status_label.setStyleSheet("color: green;")
+            def on_partial(new_pages):
+                # 每识别完几页就追加显示；整理病例进行中时文本框显示整理结果，不再追加
+                if generation != self.case_generation:
+                    return
+                markdown = "\n\n".join(new_pages)
+                self.case_markdown = f"{self.case_markdown}\n\n{markdown}" if self.case_markdown else markdown
+                if not self.case_organizing:
+                    self._append_markdown(self.case_text_edit, markdown)
+                    self.case_text_edit.document().setModified(False)
+            
+            def on_finished(result):
+                if generation != self.case_generation:
+                    return
+                if result['success']:
+                    case_hash = result['sha256']
+                    self._save_document(DOC_CASE, result['text'], case_hash, title=os.path.basename(file_path),
+                                        case_path=file_path, case_hash=case_hash)
+                    # 设置状态提示
+                    if result['is_filtered']:
+                        self.status_label.setText(result['message'])
+                        self.status_label.setStyleSheet("color: green;")
+                    else:
+                        self.status_label.setText(result['message'])
+                        self.status_label.setStyleSheet("color: blue;")
                 else:
                     self.status_label.setText(result['message'])
-                    self.status_label.setStyleSheet("color: blue;")
-            else:
-                self.status_label.setText(result['message'])
-                self.status_label.setStyleSheet("color: red;")
+                    self.status_label.setStyleSheet("color: red;")
+            
+            # 右上角患者病例逐页识别全部页面（后台进行），识别一页显示一页
+            self.status_label.setText("正在识别病例 PDF...")
+            self.status_label.setStyleSheet("color: blue;")
+            self._cancel_job(self.case_ocr_job)
+            self.case_ocr_job = self._submit_job(
+                'ocr', f"识别病例 {os.path.basename(file_path)}",
+                lambda job: self._stream_ocr(job, file_path, feed),
+                on_finished=on_finished, on_partial=on_partial, on_cancelled=feed.close
+            )
 
     def toggle_view_mode(self):
         """切换显示模式"""
@@ -250,7 +448,7 @@ class ScreeningApp(QWidget):
         # 获取左侧的入排标准
         criteria = self.criteria_text_edit.toPlainText()
         # 获取右侧的患者病例
-        patient_case = self.case_text_edit.toMarkdown()  # 获取Markdown格式的文本
+        patient_case = self._case_markdown()
         
         if not criteria:
             self.status_label.setText("请先加载或输入入排标准！")
@@ -264,33 +462,63 @@ class ScreeningApp(QWidget):
         
         self.status_label.setText("正在连接 DeepSeek 服务器，请稍候...")
         self.status_label.setStyleSheet("color: blue;")
-        QApplication.processEvents()  # 立即更新界面
         
-        # 调用分析函数
-        result = analyze_patient_criteria(criteria, patient_case)
+        # 调用分析函数（后台进行），结果边生成边显示；分析期间可以继续加载下一份病例
+        case_name = os.path.basename(self.current_pdf_path) if self.current_pdf_path else "当前病例"
+        self.result_text_edit.clear()
+        job_holder = []
+        
+        def on_partial(content):
+            job_id = job_holder[0].job_id
+            self.job_results[job_id] = content
+            if self.displayed_job_id == job_id:
+                self._show_streamed(self.result_text_edit, content)
+        
+        def on_finished(result):
+            job_id = job_holder[0].job_id
+            self.job_results[job_id] = result if result else "无返回结果"
+            if self.displayed_job_id == job_id:
+                self.result_text_edit.setPlainText(self.job_results[job_id])
+            if result and not result.startswith("分析失败"):
+                self._save_analysis(criteria, patient_case, result)
+                self.status_label.setText(f"{case_name} 病例分析成功！")
+                self.status_label.setStyleSheet("color: green;")
+            else:
+                self.status_label.setText(f"{case_name} 分析失败，请查看详细信息")
+                self.status_label.setStyleSheet("color: red;")
         
-        if result and not result.startswith("分析失败"):
-            self.result_text_edit.setPlainText(result)
-            self.status_label.setText("病例分析成功！")
+        refresh = self.refresh_cache_checkbox.isChecked()
+        saved = self._load_saved_analysis(criteria, patient_case) if not refresh else None
+        if saved is not None:
+            # 入排标准与病例都没有改动，直接显示本会话中保存的分析结果
+            self.result_text_edit.setPlainText(saved)
+            self.status_label.setText(f"{case_name} 的入排标准与病例未改动，已显示保存的分析结果")
             self.status_label.setStyleSheet("color: green;")
-        else:
-            self.result_text_edit.setPlainText(result if result else "无返回结果")
-            self.status_label.setText("分析失败，请查看详细信息")
-            self.status_label.setStyleSheet("color: red;")
+            return
+        job = self._submit_job(
+            'llm', f"分析 {case_name}",
+            lambda job: self._analyze(job, criteria, patient_case, refresh),
+            on_finished=on_finished, on_partial=on_partial
+        )
+        job_holder.append(job)
+        self.displayed_job_id = job.job_id
 
     def restart(self):
         """清除所有内容和记忆，重新开始"""
+        # 当前会话已保存在工作区中，之后的内容记入新会话
+        self._save_criteria_edits()
+        self.session_id = None
+        
         # 清除左侧面板内容
         self.criteria_text_edit.clear()
         
         # 清除右侧面板内容
-        self.case_text_edit.clear()
+        self._set_case_markdown("")
         self.result_text_edit.clear()
         self.current_pdf_path = None
         
         # 清除PDF显示
-        for i in reversed(range(self.pdf_layout.count())): 
-            self.pdf_layout.itemAt(i).widget().setParent(None)
+        self.pdf_view.clear_document()
         
         self.case_stack.setCurrentIndex(0)  # 切换到文本模式
         
@@ -300,11 +528,30 @@ class ScreeningApp(QWidget):
         
         # 重置内部变量
         self.criteria_text = ""
+        self.last_compiled = None
+        self.verdict_memo.clear()
+        self.case_feed = None
+        self.case_organizing = False
+        
+        # 取消所有后台任务，旧任务的结果不再写回界面
+        self.scheduler.cancel_all()
+        self.protocol_generation += 1
+        self.case_generation += 1
+        self.job_results.clear()
+        self.displayed_job_id = None
+        self.protocol_ocr_job = None
+        self.case_ocr_job = None
 
     def organize_case(self):
         """整理患者病例"""
+        feed = self.case_feed
+        if feed is not None and not feed.closed:
+            # 病例仍在识别：先整理已识别的页面，后续页面识别出来后接着整理
+            self._organize_streaming_case(feed)
+            return
+        
         # 获取右侧的患者病例
-        patient_case = self.case_text_edit.toMarkdown()  # 获取Markdown格式的文本
+        patient_case = self._case_markdown()
         
         if not patient_case:
             self.status_label.setText("请先加载或输入患者病例！")
@@ -313,19 +560,427 @@ class ScreeningApp(QWidget):
         
         self.status_label.setText("正在整理病例，请稍候...")
         self.status_label.setStyleSheet("color: blue;")
-        QApplication.processEvents()  # 立即更新界面
+        generation = self.case_generation
+        
+        def on_partial(content):
+            # 整理结果边生成边显示
+            if generation == self.case_generation:
+                self._show_streamed(self.case_text_edit, content, markdown=True)
+        
+        def on_finished(outcome):
+            if generation != self.case_generation:
+                return
+            success, result = outcome
+            if success:
+                # 将整理后的内容放回病例文本框，使用Markdown格式
+                self._set_case_markdown(result)
+                self._save_document(DOC_ORGANIZED, result, content_hash(patient_case))
+                self.status_label.setText("病例整理成功！")
+                self.status_label.setStyleSheet("color: green;")
+            else:
+                # 失败或取消时恢复整理前的病例
+                self._set_case_markdown(patient_case)
+                self.status_label.setText(f"病例整理失败：{result}")
+                self.status_label.setStyleSheet("color: red;")
         
         # 调用整理功能
-        success, result = organize_patient_case(patient_case)
+        refresh = self.refresh_cache_checkbox.isChecked()
+        organize = self.service.organize_patient_case if self.service else organize_patient_case
+        self._submit_job(
+            'llm', "整理病例",
+            lambda job: organize(
+                patient_case, on_delta=lambda delta, content: job.emit_partial(content), cancel_event=job.cancel_event,
+                refresh=refresh
+            ),
+            on_finished=on_finished, on_partial=on_partial,
+            on_cancelled=lambda: on_finished((False, "已取消"))
+        )
+
+    def _organize_streaming_case(self, feed):
+        """边识别边整理：文本框改为显示整理结果，失败或取消时恢复为已识别的原文"""
+        self.status_label.setText("正在整理已识别的页面，后续页面识别后继续整理...")
+        self.status_label.setStyleSheet("color: blue;")
+        generation = self.case_generation
+        self.case_organizing = True
         
-        if success:
-            # 将整理后的内容放回病例文本框，使用Markdown格式
-            self.case_text_edit.setMarkdown(result)
-            self.status_label.setText("病例整理成功！")
-            self.status_label.setStyleSheet("color: green;")
+        def on_partial(content):
+            if generation == self.case_generation:
+                self._show_streamed(self.case_text_edit, content, markdown=True)
+        
+        def on_finished(outcome):
+            if generation != self.case_generation:
+                return
+            self.case_organizing = False
+            success, result = outcome
+            if success:
+                self._set_case_markdown(result)
+                self._save_document(DOC_ORGANIZED, result, content_hash("\n\n".join(feed.snapshot())))
+                self.status_label.setText("病例整理成功！")
+                self.status_label.setStyleSheet("color: green;")
+            else:
+                self._set_case_markdown("\n\n".join(feed.snapshot()))
+                self.status_label.setText(f"病例整理失败：{result}")
+                self.status_label.setStyleSheet("color: red;")
+        
+        refresh = self.refresh_cache_checkbox.isChecked()
+        self._submit_job(
+            'llm', "整理病例（边识别边整理）",
+            lambda job: self._organize_from_feed(job, feed, refresh),
+            on_finished=on_finished, on_partial=on_partial,
+            on_cancelled=lambda: on_finished((False, "已取消"))
+        )
+
+    def _submit_job(self, lane, description, fn, **callbacks):
+        """提交后台任务，并把进度接到进度条上"""
+        job = self.scheduler.submit(lane, description, fn, **callbacks)
+        job.signals.progress.connect(self.on_job_progress)
+        job.signals.failed.connect(self.on_job_failed)
+        return job
+
+    def _cancel_job(self, job):
+        """取消仍在排队或运行的任务；已结束的任务不受影响"""
+        if job is not None:
+            self.scheduler.cancel(job.job_id)
+
+    def _run_ocr(self, job, file_path, pages=None):
+        """在任务线程（或进程池）中执行 OCR，逐段汇报页数进度；服务模式下上传 PDF 由筛查服务识别"""
+        def progress(done, total):
+            job.check_cancelled()
+            job.report_progress("OCR", done, total)
+
+        if self.service is not None:
+            result = self.service.extract_text_from_pdf(file_path, pages=pages, progress_callback=progress,
+                                                        cancel_event=job.cancel_event)
+        elif self.scheduler.process_executor() is not None:
+            result = job.run_in_process(partial(extract_text_from_pdf, file_path, pages=pages))
+        else:
+            result = extract_text_from_pdf(file_path, pages=pages, progress_callback=progress)
+        # 文件哈希（工作区的内容键）也在任务线程中计算，大文件不阻塞界面
+        result['sha256'] = file_sha256(file_path) if result['success'] else None
+        return result
+
+    def _stream_ocr(self, job, file_path, feed):
+        """在任务线程中逐页识别病例：每页放入 feed，并按刷新间隔把新识别的页面发给界面追加显示"""
+        stats = {}
+        parts = []
+        batch = []
+        last_emit = 0.0
+        # 每个转换单元只含一页，识别完一页即可显示
+        if self.service is not None:
+            pages = self.service.iter_pdf_pages(file_path, cancel_event=job.cancel_event, stats=stats)
+        else:
+            pages = iter_pdf_pages(file_path, executor=self.scheduler.process_executor(), chunk_pages=1, stats=stats)
+        try:
+            with span("ocr.extract", path=os.path.basename(file_path), streamed=True) as extract_span:
+                for page_no, page_text, _ in pages:
+                    job.check_cancelled()
+                    part = PAGE_MARKER.format(page_no=page_no)
+                    if page_text:
+                        part += f"\n\n{page_text}"
+                    parts.append(part)
+                    batch.append(part)
+                    feed.append(part)
+                    job.report_progress("OCR", len(parts), len(stats['pages']))
+                    if time.monotonic() - last_emit >= job.PARTIAL_INTERVAL:
+                        job.emit_partial(batch, force=True)
+                        batch = []
+                        last_emit = time.monotonic()
+                if batch:
+                    job.emit_partial(batch, force=True)
+                extract_span.set(pages=len(parts), cache_hits=stats['cache_hits'], ocr_pages=stats['cache_misses'])
+        except JobCancelled:
+            raise
+        except Exception as e:
+            log_event("ocr.failed", f"PDF 处理出错：{str(e)}", level="error", path=file_path)
+            return {'success': False, 'text': "", 'message': f"PDF 处理出错：{str(e)}", 'is_filtered': False}
+        finally:
+            pages.close()
+            feed.close()
+        return {'success': True, 'text': "\n\n".join(parts), 'message': conversion_message(stats), 'is_filtered': False,
+                'sha256': file_sha256(file_path)}
+
+    def _organize_from_feed(self, job, feed, refresh=False):
+        """分轮整理正在识别的病例：每轮整理上一轮之后新识别的全部页面，结果依次拼接"""
+        organized = []
+        consumed = 0
+        organize = self.service.organize_patient_case if self.service else organize_patient_case
+        while True:
+            new_pages = feed.wait_for(consumed, job.cancel_event)
+            if not new_pages:
+                break
+            consumed += len(new_pages)
+            prefix = "\n\n".join(organized)
+            success, result = organize(
+                "\n\n".join(new_pages),
+                on_delta=lambda delta, content: job.emit_partial(f"{prefix}\n\n{content}" if prefix else content),
+                cancel_event=job.cancel_event, refresh=refresh, continuation=bool(organized)
+            )
+            if not success:
+                return False, result
+            organized.append(result)
+        return True, "\n\n".join(organized)
+
+    def _set_case_markdown(self, markdown):
+        """显示病例并记下其 Markdown 原文"""
+        self.case_markdown = markdown
+        self.case_text_edit.setMarkdown(markdown)
+        self.case_text_edit.document().setModified(False)
+
+    def _case_markdown(self):
+        """当前病例的 Markdown：文本框内容被改动过时取改动后的内容（页码标记已丢失），否则取原文"""
+        if self.case_text_edit.document().isModified():
+            return self.case_text_edit.toMarkdown()
+        return self.case_markdown
+
+    def _append_markdown(self, widget, markdown):
+        """把一段 Markdown 追加到文本框末尾，不重新渲染已有内容"""
+        fragment = QTextDocument()
+        fragment.setMarkdown(markdown)
+        cursor = QTextCursor(widget.document())
+        cursor.movePosition(QTextCursor.End)
+        if not widget.document().isEmpty():
+            cursor.insertBlock()
+        cursor.insertFragment(QTextDocumentFragment(fragment))
+
+    def _analyze(self, job, criteria, patient_case, refresh=False):
+        """在任务线程中分析：优先按编译好的条目逐条评估，编译失败时退回整体分析
+
+        修改入排标准或病例后再次分析时，只编译改动过的条目，只评估改动过的条目与病例分块。
+        """
+        screen = self.service.screen_patient if self.service else screen_patient
+        analysis, compiled = screen(
+            criteria, patient_case, on_delta=lambda delta, content: job.emit_partial(content),
+            cancel_event=job.cancel_event, refresh=refresh, previous=self.last_compiled, memo=self.verdict_memo,
+            on_stage=job.report_progress
+        )
+        job.check_cancelled()
+        if compiled is not None:
+            self.last_compiled = compiled
+        return analysis
+
+    def _save_document(self, kind, text, input_hash="", **fields):
+        """把一类内容保存到当前会话（还没有会话时新建），fields 同时更新会话的标题、文件路径等"""
+        store = get_workspace_store()
+        if store is None or not text:
+            return
+        try:
+            if self.session_id is None:
+                source = fields.get('case_path') or fields.get('protocol_path')
+                title = os.path.basename(source) if source else time.strftime("会话 %Y-%m-%d %H:%M")
+                self.session_id = store.create_session(title)
+            store.save(self.session_id, kind, text, input_hash)
+            if fields:
+                store.update_session(self.session_id, **fields)
+        except sqlite3.Error as e:
+            log_event("workspace.save_failed", str(e), level="error", kind=kind)
+
+    def _save_criteria_edits(self, criteria=None):
+        """入排标准与会话中保存的不同（如手动修改过）时保存当前内容"""
+        store = get_workspace_store() if self.session_id is not None else None
+        criteria = self.criteria_text_edit.toPlainText() if criteria is None else criteria
+        if store is None or not criteria:
+            return
+        try:
+            if store.load(self.session_id, DOC_CRITERIA) != criteria:
+                store.save(self.session_id, DOC_CRITERIA, criteria)
+        except sqlite3.Error as e:
+            log_event("workspace.save_failed", str(e), level="error", kind=DOC_CRITERIA)
+
+    def _analysis_key(self, criteria, patient_case):
+        """分析结果的输入哈希；忽略空白差异，文本框 Markdown 往返转换带来的空行变化不影响复用"""
+        return content_hash(" ".join(criteria.split()), " ".join(patient_case.split()))
+
+    def _save_analysis(self, criteria, patient_case, analysis):
+        """保存分析结果及所用的入排标准与编译结果，结论摘要显示在历史会话列表中"""
+        self._save_document(DOC_ANALYSIS, analysis, self._analysis_key(criteria, patient_case),
+                            summary=extract_conclusion(analysis))
+        self._save_criteria_edits(criteria)
+        if self.last_compiled is not None:
+            self._save_document(DOC_COMPILED, json.dumps(self.last_compiled, ensure_ascii=False))
+
+    def _load_saved_analysis(self, criteria, patient_case):
+        """本会话中输入相同的分析结果；没有时返回 None"""
+        store = get_workspace_store() if self.session_id is not None else None
+        if store is None:
+            return None
+        try:
+            return store.load(self.session_id, DOC_ANALYSIS, self._analysis_key(criteria, patient_case))
+        except sqlite3.Error:
+            return None
+
+    def show_sessions(self):
+        """列出工作区中的历史会话，选中后重新打开"""
+        store = get_workspace_store()
+        if store is None:
+            return
+        dialog = SessionsDialog(store, self)
+        accepted = dialog.exec_() == QDialog.Accepted
+        if self.session_id in dialog.deleted:
+            self.session_id = None
+        if accepted and dialog.selected_session is not None:
+            self.open_session(dialog.selected_session)
+
+    def open_session(self, session_id):
+        """重新打开保存的会话：只读取需要显示的内容，不重新识别或调用模型"""
+        store = get_workspace_store()
+        with span("workspace.open_session") as open_span:
+            session = store.open_session(session_id)
+            if session is None:
+                self.status_label.setText("会话不存在或已被删除")
+                self.status_label.setStyleSheet("color: red;")
+                return
+            self.restart()
+            self.session_id = session_id
+            documents = session['documents']
+            # 有整理结果时不再读取原始识别结果，有入排标准时不再读取方案全文
+            criteria = store.load(session_id, DOC_CRITERIA if DOC_CRITERIA in documents else DOC_PROTOCOL) or ""
+            case_text = store.load(session_id, DOC_ORGANIZED if DOC_ORGANIZED in documents else DOC_CASE) or ""
+            analysis = store.load(session_id, DOC_ANALYSIS) or ""
+            compiled = store.load(session_id, DOC_COMPILED)
+            open_span.set(documents=len(documents))
+        
+        self.criteria_text = criteria
+        self.criteria_text_edit.setPlainText(criteria)
+        self._set_case_markdown(case_text)
+        self.result_text_edit.setPlainText(analysis)
+        self.last_compiled = json.loads(compiled) if compiled else None
+        if session['case_path'] and os.path.exists(session['case_path']):
+            self.current_pdf_path = session['case_path']
+            try:
+                self.pdf_view.set_document(session['case_path'])
+            except Exception as e:
+                log_event("workspace.open_pdf_failed", str(e), level="error", path=session['case_path'])
+        self.status_label.setText(f"已打开会话：{session['title']}")
+        self.status_label.setStyleSheet("color: green;")
+
+    def _show_streamed(self, widget, content, markdown=False):
+        """显示流式输出的阶段性文本，并滚动到末尾"""
+        if markdown:
+            widget.setMarkdown(content)
         else:
-            self.status_label.setText(f"病例整理失败：{result}")
+            widget.setPlainText(content)
+        widget.moveCursor(QTextCursor.End)
+
+    def on_job_progress(self, job_id, stage, done, total):
+        """更新进度条"""
+        job = self.scheduler.jobs.get(job_id)
+        self.progress_bar.setVisible(True)
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+        self.progress_bar.setFormat(f"{job.description if job else ''} {stage} %v/%m")
+
+    def on_job_failed(self, job_id, message):
+        """任务异常结束"""
+        self.status_label.setText(f"任务失败：{message}")
+        self.status_label.setStyleSheet("color: red;")
+
+    def refresh_job_list(self):
+        """刷新任务队列显示"""
+        selected = self.job_list.currentItem()
+        selected_id = selected.data(Qt.UserRole) if selected else None
+        self.job_list.clear()
+        for job in self.scheduler.jobs.values():
+            item = QListWidgetItem(f"[{JOB_STATE_LABELS[job.state]}] {job.description}")
+            item.setData(Qt.UserRole, job.job_id)
+            self.job_list.addItem(item)
+            if job.job_id == selected_id:
+                self.job_list.setCurrentItem(item)
+        if not self.scheduler.active_jobs():
+            self.progress_bar.setVisible(False)
+
+    def show_job_result(self, item):
+        """点击任务队列中的分析任务，显示其结果"""
+        job_id = item.data(Qt.UserRole)
+        if job_id in self.job_results:
+            self.displayed_job_id = job_id
+            self.result_text_edit.setPlainText(self.job_results[job_id])
+
+    def cancel_jobs(self):
+        """取消所选任务；未选择任务时取消全部进行中的任务"""
+        item = self.job_list.currentItem()
+        if item is not None and self.scheduler.jobs[item.data(Qt.UserRole)] in self.scheduler.active_jobs():
+            self.scheduler.cancel(item.data(Qt.UserRole))
+        else:
+            self.scheduler.cancel_all()
+        self.status_label.setText("正在取消任务...")
+        self.status_label.setStyleSheet("color: blue;")
+
+    def start_prewarm(self):
+        """后台加载 docling / OCR 模型，加载期间界面可正常使用，状态标签显示就绪情况
+
+        服务模式下本机不加载模型，改为在后台检查筛查服务是否可用。
+        """
+        self.status_label.setText("OCR 模型加载中，可先输入或编辑入排标准...")
+        self.status_label.setStyleSheet("color: gray;")
+        if self.service is None:
+            prewarm_converters(on_done=lambda error, seconds: self.prewarm_done.emit(error or "", seconds))
+            return
+
+        def check_service():
+            started = time.perf_counter()
+            try:
+                health = self.service.health()
+                error = "" if health.get('ocr_error') is None else f"服务端 {health['ocr_error']}"
+            except Exception as e:
+                error = str(e)
+            self.prewarm_done.emit(error, time.perf_counter() - started)
+
+        threading.Thread(target=check_service, daemon=True).start()
+
+    def on_prewarm_done(self, error, seconds):
+        """预热结束；状态标签已被其他操作更新时不覆盖"""
+        self.ocr_ready = not error
+        self._compact_workspace()
+        log_event("app.ocr_ready", level="info" if not error else "error", seconds=round(seconds, 3))
+        if not self.status_label.text().startswith("OCR 模型加载中"):
+            return
+        if error and self.service is not None:
+            self.status_label.setText(f"筛查服务不可用：{error}")
             self.status_label.setStyleSheet("color: red;")
+        elif error:
+            self.status_label.setText(f"OCR 模型加载失败，将在首次识别时重试：{error}")
+            self.status_label.setStyleSheet("color: red;")
+        elif self.service is not None:
+            self.status_label.setText(f"已连接筛查服务 {self.service.base_url}（用户 {self.service.user}）")
+            self.status_label.setStyleSheet("color: green;")
+        else:
+            self.status_label.setText(f"OCR 模型已就绪（加载用时 {seconds:.1f} 秒）")
+            self.status_label.setStyleSheet("color: green;")
+
+    def refresh_stage_table(self):
+        """按累计耗时从高到低刷新阶段耗时面板"""
+        summary = sorted(stage_summary().items(), key=lambda entry: entry[1]['total_s'], reverse=True)
+        self.stage_table.setRowCount(len(summary))
+        for row, (stage, stats) in enumerate(summary):
+            values = [stage, str(stats['count'])] + [
+                f"{stats[key]:.2f}" for key in ('last_s', 'mean_s', 'p95_s', 'total_s')
+            ]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.stage_table.setItem(row, column, item)
+    
+    def _compact_workspace(self):
+        """启动后模型加载完、界面空闲时，在后台线程中整理工作区（清理无人引用的内容，必要时 VACUUM）"""
+        store = get_workspace_store()
+        if store is None:
+            return
+
+        def compact():
+            try:
+                store.compact()
+            except sqlite3.Error as e:
+                log_event("workspace.compact_failed", str(e), level="error")
+
+        threading.Thread(target=compact, name="workspace-compact", daemon=True).start()
+
+    def closeEvent(self, event):
+        """关闭窗口时停止后台任务，并保存手动修改的入排标准"""
+        self.scheduler.shutdown()
+        self._save_criteria_edits()
+        self.pdf_view.clear_document()
+        super().closeEvent(event)
             
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,610 @@
+"""多用户筛查服务：共享一份常驻的 OCR 模型与模型连接，按用户轮转处理各界面提交的任务
+
+用法示例：
+    python screening_service.py --host 0.0.0.0 --port 8765 --ocr-workers 2 --llm-workers 4
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from config import (CACHE_DIR, SERVICE_HOST, SERVICE_PORT, SERVICE_OCR_WORKERS, SERVICE_LLM_WORKERS,
+                    SERVICE_MAX_QUEUED_PER_USER, SERVICE_JOB_TTL, SERVICE_MAX_UPLOAD_MB, SERVICE_TOKEN)
+from ocr_utils import (iter_pdf_pages, conversion_message, prewarm_converters, shutdown_converters, get_ocr_process_pool,
+                       PAGE_MARKER)
+from api_utils import extract_criteria_from_text, organize_patient_case, screen_patient
+from analysis_engine import VerdictMemo
+from instrumentation import span, log_event, increment, set_gauge, render_prometheus, start_exporters
+
+# 任务类型 -> 通道
+JOB_KINDS = {
+    'ocr': 'ocr',
+    'extract_criteria': 'llm',
+    'organize': 'llm',
+    'analyze': 'llm',
+}
+ACTIVE_STATES = ('queued', 'running')
+# 长轮询单次最长等待（秒）
+MAX_WAIT_SECONDS = 30.0
+# 全部用户共享的条目判定记忆容量
+SHARED_MEMO_ENTRIES = 200000
+
+_FILE_ID = re.compile(r'^[0-9a-f]{64}$')
+
+
+class JobCancelled(Exception):
+    """任务在执行过程中被取消"""
+
+
+class ServiceBusy(Exception):
+    """用户排队的任务已达上限"""
+
+
+class ServiceJob:
+    """服务端任务：状态、进度与阶段性结果，状态每次变化时递增 version 并唤醒长轮询"""
+
+    def __init__(self, kind, user, params):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.lane = JOB_KINDS[kind]
+        self.user = user
+        self.params = params
+        self.state = 'queued'
+        self.progress = None
+        self.partial = None
+        self.pages = []
+        self.stats = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def update(self, **fields):
+        with self._cond:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self._cond.notify_all()
+
+    def add_page(self, page_no, text, method, stats):
+        with self._cond:
+            self.pages.append([page_no, text, method])
+            self.stats = stats
+            self.progress = ["OCR", len(self.pages), stats.get('pages', 0)]
+            self.version += 1
+            self._cond.notify_all()
+
+    def report_progress(self, stage, done, total):
+        self.update(progress=[stage, done, total])
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def wait_change(self, version, timeout):
+        """等待 version 之后的状态变化，最多 timeout 秒"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version > version, timeout)
+
+    def snapshot(self, since=0, position=None):
+        with self._cond:
+            data = {
+                'id': self.job_id,
+                'kind': self.kind,
+                'user': self.user,
+                'state': self.state,
+                'version': self.version,
+                'progress': self.progress,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+            }
+            if position is not None:
+                data['position'] = position
+            if self.kind == 'ocr':
+                data['pages'] = self.pages[since:]
+                data['stats'] = self.stats
+            else:
+                data['partial'] = self.partial
+            if self.state == 'finished':
+                data['result'] = self.result
+            elif self.state == 'failed':
+                data['error'] = self.error
+            return data
+
+
+class FairQueue:
+    """按用户轮转的任务队列：每个用户一条队列，轮到的用户取出最早的任务后排到末尾"""
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def put(self, job):
+        with self._cond:
+            self._queues.setdefault(job.user, deque()).append(job)
+            self._cond.notify()
+
+    def get(self):
+        """取出下一个任务，队列为空时等待；关闭后返回 None"""
+        with self._cond:
+            while not self._queues and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                return None
+            user, queue = self._queues.popitem(last=False)
+            job = queue.popleft()
+            if queue:
+                self._queues[user] = queue
+            return job
+
+    def remove(self, job):
+        with self._cond:
+            queue = self._queues.get(job.user)
+            if queue is None or job not in queue:
+                return False
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.user]
+            return True
+
+    def position(self, job):
+        """job 之前还要取出的任务数；不在队列中时返回 None"""
+        with self._cond:
+            queues = [list(queue) for queue in self._queues.values()]
+        # 轮转顺序即各用户队列按位置交错
+        order = (queued for queued in itertools.chain.from_iterable(itertools.zip_longest(*queues))
+                 if queued is not None)
+        for index, queued in enumerate(order):
+            if queued is job:
+                return index
+        return None
+
+    def count(self, user):
+        with self._cond:
+            return len(self._queues.get(user, ()))
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class ScreeningService:
+    """筛查服务：HTTP 接口、按通道与用户排队的任务，以及处理任务的工作线程"""
+
+    def __init__(self, host=SERVICE_HOST, port=SERVICE_PORT, lane_workers=None, upload_dir=None, token=SERVICE_TOKEN,
+                 job_ttl=SERVICE_JOB_TTL, max_queued_per_user=SERVICE_MAX_QUEUED_PER_USER,
+                 max_upload_bytes=SERVICE_MAX_UPLOAD_MB * 1024 * 1024):
+        self.lane_workers = lane_workers or {'ocr': SERVICE_OCR_WORKERS, 'llm': SERVICE_LLM_WORKERS}
+        self.queues = {lane: FairQueue() for lane in self.lane_workers}
+        self.upload_dir = upload_dir or os.path.join(CACHE_DIR, "service", "uploads")
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.token = token
+        self.job_ttl = job_ttl
+        self.max_queued_per_user = max_queued_per_user
+        self.max_upload_bytes = max_upload_bytes
+        self.jobs = {}
+        self._lock = threading.Lock()
+        # 判定按条目与病例分块的内容记忆，各用户共用；上一版编译结果按用户分别保存
+        self.verdict_memo = VerdictMemo(max_entries=SHARED_MEMO_ENTRIES)
+        self.last_compiled = {}
+        self.ocr_ready = False
+        self.ocr_error = None
+        self._workers = []
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # ---- 任务 ----
+
+    def submit(self, kind, user, params):
+        """提交任务，返回 ServiceJob；类型或参数不合法时抛出 ValueError，排队已满时抛出 ServiceBusy"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"未知的任务类型：{kind}")
+        if kind == 'ocr':
+            self.upload_path(params.get('file_id'))
+        job = ServiceJob(kind, user, params)
+        queue = self.queues[job.lane]
+        with self._lock:
+            if 0 < self.max_queued_per_user <= queue.count(user):
+                raise ServiceBusy(f"用户 {user} 已有 {queue.count(user)} 个任务在排队")
+            self.jobs[job.job_id] = job
+        queue.put(job)
+        increment("service_jobs_total", kind=kind, state='submitted')
+        set_gauge("service_queue_depth", len(queue), lane=job.lane)
+        log_event("service.job_submitted", level="debug", job=job.job_id, kind=kind, user=user)
+        self._purge()
+        return job
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def job_status(self, job, since=0):
+        position = self.queues[job.lane].position(job) if job.state == 'queued' else None
+        return job.snapshot(since, position)
+
+    def cancel(self, job):
+        """取消任务：排队中的任务直接移出队列，运行中的任务在下一个检查点停止"""
+        if job.state not in ACTIVE_STATES:
+            return
+        job.cancel_event.set()
+        if self.queues[job.lane].remove(job):
+            self._finish(job, 'cancelled')
+
+    def _finish(self, job, state, result=None, error=None):
+        job.update(state=state, result=result, error=error, finished=time.time())
+        increment("service_jobs_total", kind=job.kind, state=state)
+
+    def _worker(self, lane):
+        queue = self.queues[lane]
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            set_gauge("service_queue_depth", len(queue), lane=lane)
+            self._execute(job)
+
+    def _execute(self, job):
+        if job.cancel_event.is_set():
+            self._finish(job, 'cancelled')
+            return
+        job.update(state='running', started=time.time())
+        try:
+            with span("service.job", kind=job.kind, user=job.user,
+                      waited_s=round(job.started - job.created, 3)):
+                result = getattr(self, f"_run_{job.kind}")(job)
+            job.check_cancelled()
+        except JobCancelled:
+            self._finish(job, 'cancelled')
+        except Exception as e:
+            log_event("service.job_failed", str(e), level="error", job=job.job_id, kind=job.kind, user=job.user)
+            self._finish(job, 'failed', error=str(e))
+        else:
+            self._finish(job, 'finished', result=result)
+
+    def _run_ocr(self, job):
+        """逐页识别；每页就绪即写入任务，客户端可以边识别边显示"""
+        params = job.params
+        path = self.upload_path(params['file_id'])
+        stats = {}
+        parts = []
+        pages = iter_pdf_pages(path, pages=params.get('pages'), chunk_pages=1 if params.get('stream') else None,
+                               executor=get_ocr_process_pool(), stats=stats)
+        try:
+            for page_no, page_text, method in pages:
+                job.check_cancelled()
+                part = PAGE_MARKER.format(page_no=page_no)
+                if page_text:
+                    part += f"\n\n{page_text}"
+                parts.append(part)
+                job.add_page(page_no, page_text, method, {
+                    'pages': len(stats['pages']), 'text_layer_pages': stats['text_layer_pages'],
+                    'table_pages': stats['table_pages'], 'cache_hits': stats['cache_hits'], 'cache_misses': stats['cache_misses'],
+                })
+        finally:
+            pages.close()
+        return {
+            'success': True,
+            'text': "\n\n".join(parts),
+            'message': conversion_message(stats),
+            'is_filtered': params.get('pages') is not None,
+            'pages': stats['pages'],
+            'cache_hits': stats['cache_hits'],
+            'cache_misses': stats['cache_misses'],
+        }
+
+    def _run_extract_criteria(self, job):
+        params = job.params
+        return extract_criteria_from_text(
+            params['text'], on_delta=lambda delta, content: job.update(partial=content),
+            cancel_event=job.cancel_event, refresh=bool(params.get('refresh'))
+        )
+
+    def _run_organize(self, job):
+        params = job.params
+        return organize_patient_case(
+            params['case_text'], on_delta=lambda delta, content: job.update(partial=content),
+            cancel_event=job.cancel_event, refresh=bool(params.get('refresh')),
+            continuation=bool(params.get('continuation'))
+        )
+
+    def _run_analyze(self, job):
+        params = job.params
+        with self._lock:
+            previous = self.last_compiled.get(job.user)
+        analysis, compiled = screen_patient(
+            params['criteria'], params['patient_case'], on_delta=lambda delta, content: job.update(partial=content),
+            cancel_event=job.cancel_event, refresh=bool(params.get('refresh')), previous=previous,
+            memo=self.verdict_memo, on_stage=job.report_progress
+        )
+        if compiled is not None:
+            with self._lock:
+                self.last_compiled[job.user] = compiled
+        return analysis
+
+    def _purge(self):
+        """清理超过保留时间的已结束任务，以及不再被任务引用的过期上传文件"""
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job.state not in ACTIVE_STATES and now - (job.finished or now) > self.job_ttl]
+            for job_id in expired:
+                del self.jobs[job_id]
+            in_use = {job.params.get('file_id') for job in self.jobs.values() if job.kind == 'ocr'}
+        for name in os.listdir(self.upload_dir):
+            path = os.path.join(self.upload_dir, name)
+            try:
+                if name[:-len('.pdf')] not in in_use and now - os.path.getmtime(path) > self.job_ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    # ---- 上传文件 ----
+
+    def upload_path(self, file_id):
+        """file_id 对应的上传文件路径；不存在时抛出 ValueError"""
+        if not isinstance(file_id, str) or not _FILE_ID.match(file_id):
+            raise ValueError("file_id 无效")
+        path = os.path.join(self.upload_dir, f"{file_id}.pdf")
+        if not os.path.exists(path):
+            raise ValueError("文件不存在，请先上传")
+        return path
+
+    def store_upload(self, stream, length):
+        """保存上传的 PDF，按内容哈希命名；已有相同内容时只更新修改时间"""
+        digest = hashlib.sha256()
+        temp_path = os.path.join(self.upload_dir, f".upload-{uuid.uuid4().hex}")
+        try:
+            with open(temp_path, 'wb') as f:
+                remaining = length
+                while remaining > 0:
+                    block = stream.read(min(remaining, 1 << 20))
+                    if not block:
+                        raise ValueError("上传内容不完整")
+                    digest.update(block)
+                    f.write(block)
+                    remaining -= len(block)
+            file_id = digest.hexdigest()
+            path = os.path.join(self.upload_dir, f"{file_id}.pdf")
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                os.replace(temp_path, path)
+            return file_id
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def health(self):
+        with self._lock:
+            active = sum(1 for job in self.jobs.values() if job.state in ACTIVE_STATES)
+        return {
+            'status': 'ok',
+            'ocr_ready': self.ocr_ready,
+            'ocr_error': self.ocr_error,
+            'active_jobs': active,
+            'queued': {lane: len(queue) for lane, queue in self.queues.items()},
+            'workers': self.lane_workers,
+        }
+
+    # ---- 启停 ----
+
+    def _on_prewarm(self, error, seconds):
+        self.ocr_ready = error is None
+        self.ocr_error = error
+        log_event("service.ocr_ready", level="info" if error is None else "error", seconds=round(seconds, 3),
+                  error=error)
+
+    def start(self, prewarm=True):
+        """启动工作线程与 HTTP 服务（后台线程），prewarm=True 时在后台预热 OCR 转换器"""
+        if prewarm:
+            prewarm_converters(on_done=self._on_prewarm)
+        for lane, count in self.lane_workers.items():
+            for index in range(count):
+                worker = threading.Thread(target=self._worker, args=(lane,), name=f"service-{lane}-{index}",
+                                          daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        log_event("service.started", f"筛查服务已启动：{self.url}", url=self.url, workers=self.lane_workers)
+        return self
+
+    def stop(self):
+        for queue in self.queues.values():
+            queue.close()
+        with self._lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel_event.set()
+        self._server.shutdown()
+        self._server.server_close()
+        shutdown_converters(wait=False)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ---- HTTP ----
+
+    def _handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, data):
+                out = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def _send_error(self, status, message):
+                self._send_json(status, {'error': message})
+
+            def _authorized(self):
+                if not service.token or self.headers.get('Authorization') == f"Bearer {service.token}":
+                    return True
+                # 未读取的请求体会干扰同一连接上的下一个请求
+                self.close_connection = True
+                self._send_error(401, "访问令牌无效")
+                return False
+
+            def _user(self):
+                return unquote(self.headers.get('X-User') or "") or self.client_address[0]
+
+            def _read_json(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    return json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    return None
+
+            def _route(self):
+                parts = urlsplit(self.path)
+                segments = [segment for segment in parts.path.split('/') if segment]
+                query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+                return segments, query
+
+            def do_GET(self):
+                if not self._authorized():
+                    return
+                segments, query = self._route()
+                if segments == ['health']:
+                    self._send_json(200, service.health())
+                elif segments == ['metrics']:
+                    out = render_prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(out)))
+                    self.end_headers()
+                    self.wfile.write(out)
+                elif len(segments) == 2 and segments[0] == 'files':
+                    try:
+                        service.upload_path(segments[1])
+                        exists = True
+                    except ValueError:
+                        exists = False
+                    self._send_json(200, {'file_id': segments[1], 'exists': exists})
+                elif len(segments) == 2 and segments[0] == 'jobs':
+                    job = service.get_job(segments[1])
+                    if job is None:
+                        self._send_error(404, "任务不存在或已过期")
+                        return
+                    try:
+                        since = int(query.get('since', 0))
+                        version = int(query.get('version', -1))
+                        wait = min(float(query.get('wait', 0)), MAX_WAIT_SECONDS)
+                    except ValueError:
+                        self._send_error(400, "参数无效")
+                        return
+                    if wait > 0:
+                        job.wait_change(version, wait)
+                    self._send_json(200, service.job_status(job, since))
+                else:
+                    self._send_error(404, "接口不存在")
+
+            def do_POST(self):
+                if not self._authorized():
+                    return
+                segments, _ = self._route()
+                if segments == ['files']:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    if length <= 0 or length > service.max_upload_bytes:
+                        self.close_connection = True
+                        self._send_error(413, f"文件为空或超过 {service.max_upload_bytes // (1024 * 1024)} MB")
+                        return
+                    try:
+                        file_id = service.store_upload(self.rfile, length)
+                    except ValueError as e:
+                        self.close_connection = True
+                        self._send_error(400, str(e))
+                        return
+                    self._send_json(200, {'file_id': file_id})
+                elif segments == ['jobs']:
+                    body = self._read_json()
+                    if not isinstance(body, dict) or not isinstance(body.get('params', {}), dict):
+                        self._send_error(400, "请求体须为 JSON 对象")
+                        return
+                    try:
+                        job = service.submit(body.get('kind'), self._user(), body.get('params') or {})
+                    except ValueError as e:
+                        self._send_error(400, str(e))
+                        return
+                    except ServiceBusy as e:
+                        self._send_error(429, str(e))
+                        return
+                    self._send_json(202, service.job_status(job))
+                else:
+                    self.close_connection = True
+                    self._send_error(404, "接口不存在")
+
+            def do_DELETE(self):
+                if not self._authorized():
+                    return
+                segments, _ = self._route()
+                job = service.get_job(segments[1]) if len(segments) == 2 and segments[0] == 'jobs' else None
+                if job is None:
+                    self._send_error(404, "任务不存在或已过期")
+                    return
+                service.cancel(job)
+                self._send_json(200, service.job_status(job))
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多用户筛查服务")
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--ocr-workers', type=int, default=SERVICE_OCR_WORKERS, help="OCR 通道的工作线程数")
+    parser.add_argument('--llm-workers', type=int, default=SERVICE_LLM_WORKERS, help="模型调用通道的工作线程数")
+    parser.add_argument('--no-prewarm', dest='prewarm', action='store_false', help="不在启动时预热 OCR 模型")
+    args = parser.parse_args()
+
+    service = ScreeningService(args.host, args.port, {'ocr': args.ocr_workers, 'llm': args.llm_workers})
+    start_exporters()
+    service.start(prewarm=args.prewarm)
+    print(f"筛查服务已启动：{service.url}（Ctrl+C 退出）")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""筛查服务的客户端，方法与 ocr_utils / api_utils 中的同名函数参数、返回值一致"""
+import getpass
+import hashlib
+import time
+from contextlib import closing
+from urllib.parse import quote
+
+import requests
+
+from config import SCREENING_SERVICE_URL, SCREENING_SERVICE_USER, SCREENING_SERVICE_WAIT, SERVICE_TOKEN
+
+# 两次状态请求之间的最小间隔（秒），流式输出很快时避免请求过于频繁
+MIN_POLL_INTERVAL = 0.1
+
+
+class ServiceError(Exception):
+    """筛查服务不可用，或任务在服务端执行失败"""
+
+
+class ServiceCancelled(Exception):
+    """任务已取消"""
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ScreeningServiceClient:
+    """访问筛查服务的客户端，一个实例复用一组 HTTP 连接"""
+
+    def __init__(self, base_url=SCREENING_SERVICE_URL, user=None, token=SERVICE_TOKEN, wait=SCREENING_SERVICE_WAIT,
+                 timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.user = user or SCREENING_SERVICE_USER or getpass.getuser()
+        self.wait = wait
+        self.timeout = timeout
+        self.session = requests.Session()
+        # HTTP 头只能是 latin-1，中文用户名需编码
+        self.session.headers['X-User'] = quote(self.user)
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+
+    def _call(self, method, path, timeout=None, **kwargs):
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=timeout or self.timeout,
+                                            **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise ServiceError(f"无法连接筛查服务：{str(e)}")
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code >= 400:
+            raise ServiceError(data.get('error') or f"筛查服务返回 HTTP {response.status_code}")
+        return data
+
+    def health(self):
+        return self._call('GET', '/health')
+
+    def upload(self, pdf_path):
+        """上传 PDF 并返回 file_id；服务端已有相同内容的文件时不再上传"""
+        file_id = _file_sha256(pdf_path)
+        if self._call('GET', f"/files/{file_id}").get('exists'):
+            return file_id
+        with open(pdf_path, 'rb') as f:
+            return self._call('POST', '/files', data=f, headers={'Content-Type': 'application/pdf'},
+                              timeout=max(self.timeout, 300))['file_id']
+
+    def submit(self, kind, **params):
+        return self._call('POST', '/jobs', json={'kind': kind, 'params': params})
+
+    def status(self, job_id, since=0, version=-1, wait=0.0):
+        return self._call('GET', f"/jobs/{job_id}", params={'since': since, 'version': version, 'wait': wait},
+                          timeout=self.timeout + wait)
+
+    def cancel(self, job_id):
+        try:
+            self._call('DELETE', f"/jobs/{job_id}")
+        except ServiceError:
+            pass
+
+    def follow(self, kind, cancel_event=None, **params):
+        """提交任务并逐次产出状态更新，任务结束（完成、失败或取消）后停止
+
+        cancel_event 置位时取消服务端任务并抛出 ServiceCancelled；生成器被提前关闭时同样取消服务端任务。
+        """
+        job = self.submit(kind, **params)
+        since = 0
+        try:
+            while job['state'] in ('queued', 'running'):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise ServiceCancelled()
+                polled = time.monotonic()
+                job = self.status(job['id'], since, job['version'], wait=self.wait)
+                since += len(job.get('pages') or ())
+                yield job
+                remaining = MIN_POLL_INTERVAL - (time.monotonic() - polled)
+                if remaining > 0:
+                    time.sleep(remaining)
+        finally:
+            if job['state'] in ('queued', 'running'):
+                self.cancel(job['id'])
+
+    def _run(self, kind, cancel_event=None, on_update=None, **params):
+        """执行任务直到结束并返回结果；失败时抛出 ServiceError，取消时抛出 ServiceCancelled"""
+        job = None
+        with closing(self.follow(kind, cancel_event, **params)) as updates:
+            for job in updates:
+                if on_update is not None:
+                    on_update(job)
+        if job['state'] == 'failed':
+            raise ServiceError(job.get('error') or "任务失败")
+        if job['state'] == 'cancelled':
+            raise ServiceCancelled()
+        return job['result']
+
+    def _run_streamed(self, kind, on_delta=None, cancel_event=None, on_stage=None, **params):
+        """执行产出流式文本的任务
+
+        阶段性文本以 on_delta(新增文本, 已累计文本) 回调，进度以 on_stage(阶段, 已完成, 总数) 回调。
+        """
+        content = ""
+
+        def on_update(job):
+            nonlocal content
+            if on_stage is not None and job.get('progress'):
+                on_stage(*job['progress'])
+            partial = job.get('partial') or ""
+            if on_delta is not None and partial != content:
+                delta = partial[len(content):] if partial.startswith(content) else partial
+                content = partial
+                on_delta(delta, content)
+
+        return self._run(kind, cancel_event, on_update, **params)
+
+    # ---- 与 ocr_utils / api_utils 同名的接口 ----
+
+    def iter_pdf_pages(self, pdf_path, pages=None, cancel_event=None, stats=None, stream=True):
+        """逐页产出 (页码, Markdown, 方式)，与 ocr_utils.iter_pdf_pages 相同；stats 中的 pages 为总页数列表"""
+        stats = stats if stats is not None else {}
+        job = None
+        with closing(self.follow('ocr', cancel_event, file_id=self.upload(pdf_path), pages=pages,
+                                 stream=stream)) as updates:
+            for job in updates:
+                if job.get('stats'):
+                    stats.update(job['stats'], pages=list(range(job['stats']['pages'])))
+                for page_no, text, method in job.get('pages') or ():
+                    yield page_no, text, method
+        if job['state'] == 'failed':
+            raise ServiceError(job.get('error') or "识别失败")
+        if job['state'] == 'cancelled':
+            raise ServiceCancelled()
+
+    def extract_text_from_pdf(self, pdf_path, pages=None, progress_callback=None, cancel_event=None):
+        """由服务识别 PDF，返回值与 ocr_utils.extract_text_from_pdf 相同"""
+        def on_update(job):
+            if progress_callback is not None and job.get('progress'):
+                progress_callback(*job['progress'][1:])
+
+        try:
+            return self._run('ocr', cancel_event, on_update, file_id=self.upload(pdf_path), pages=pages)
+        except (ServiceError, ServiceCancelled, OSError) as e:
+            message = f"PDF 处理出错：{str(e)}" if not isinstance(e, ServiceCancelled) else "已取消"
+            return {'success': False, 'text': "", 'message': message, 'is_filtered': False}
+
+    def extract_criteria_from_text(self, text, on_delta=None, cancel_event=None, refresh=False):
+        try:
+            return tuple(self._run_streamed('extract_criteria', on_delta, cancel_event, text=text, refresh=refresh))
+        except ServiceCancelled:
+            return False, "已取消"
+        except ServiceError as e:
+            return False, f"发生错误：{str(e)}"
+
+    def organize_patient_case(self, case_text, on_delta=None, cancel_event=None, refresh=False, continuation=False):
+        try:
+            return tuple(self._run_streamed('organize', on_delta, cancel_event, case_text=case_text, refresh=refresh,
+                                            continuation=continuation))
+        except ServiceCancelled:
+            return False, "已取消"
+        except ServiceError as e:
+            return False, f"发生错误：{str(e)}"
+
+    def screen_patient(self, criteria, patient_case, on_delta=None, cancel_event=None, refresh=False, previous=None,
+                       memo=None, on_stage=None):
+        """由服务分析；上一版编译结果与条目判定保存在服务端，previous 与 memo 不需要传输，返回的编译结果为 None"""
+        try:
+            return self._run_streamed('analyze', on_delta, cancel_event, on_stage, criteria=criteria,
+                                      patient_case=patient_case, refresh=refresh), None
+        except ServiceCancelled:
+            return "分析失败：已取消", None
+        except ServiceError as e:
+            return f"分析失败：{str(e)}", None
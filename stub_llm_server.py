@@ -0,0 +1,173 @@
+"""本地 OpenAI 兼容的桩服务器，用于基准测试与离线调试
+
+用法示例：
+    python stub_llm_server.py --port 8008 --delay 0.5 --stream-interval 0.02 --error-rate 0.05
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ANALYSIS = """1. 符合的条目：
+- 年龄 ≥ 18 岁（病例：患者 56 岁）
+
+2. 不符合的条目：
+无
+
+3. 总体结论：符合入排标准。"""
+
+
+def stub_content(payload):
+    """按请求内容构造一个格式合理的回复"""
+    messages = payload.get('messages') or []
+    last = (messages[-1].get('content') or "") if messages else ""
+    if (payload.get('response_format') or {}).get('type') == 'json_object':
+        requested = re.search(r'请评估以下条目：(.*)', last)
+        if requested:
+            ids = [item.strip() for item in requested.group(1).split(',') if item.strip()]
+            return json.dumps({'verdicts': [
+                {'id': item_id, 'status': 'unknown', 'evidence': '', 'reason': '桩服务器未做判断'}
+                for item_id in ids
+            ]}, ensure_ascii=False)
+        return json.dumps({'items': []})
+    return DEFAULT_ANALYSIS
+
+
+class StubLLMServer:
+    """在后台线程中运行的桩服务器
+
+    delay：收到请求到开始响应的秒数；stream_interval：流式输出每段之间的秒数；
+    error_rate：以该概率返回 error_status（默认 503，可重试）。
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, stream_interval=0.0, chunk_chars=8,
+                 error_rate=0.0, error_status=503, seed=None):
+        self.delay = delay
+        self.stream_interval = stream_interval
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.streamed = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    self._send_json(400, {'error': {'message': 'invalid json'}})
+                    return
+                with server._lock:
+                    server.requests += 1
+                    failed = server._random.random() < server.error_rate
+                    if failed:
+                        server.errors += 1
+                    elif payload.get('stream'):
+                        server.streamed += 1
+                if server.delay:
+                    time.sleep(server.delay)
+                if failed:
+                    self._send_json(server.error_status, {'error': {'message': 'stub error'}})
+                    return
+                content = stub_content(payload)
+                if payload.get('stream'):
+                    self._send_stream(content)
+                else:
+                    self._send_json(200, {
+                        'id': 'stub', 'object': 'chat.completion', 'model': payload.get('model'),
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                                     'finish_reason': 'stop'}],
+                        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+                    })
+
+            def _send_json(self, status, data):
+                out = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def _send_stream(self, content):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                step = max(1, server.chunk_chars)
+                for start in range(0, len(content), step):
+                    chunk = {'choices': [{'index': 0, 'delta': {'content': content[start:start + step]}}]}
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                    if server.stream_interval:
+                        time.sleep(server.stream_interval)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'errors': self.errors, 'streamed': self.streamed}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容桩服务器")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--delay', type=float, default=0.0, help="首字节延迟（秒）")
+    parser.add_argument('--stream-interval', type=float, default=0.0, help="流式输出每段间隔（秒）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回错误的概率")
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args(argv)
+    server = StubLLMServer(args.host, args.port, args.delay, args.stream_interval,
+                           error_rate=args.error_rate, error_status=args.error_status)
+    print(f"桩服务器已启动：API_URL={server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import batch_screening
+
+CASES = {
+    'a.pdf': "患者确诊非小细胞肺癌，EGFR 突变阳性，既往未接受靶向治疗。",
+    'b.pdf': "非小细胞肺癌术后，EGFR 突变阴性。",
+    'c.pdf': "2 型糖尿病十年，血糖控制良好。",
+    'd.pdf': "高血压病史，规律服药。",
+}
+CRITERIA = "入选标准：\n1. 组织学确诊的非小细胞肺癌\n2. EGFR 突变阳性\n"
+
+
+class FakeClient:
+    cache = None
+
+
+def _run(tmp_path, monkeypatch, fail=()):
+    analyzed = []
+
+    def fake_screen_case(case_text, protocol, organize, refresh=False, lab_rules=True):
+        analyzed.append(case_text)
+        if case_text in fail:
+            return {'status': 'error', 'error': "模型请求失败"}
+        return {'status': 'ok', 'decided_by': 'llm', 'analysis': "符合", 'conclusion': "符合"}
+
+    monkeypatch.setattr(batch_screening, 'ProcessPoolExecutor',
+                        lambda max_workers, initializer=None: ThreadPoolExecutor(max_workers))
+    monkeypatch.setattr(batch_screening, 'extract_text_from_pdf',
+                        lambda path, pages=None: {'success': True, 'text': open(path, encoding='utf-8').read()})
+    monkeypatch.setattr(batch_screening, 'screen_case', fake_screen_case)
+    monkeypatch.setattr(batch_screening, 'get_llm_client', FakeClient)
+    code = batch_screening.run_batch(argparse.Namespace(
+        cases_dir=str(tmp_path / 'cases'), protocol=[], protocol_pages=None,
+        criteria_file=[str(tmp_path / 'criteria.txt')], output=str(tmp_path / 'results.jsonl'), csv=None,
+        ocr_workers=1, llm_concurrency=1, organize=False, per_criterion=False, top_k=2,
+        index=str(tmp_path / 'index.sqlite3'), lab_rules=False, llm_cache=False, refresh_cache=False,
+    ))
+    assert code == 0
+    return analyzed
+
+
+def test_resume_with_top_k_does_not_promote_skipped_cases(tmp_path, monkeypatch):
+    (tmp_path / 'cases').mkdir()
+    for name, text in CASES.items():
+        (tmp_path / 'cases' / name).write_text(text, encoding='utf-8')
+    (tmp_path / 'criteria.txt').write_text(CRITERIA, encoding='utf-8')
+
+    first = _run(tmp_path, monkeypatch, fail={CASES['b.pdf']})
+    assert sorted(first) == sorted([CASES['a.pdf'], CASES['b.pdf']])
+
+    # 续跑只重试失败的组合，之前落选的病例不会补进前 K 名
+    second = _run(tmp_path, monkeypatch)
+    assert second == [CASES['b.pdf']]
+
+    with open(tmp_path / 'results.jsonl', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    skipped = {r['case'].rsplit('/', 1)[-1] for r in records if r['status'] == 'skipped'}
+    assert skipped == {'c.pdf', 'd.pdf'}
+    assert len([r for r in records if r['status'] == 'skipped']) == 2
@@ -0,0 +1,45 @@
+import sqlite3
+
+from candidate_index import CandidateIndex, TOKENIZER_BIGRAM, TOKENIZER_JIEBA
+
+CRITERIA = "入选标准：\n1. 组织学确诊的非小细胞肺癌\n2. EGFR 突变阳性\n"
+
+
+def _build(path):
+    index = CandidateIndex(path, tokenizer=TOKENIZER_BIGRAM)
+    index.add_documents([
+        ('a', 'a.pdf', "确诊非小细胞肺癌，EGFR 突变阳性。"),
+        ('b', 'b.pdf', "2 型糖尿病，血糖控制良好。"),
+        ('c', 'c.pdf', "非小细胞肺癌术后复发。"),
+    ])
+    return index
+
+
+def test_rank_for_criteria_orders_by_relevance(tmp_path):
+    index = _build(str(tmp_path / "index.sqlite3"))
+    ranked = [key for key, _, _ in index.rank_for_criteria(CRITERIA, top_k=2)]
+    assert ranked == ['a', 'c']
+    # 只在指定的病例中排序
+    assert [key for key, _, _ in index.rank_for_criteria(CRITERIA, keys={'b', 'c'})][0] == 'c'
+    index.close()
+
+
+def test_index_is_rebuilt_when_tokenizer_changes(tmp_path):
+    path = str(tmp_path / "index.sqlite3")
+    _build(path).close()
+    # 模拟索引由 jieba 分词建立、当前环境没有 jieba
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE meta SET value = ? WHERE name = 'tokenizer'", (TOKENIZER_JIEBA,))
+    conn.commit()
+    conn.close()
+
+    index = CandidateIndex(path, tokenizer=TOKENIZER_BIGRAM)
+    assert len(index) == 0
+    assert index.stats() == {'documents': 0, 'segments': 0, 'terms': 0, 'tokenizer': TOKENIZER_BIGRAM}
+    index.close()
+
+    # 分词方式不变时重新打开，保留已有文档
+    _build(path).close()
+    index = CandidateIndex(path, tokenizer=TOKENIZER_BIGRAM)
+    assert len(index) == 3
+    index.close()
@@ -0,0 +1,33 @@
+from analysis_engine import split_case_sections
+from prompt_budget import count_tokens
+
+LINES = [f"第{i}行：患者复查血常规，白细胞计数 {i % 9}.{i % 7} ×10^9/L，血小板 {100 + i} ×10^9/L。\n" for i in range(600)]
+MAX_TOKENS = 400
+
+
+def _chunks(lines):
+    return split_case_sections("".join(lines), max_tokens=MAX_TOKENS)
+
+
+def test_chunks_cover_text_within_budget():
+    chunks = _chunks(LINES)
+    assert "".join(chunks) == "".join(LINES)
+    assert all(count_tokens(chunk) <= MAX_TOKENS for chunk in chunks)
+
+
+def test_edit_only_changes_its_own_chunk():
+    before = _chunks(LINES)
+    for edited in (0, 137, 300, 599):
+        lines = list(LINES)
+        lines[edited] = lines[edited].replace("复查", "门诊复查")
+        after = _chunks(lines)
+        owner = next(i for i, chunk in enumerate(before) if LINES[edited] in chunk)
+        # 除被修改的分块（及其后紧邻、可能与之合并的分块）外，其余分块内容不变
+        untouched = [chunk for i, chunk in enumerate(before) if i not in (owner, owner + 1)]
+        assert set(untouched) <= set(after)
+
+
+def test_inserting_a_line_at_the_top_keeps_later_chunks():
+    before = _chunks(LINES)
+    after = _chunks(["新增一行既往史。\n"] + LINES)
+    assert len(set(before) - set(after)) <= 2
@@ -0,0 +1,44 @@
+import threading
+from types import SimpleNamespace
+
+from screening_service import FairQueue
+
+
+def _job(user, name):
+    return SimpleNamespace(user=user, name=name)
+
+
+def test_users_take_turns():
+    queue = FairQueue()
+    jobs = [_job('alice', f"a{i}") for i in range(3)] + [_job('bob', "b0"), _job('carol', "c0")]
+    for job in jobs:
+        queue.put(job)
+
+    assert queue.position(jobs[3]) == 1
+    assert queue.position(jobs[2]) == 4
+    assert [queue.get().name for _ in range(5)] == ["a0", "b0", "c0", "a1", "a2"]
+    assert len(queue) == 0
+
+
+def test_remove_and_count():
+    queue = FairQueue()
+    first, second = _job('alice', "a0"), _job('alice', "a1")
+    queue.put(first)
+    queue.put(second)
+    assert queue.count('alice') == 2
+
+    assert queue.remove(first)
+    assert not queue.remove(first)
+    assert queue.position(first) is None
+    assert queue.get() is second
+    assert queue.count('alice') == 0
+
+
+def test_close_wakes_waiting_workers():
+    queue = FairQueue()
+    results = []
+    worker = threading.Thread(target=lambda: results.append(queue.get()))
+    worker.start()
+    queue.close()
+    worker.join(timeout=5)
+    assert results == [None]
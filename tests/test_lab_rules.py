@@ -0,0 +1,78 @@
+from analysis_engine import CATEGORY_EXCLUSION, STATUS_MET, STATUS_NOT_MET
+from lab_rules import parse_lab_values, screen_cohort
+
+COMPILED = {
+    'items': [
+        {'id': 'E1', 'category': CATEGORY_EXCLUSION, 'text': '血小板 < 100×10^9/L',
+         'thresholds': [{'analyte': '血小板', 'operator': '<', 'value': 100.0, 'unit': '×10^9/L'}]},
+        {'id': 'E2', 'category': CATEGORY_EXCLUSION, 'text': '既往接受过免疫治疗', 'thresholds': []},
+    ],
+}
+
+
+def test_screen_cohort_excludes_by_threshold():
+    cases = [
+        "| 项目 | 结果 | 单位 |\n| --- | --- | --- |\n| 血小板计数 | 65 | ×10^9/L |",
+        "| 项目 | 结果 | 单位 |\n| --- | --- | --- |\n| 血小板计数 | 210 | ×10^9/L |",
+        "患者无检验结果。",
+    ]
+    low, normal, missing = screen_cohort(COMPILED, cases)
+
+    assert low['excluded']
+    assert low['verdicts']['E1']['status'] == STATUS_MET
+    assert 'E1' in low['analysis']
+
+    assert not normal['excluded']
+    assert normal['verdicts']['E1']['status'] == STATUS_NOT_MET
+    assert normal['analysis'] is None
+
+    assert missing == {'excluded': False, 'verdicts': {}, 'analysis': None}
+
+
+WBC_RULE = {
+    'items': [
+        {'id': 'E1', 'category': CATEGORY_EXCLUSION, 'text': '白细胞 < 3.0×10^9/L',
+         'thresholds': [{'analyte': 'WBC', 'operator': '<', 'value': 3.0, 'unit': '×10^9/L'}]},
+    ],
+}
+
+
+def test_urine_section_is_not_read_as_blood():
+    case = "\n".join([
+        "## 尿常规",
+        "| 项目 | 结果 | 单位 | 参考范围 |",
+        "| --- | --- | --- | --- |",
+        "| 白细胞 | 3 | /uL | 0-25 |",
+        "## 血常规",
+        "| 项目 | 结果 | 单位 | 参考范围 |",
+        "| --- | --- | --- | --- |",
+        "| 白细胞 | 5.6 | ×10^9/L | 3.5-9.5 |",
+    ])
+    assert parse_lab_values(case)['WBC']['value'] == 5.6
+    outcome, = screen_cohort(WBC_RULE, [case])
+    assert not outcome['excluded']
+    assert outcome['verdicts']['E1']['status'] == STATUS_NOT_MET
+
+
+def test_urine_only_value_is_left_to_the_model():
+    case = "尿常规：白细胞 3 /uL，尿蛋白 阴性"
+    assert 'WBC' not in parse_lab_values(case)
+    assert screen_cohort(WBC_RULE, [case]) == [{'excluded': False, 'verdicts': {}, 'analysis': None}]
+
+
+def test_shared_name_without_section_is_ambiguous():
+    case = "| 项目 | 结果 | 单位 |\n| --- | --- | --- |\n| 白细胞 | 2.1 | ×10^9/L |"
+    assert 'WBC' not in parse_lab_values(case)
+
+
+def test_most_recent_value_wins():
+    case = "\n".join([
+        "2023-01-05 血常规：白细胞计数 2.1 ×10^9/L",
+        "2023-03-20 血常规：白细胞计数 6.0 ×10^9/L",
+    ])
+    assert parse_lab_values(case)['WBC']['value'] == 6.0
+
+
+def test_conflicting_undated_values_are_ambiguous():
+    case = "血常规：白细胞计数 2.1 ×10^9/L\n\n复查血常规：白细胞计数 6.0 ×10^9/L"
+    assert 'WBC' not in parse_lab_values(case)
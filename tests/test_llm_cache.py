@@ -0,0 +1,38 @@
+from llm_cache import LLMResponseCache
+from llm_client import LLMClient
+
+
+def _client(tmp_path, content):
+    cache = LLMResponseCache(str(tmp_path / "llm.sqlite3"))
+    client = LLMClient(api_key="test", api_url="http://127.0.0.1:9", cache=cache)
+    client.calls = 0
+
+    def fake_request(payload, timeout, stream=False, request_span=None):
+        client.calls += 1
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    client._request = fake_request
+    return client
+
+
+def test_identical_requests_hit_cache(tmp_path):
+    client = _client(tmp_path, '{"verdicts": []}')
+    messages = [{"role": "user", "content": "病例"}]
+    first = client.chat_completion(messages, temperature=0.0, response_format={"type": "json_object"})
+    second = client.chat_completion(messages, temperature=0.0, response_format={"type": "json_object"})
+
+    assert first == second
+    assert client.calls == 1
+    # 参数不同视为不同请求
+    client.chat_completion(messages, temperature=0.5, response_format={"type": "json_object"})
+    assert client.calls == 2
+
+
+def test_unparsable_json_response_is_not_cached(tmp_path):
+    client = _client(tmp_path, "抱歉，无法判断")
+    messages = [{"role": "user", "content": "病例"}]
+    client.chat_completion(messages, response_format={"type": "json_object"})
+    client.chat_completion(messages, response_format={"type": "json_object"})
+
+    assert client.calls == 2
+    assert client.cache.stats()['entries'] == 0
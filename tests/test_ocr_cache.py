@@ -0,0 +1,24 @@
+from ocr_cache import OcrCache
+
+FINGERPRINT = (('do_ocr', True), ('engine', 'rapidocr'))
+
+
+def test_pages_are_keyed_by_document_and_pipeline(tmp_path):
+    cache = OcrCache(str(tmp_path / "ocr.sqlite3"))
+    cache.put_pages('doc', FINGERPRINT, {1: "第一页", 2: "第二页"})
+
+    assert cache.get_pages('doc', FINGERPRINT, [1, 2, 3]) == {1: "第一页", 2: "第二页"}
+    # 流水线参数不同（如关闭 OCR）时不复用
+    assert cache.get_pages('doc', (('do_ocr', False),), [1]) == {}
+    assert cache.get_pages('other', FINGERPRINT, [1]) == {}
+    cache.close()
+
+
+def test_least_recently_used_pages_are_evicted(tmp_path):
+    cache = OcrCache(str(tmp_path / "ocr.sqlite3"), max_bytes=len("页".encode('utf-8')) * 200 * 2)
+    cache.put_pages('doc', FINGERPRINT, {1: "页" * 200, 2: "页" * 200})
+    cache.get_pages('doc', FINGERPRINT, [1])
+    cache.put_pages('doc', FINGERPRINT, {3: "页" * 200})
+
+    assert sorted(cache.get_pages('doc', FINGERPRINT, [1, 2, 3])) == [1, 3]
+    cache.close()
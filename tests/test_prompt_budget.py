@@ -0,0 +1,37 @@
+from prompt_budget import compress_markdown, compact_tables, strip_repeated_lines
+
+PAGES = [
+    "<!-- 第 {n} 页 -->\n\n某某医院 出院记录\n\n血红蛋白 {hb} g/L\n\n第 {n} 页 共 3 页".format(n=n, hb=hb)
+    for n, hb in ((1, 98), (2, 102), (3, 110))
+]
+
+
+def test_strip_repeated_lines_removes_headers_and_page_footers():
+    stripped = strip_repeated_lines("\n".join(PAGES))
+
+    assert "某某医院 出院记录" not in stripped
+    assert "共 3 页" not in stripped
+    # 每页格式相同但数值不同的正文、页码标记都保留
+    for n, hb in ((1, 98), (2, 102), (3, 110)):
+        assert f"<!-- 第 {n} 页 -->" in stripped
+        assert f"血红蛋白 {hb} g/L" in stripped
+
+
+def test_strip_repeated_lines_keeps_short_documents():
+    text = "\n".join(PAGES[:2])
+    assert strip_repeated_lines(text) == text
+
+
+def test_compact_tables_drops_padding_empty_and_duplicate_columns():
+    table = "\n".join([
+        "| 项目      | 项目      | 结果   |     | 单位   |",
+        "|-----------|-----------|--------|-----|--------|",
+        "| 血小板    | 血小板    | 65     |     | ×10^9/L |",
+        "|           |           |        |     |        |",
+    ])
+    assert compact_tables(table) == "|项目|结果|单位|\n|-|-|-|\n|血小板|65|×10^9/L|"
+
+
+def test_compress_markdown_keeps_clinical_text():
+    text = "病史摘要\n\n<!-- image -->\n\n\n\n患者 ALT 120 U/L   \n"
+    assert compress_markdown(text) == "病史摘要\n\n患者 ALT 120 U/L"
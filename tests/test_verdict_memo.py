@@ -0,0 +1,68 @@
+import json
+import re
+
+import pytest
+
+from analysis_engine import VerdictMemo, map_reduce_analysis, STATUS_MET
+from llm_client import set_llm_client
+
+CRITERIA = "入选标准：\n1. 年龄 18-75 岁\n2. 确诊非小细胞肺癌\n排除标准：\n1. 妊娠期女性\n"
+CASE = "患者男，56 岁，确诊非小细胞肺癌。"
+
+
+class FakeClient:
+    """按请求中的条目编号全部判为 met，并记录每次请求评估了哪些条目"""
+
+    def __init__(self, content=None):
+        self.content = content
+        self.requested = []
+
+    def chat_completion(self, messages, **kwargs):
+        ids = re.findall(r'[IE]\d+', messages[-1]['content'])
+        self.requested.append(ids)
+        content = self.content or json.dumps(
+            {'verdicts': [{'id': i, 'status': STATUS_MET, 'evidence': "", 'reason': ""} for i in ids]})
+        return {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+
+
+@pytest.fixture
+def client():
+    fake = FakeClient()
+    previous = set_llm_client(fake)
+    yield fake
+    set_llm_client(previous)
+
+
+def test_memo_reuses_verdicts_and_reevaluates_only_changed_items(client):
+    memo = VerdictMemo()
+    map_reduce_analysis(CRITERIA, CASE, memo=memo)
+    assert sorted(i for ids in client.requested for i in ids) == ['E1', 'I1', 'I2']
+    assert len(memo) == 3
+
+    client.requested.clear()
+    map_reduce_analysis(CRITERIA, CASE, memo=memo)
+    assert client.requested == []
+
+    map_reduce_analysis(CRITERIA.replace("18-75", "18-80"), CASE, memo=memo)
+    assert client.requested == [['I1']]
+
+    client.requested.clear()
+    map_reduce_analysis(CRITERIA, CASE, memo=memo, refresh=True)
+    assert sorted(i for ids in client.requested for i in ids) == ['E1', 'I1', 'I2']
+
+
+def test_unparsable_chunk_is_not_memoized(client):
+    memo = VerdictMemo()
+    client.content = "无法判断"
+    map_reduce_analysis(CRITERIA, CASE, memo=memo)
+    assert len(memo) == 0
+
+
+def test_memo_evicts_least_recently_used():
+    memo = VerdictMemo(max_entries=2)
+    memo.put('a', 'c1', 1)
+    memo.put('b', 'c1', 2)
+    assert memo.get('a', 'c1') == 1
+    memo.put('c', 'c1', 3)
+    assert memo.get('b', 'c1') is None
+    assert memo.get('a', 'c1') == 1 and memo.get('c', 'c1') == 3
@@ -0,0 +1,279 @@
+"""工作区：把筛查会话的方案、病例、整理结果与分析结果按内容哈希去重保存在本地 SQLite 中"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from config import WORKSPACE_ENABLED, WORKSPACE_DB, WORKSPACE_MAX_MB, WORKSPACE_MAX_SESSIONS
+from instrumentation import log_event
+
+# 会话中保存的内容类型
+DOC_PROTOCOL = 'protocol'      # 方案 PDF 的识别结果
+DOC_CRITERIA = 'criteria'      # 入排标准
+DOC_COMPILED = 'compiled'      # 编译好的入排标准条目（JSON）
+DOC_CASE = 'case'              # 病例 PDF 的识别结果
+DOC_ORGANIZED = 'organized'    # 整理后的病例
+DOC_ANALYSIS = 'analysis'      # 分析结果
+
+# 可在 update_session 中修改的会话字段
+SESSION_FIELDS = ('title', 'protocol_path', 'protocol_hash', 'case_path', 'case_hash', 'summary')
+# 空闲页超过数据库文件的该比例时 VACUUM
+VACUUM_FREE_RATIO = 0.25
+
+
+def content_hash(*parts):
+    """一组文本的 SHA-256，用作内容与输入的哈希"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class WorkspaceStore:
+    """SQLite 持久化的筛查会话，超出 max_bytes / max_sessions 时删除最久未打开的会话"""
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024, max_sessions=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL DEFAULT '',
+                protocol_path TEXT NOT NULL DEFAULT '',
+                protocol_hash TEXT NOT NULL DEFAULT '',
+                case_path TEXT NOT NULL DEFAULT '',
+                case_hash TEXT NOT NULL DEFAULT '',
+                summary TEXT NOT NULL DEFAULT '',
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                opened_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at);
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                raw_size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                session_id INTEGER NOT NULL REFERENCES sessions (id) ON DELETE CASCADE,
+                kind TEXT NOT NULL,
+                input_hash TEXT NOT NULL DEFAULT '',
+                blob_hash TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (session_id, kind)
+            );
+            CREATE INDEX IF NOT EXISTS idx_documents_blob ON documents (blob_hash);"""
+        )
+        self._conn.commit()
+
+    # ---- 会话 ----
+
+    def create_session(self, title="", **fields):
+        """新建会话，返回会话编号"""
+        now = time.time()
+        values = {'title': title, **{key: value for key, value in fields.items() if key in SESSION_FIELDS}}
+        columns = ', '.join(values)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"INSERT INTO sessions ({columns}, created_at, updated_at, opened_at) "
+                f"VALUES ({', '.join('?' * len(values))}, ?, ?, ?)",
+                [*values.values(), now, now, now],
+            )
+            self._conn.commit()
+            session_id = cursor.lastrowid
+        self._enforce_limits(keep=session_id)
+        return session_id
+
+    def update_session(self, session_id, **fields):
+        """修改会话的元数据（title、protocol_path、case_path、summary 等）"""
+        values = {key: value or "" for key, value in fields.items() if key in SESSION_FIELDS}
+        if not values:
+            return
+        assignments = ', '.join(f"{key} = ?" for key in values)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE sessions SET {assignments}, updated_at = ? WHERE id = ?",
+                [*values.values(), time.time(), session_id],
+            )
+            self._conn.commit()
+
+    def list_sessions(self, limit=200):
+        """按最近修改时间列出会话（只读元数据），每项附带已保存的内容类型"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.id, s.title, s.protocol_path, s.case_path, s.summary, s.created_at, s.updated_at, "
+                "GROUP_CONCAT(d.kind) FROM sessions s LEFT JOIN documents d ON d.session_id = s.id "
+                "GROUP BY s.id ORDER BY s.updated_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            {
+                'id': row[0], 'title': row[1], 'protocol_path': row[2], 'case_path': row[3], 'summary': row[4],
+                'created_at': row[5], 'updated_at': row[6], 'kinds': row[7].split(',') if row[7] else [],
+            }
+            for row in rows
+        ]
+
+    def open_session(self, session_id):
+        """读取会话元数据并记录打开时间；各类内容的输入哈希一并返回，内容本身用 load 按需读取"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, title, protocol_path, protocol_hash, case_path, case_hash, summary, created_at, "
+                "updated_at FROM sessions WHERE id = ?",
+                (session_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            documents = dict(self._conn.execute(
+                "SELECT kind, input_hash FROM documents WHERE session_id = ?", (session_id,)
+            ).fetchall())
+            self._conn.execute("UPDATE sessions SET opened_at = ? WHERE id = ?", (time.time(), session_id))
+            self._conn.commit()
+        keys = ('id', 'title', 'protocol_path', 'protocol_hash', 'case_path', 'case_hash', 'summary', 'created_at',
+                'updated_at')
+        return {**dict(zip(keys, row)), 'documents': documents}
+
+    def delete_session(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._delete_orphans_locked()
+            self._conn.commit()
+
+    # ---- 内容 ----
+
+    def save(self, session_id, kind, text, input_hash=""):
+        """保存会话中的一类内容及其输入哈希；内容与输入都没有变化时不写入，返回是否写入"""
+        text = text or ""
+        blob_hash = content_hash(text)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT blob_hash, input_hash FROM documents WHERE session_id = ? AND kind = ?",
+                (session_id, kind),
+            ).fetchone()
+            if row == (blob_hash, input_hash):
+                return False
+            raw = text.encode('utf-8')
+            if self._conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (blob_hash,)).fetchone() is None:
+                data = zlib.compress(raw, 6)
+                self._conn.execute(
+                    "INSERT INTO blobs (hash, data, size, raw_size) VALUES (?, ?, ?, ?)",
+                    (blob_hash, data, len(data), len(raw)),
+                )
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (session_id, kind, input_hash, blob_hash, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, kind, input_hash, blob_hash, now),
+            )
+            self._conn.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (now, session_id))
+            if row is not None:
+                self._delete_orphans_locked()
+            self._conn.commit()
+        self._enforce_limits(keep=session_id)
+        return True
+
+    def load(self, session_id, kind, input_hash=None):
+        """读取会话中的一类内容；传入 input_hash 时只在保存时的输入与之相同时返回，否则返回 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT d.input_hash, b.data FROM documents d JOIN blobs b ON b.hash = d.blob_hash "
+                "WHERE d.session_id = ? AND d.kind = ?",
+                (session_id, kind),
+            ).fetchone()
+        if row is None or (input_hash is not None and row[0] != input_hash):
+            return None
+        return zlib.decompress(row[1]).decode('utf-8')
+
+    # ---- 容量 ----
+
+    def _delete_orphans_locked(self):
+        cursor = self._conn.execute(
+            "DELETE FROM blobs WHERE NOT EXISTS (SELECT 1 FROM documents d WHERE d.blob_hash = blobs.hash)"
+        )
+        return max(cursor.rowcount, 0)
+
+    def _enforce_limits(self, keep=None):
+        """超出大小或会话数上限时按最近打开时间删除旧会话（不删除 keep）"""
+        removed = 0
+        with self._lock:
+            while True:
+                size, = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+                count, = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+                if size <= self.max_bytes and not (self.max_sessions and count > self.max_sessions):
+                    break
+                row = self._conn.execute(
+                    "SELECT id FROM sessions WHERE id != ? ORDER BY opened_at ASC LIMIT 1", (keep or 0,)
+                ).fetchone()
+                if row is None:
+                    break
+                self._conn.execute("DELETE FROM sessions WHERE id = ?", row)
+                self._delete_orphans_locked()
+                removed += 1
+            self._conn.commit()
+        if removed:
+            log_event("workspace.evicted", f"工作区超出容量，已删除 {removed} 个最久未打开的会话", removed=removed)
+        return removed
+
+    def compact(self, force=False):
+        """清理无人引用的内容；空闲页超过 VACUUM_FREE_RATIO（或 force=True）时 VACUUM 并截断 WAL"""
+        with self._lock:
+            orphans = self._delete_orphans_locked()
+            self._conn.commit()
+            page_count, = self._conn.execute("PRAGMA page_count").fetchone()
+            free_pages, = self._conn.execute("PRAGMA freelist_count").fetchone()
+            vacuumed = force or (page_count and free_pages / page_count > VACUUM_FREE_RATIO)
+            if vacuumed:
+                self._conn.execute("VACUUM")
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if orphans or vacuumed:
+            log_event("workspace.compacted", level="debug", orphans=orphans, free_pages=free_pages,
+                      vacuumed=bool(vacuumed))
+        return {'orphans': orphans, 'free_pages': free_pages, 'vacuumed': bool(vacuumed)}
+
+    def stats(self):
+        """会话数、内容条目数与占用（压缩后 / 原始）"""
+        with self._lock:
+            sessions, = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+            blobs, size, raw_size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(raw_size), 0) FROM blobs"
+            ).fetchone()
+        return {
+            'sessions': sessions,
+            'blobs': blobs,
+            'size_bytes': size,
+            'raw_bytes': raw_size,
+            'max_bytes': self.max_bytes,
+            'file_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_workspace_store():
+    """返回进程内共享的工作区；未启用时返回 None。首次使用时才打开数据库，不拖慢启动"""
+    global _store
+    if not WORKSPACE_ENABLED:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = WorkspaceStore(WORKSPACE_DB, max_bytes=WORKSPACE_MAX_MB * 1024 * 1024,
+                                    max_sessions=WORKSPACE_MAX_SESSIONS)
+        return _store